@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from metrics import Counter
+from notifier import TokenBucket
+
+UPDATES_ADMITTED = Counter("updates_admitted_total", "Updates passed on to the handlers")
+UPDATES_COALESCED = Counter("updates_coalesced_total", "Repeated requests left to the reply of an identical earlier one")
+UPDATES_ESSENTIAL = Counter("updates_essential_total", "Conversation steps admitted whatever the budget")
+UPDATES_SHED = Counter("updates_shed_total", "Updates refused over budget, by the budget exceeded and whether they got a reply", ["limit", "reply"])
+
+# Decisions of AdmissionControl.check
+ADMIT = "admit"
+COALESCE = "coalesce"
+# Shed with a cheap reply, or silently because the user got one just before
+SHED = "shed"
+DROP = "drop"
+
+
+# Decides which incoming updates reach the handlers. A request identical to
+# the same user's previous admitted one within `coalesce_seconds` is
+# coalesced: the earlier reply answers both. Any other update needs a token
+# from the user's bucket (user_rate per second, bursts of user_burst) and
+# one from the global bucket; without them it is shed. A user over their own
+# budget gets at most one shed reply every `coalesce_seconds`; an update shed
+# because everyone together is over budget is always answered, since the
+# user did nothing wrong. Essential updates (a step of a conversation the
+# user is in) are always admitted, taking tokens when there are any. Buckets
+# are kept for the `max_users` most recently seen users.
+class AdmissionControl:
+    def __init__(self, user_rate=1.0, user_burst=8, global_rate=30.0, global_burst=100,
+                 coalesce_seconds=3.0, max_users=100_000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.coalesce_seconds = coalesce_seconds
+        self.max_users = max_users
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        # user id -> [bucket, last admitted request, when, when last shed with a reply]
+        self.users = OrderedDict()
+
+    # `request` identifies requests that may be coalesced (e.g. a price view
+    # of one symbol); None for everything else
+    def check(self, user_id, request=None, now=None, essential=False):
+        now = time.monotonic() if now is None else now
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = [TokenBucket(self.user_rate, self.user_burst), None, 0.0, None]
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+
+        if request is not None and request == entry[1] and now - entry[2] < self.coalesce_seconds:
+            UPDATES_COALESCED.inc()
+            return COALESCE
+
+        if essential:
+            entry[0].take()
+            self.global_bucket.take()
+            UPDATES_ESSENTIAL.inc()
+        elif entry[0].take():
+            return self._shed(entry, "user", now)
+        elif self.global_bucket.take():
+            # Not the user's fault: give their token back, and always reply
+            entry[0].tokens += 1
+            UPDATES_SHED.labels("global", "yes").inc()
+            return SHED
+
+        entry[1], entry[2] = request, now
+        UPDATES_ADMITTED.inc()
+        return ADMIT
+
+    def _shed(self, entry, limit, now):
+        if entry[3] is not None and now - entry[3] < self.coalesce_seconds:
+            UPDATES_SHED.labels(limit, "no").inc()
+            return DROP
+        entry[3] = now
+        UPDATES_SHED.labels(limit, "yes").inc()
+        return SHED
@@ -0,0 +1,618 @@
+import bisect
+import heapq
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime
+import numpy as np
+
+# created_at format in user_alerts.json and the database
+CREATED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# One price alert, never modified once it is in an AlertBook. created_at is a
+# Unix timestamp; the price the alert was last compared against is kept once
+# per symbol (AlertIndex.last_prices) rather than per alert.
+#
+# The base class fires when the price crosses target_price. Subclasses are
+# the other alert types; for them target_price is the price when the alert
+# was created, and `fields` lists their extra attributes.
+class Alert:
+    __slots__ = ("id", "user_id", "symbol", "target_price", "created_at")
+    kind = "cross"
+    fields = ()
+
+    def __init__(self, id, user_id, symbol, target_price, created_at):
+        self.id = id
+        self.user_id = user_id
+        self.symbol = symbol
+        self.target_price = target_price
+        self.created_at = created_at
+
+    # Build an alert of any type from its user_alerts.json form
+    @staticmethod
+    def from_dict(user_id, symbol, data):
+        return make_alert(
+            data.get("type", "cross"), data.get("id"), int(user_id), symbol, float(data["target_price"]),
+            parse_created_at(data.get("created_at")), **{field: float(data[field]) for field in ("percent", "window") if field in data}
+        )
+
+    # user_alerts.json form of the alert; price-crossing alerts keep the
+    # original layout, other types add their type and fields
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "target_price": self.target_price,
+            "created_at": format_created_at(self.created_at),
+            "last_price": None
+        }
+        if self.kind != "cross":
+            data["type"] = self.kind
+            for field in self.fields:
+                data[field] = getattr(self, field)
+        return data
+
+
+# Fires when the price has moved `percent` or more within `window` seconds,
+# i.e. is that far above the window's low or below its high
+class PercentMoveAlert(Alert):
+    __slots__ = ("percent", "window")
+    kind = "move"
+    fields = ("percent", "window")
+
+    def __init__(self, id, user_id, symbol, target_price, created_at, percent, window):
+        super().__init__(id, user_id, symbol, target_price, created_at)
+        self.percent = percent
+        self.window = window
+
+
+# Trailing stop: fires when the price falls `percent` below the highest price
+# seen since the alert was created
+class TrailingAlert(Alert):
+    __slots__ = ("percent",)
+    kind = "trailing"
+    fields = ("percent",)
+
+    def __init__(self, id, user_id, symbol, target_price, created_at, percent):
+        super().__init__(id, user_id, symbol, target_price, created_at)
+        self.percent = percent
+
+
+ALERT_TYPES = {cls.kind: cls for cls in (Alert, PercentMoveAlert, TrailingAlert)}
+
+
+def make_alert(kind, id, user_id, symbol, target_price, created_at, **fields):
+    cls = ALERT_TYPES[kind]
+    return cls(id, user_id, symbol, target_price, created_at, *(fields[field] for field in cls.fields))
+
+
+def parse_created_at(text):
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except (TypeError, ValueError):
+        return datetime.now().timestamp()
+
+
+def format_created_at(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime(CREATED_AT_FORMAT)
+
+
+# Target prices of the alerts per symbol, kept sorted in flat arrays so that a
+# price tick only has to look at the alerts whose target it actually crossed
+class AlertIndex:
+    def __init__(self):
+        # symbol -> sorted array of target prices
+        self.targets = {}
+        # symbol -> array of alert ids kept parallel to self.targets
+        self.ids = {}
+        # symbol -> price seen on the previous tick
+        self.last_prices = {}
+
+    def __len__(self):
+        return sum(len(targets) for targets in self.targets.values())
+
+    def count(self, symbol):
+        return len(self.targets.get(symbol, ()))
+
+    # Rebuild the whole index from an iterable of alerts
+    def rebuild(self, alerts):
+        columns = {}
+        for alert in alerts:
+            columns.setdefault(alert.symbol, []).append((alert.target_price, alert.id))
+
+        self.targets = {}
+        self.ids = {}
+        for symbol, entries in columns.items():
+            entries.sort()
+            self.targets[symbol] = array('d', [target for target, _ in entries])
+            self.ids[symbol] = array('q', [alert_id for _, alert_id in entries])
+
+    # Take saved columns (symbol -> (targets, ids) as raw bytes) instead of
+    # rebuilding, if they hold exactly `alerts` in index order. Returns whether
+    # they did; the index is unchanged when not.
+    def restore(self, alerts, columns):
+        alerts = list(alerts)
+        expected_ids = np.fromiter((alert.id for alert in alerts), dtype=np.int64, count=len(alerts))
+        expected_targets = np.fromiter((alert.target_price for alert in alerts), dtype=np.float64, count=len(alerts))
+        targets_by_symbol, ids_by_symbol = {}, {}
+        saved_targets, saved_ids = [], []
+        for symbol, (target_bytes, id_bytes) in columns.items():
+            targets = np.frombuffer(target_bytes, dtype=np.float64)
+            ids = np.frombuffer(id_bytes, dtype=np.int64)
+            if len(targets) != len(ids) or np.any(targets[1:] < targets[:-1]):
+                return False
+            saved_targets.append(targets)
+            saved_ids.append(ids)
+            targets_by_symbol[symbol], ids_by_symbol[symbol] = array('d', target_bytes), array('q', id_bytes)
+
+        # Same ids with the same targets, compared in id order
+        saved_ids = np.concatenate(saved_ids) if saved_ids else expected_ids[:0]
+        saved_targets = np.concatenate(saved_targets) if saved_targets else expected_targets[:0]
+        if len(saved_ids) != len(expected_ids):
+            return False
+        saved_order, expected_order = np.argsort(saved_ids), np.argsort(expected_ids)
+        if not (np.array_equal(saved_ids[saved_order], expected_ids[expected_order])
+                and np.array_equal(saved_targets[saved_order], expected_targets[expected_order])):
+            return False
+
+        self.targets = targets_by_symbol
+        self.ids = ids_by_symbol
+        return True
+
+    # Symbols that currently have at least one alert
+    def symbols(self):
+        return [symbol for symbol, targets in self.targets.items() if targets]
+
+    def add(self, alert):
+        targets = self.targets.get(alert.symbol)
+        if targets is None:
+            targets = self.targets[alert.symbol] = array('d')
+            self.ids[alert.symbol] = array('q')
+        i = bisect.bisect_right(targets, alert.target_price)
+        targets.insert(i, alert.target_price)
+        self.ids[alert.symbol].insert(i, alert.id)
+
+    # Remove one alert, matching it by id among alerts with the same target
+    def remove(self, alert):
+        targets = self.targets.get(alert.symbol)
+        if not targets:
+            return False
+
+        ids = self.ids[alert.symbol]
+        i = bisect.bisect_left(targets, alert.target_price)
+        while i < len(targets) and targets[i] == alert.target_price:
+            if ids[i] == alert.id:
+                del targets[i]
+                del ids[i]
+                return True
+            i += 1
+        return False
+
+    # Remove and return the ids of every alert whose target lies between the
+    # previous and the current price, both ends included
+    def pop_crossed(self, symbol, previous_price, current_price):
+        targets = self.targets.get(symbol)
+        if not targets:
+            return []
+
+        low, high = min(previous_price, current_price), max(previous_price, current_price)
+        lo = bisect.bisect_left(targets, low)
+        hi = bisect.bisect_right(targets, high)
+        if lo == hi:
+            return []
+
+        ids = self.ids[symbol]
+        crossed = ids[lo:hi].tolist()
+        del targets[lo:hi]
+        del ids[lo:hi]
+        return crossed
+
+
+# Rolling low and high of one symbol over `seconds`, with the percent-move
+# alerts that share that window sorted by percent. The low and high come from
+# monotonic deques, so each tick costs amortised O(1) however many alerts use
+# the window.
+class _MoveWindow:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        # (timestamp, price) with increasing prices; the first is the low
+        self.lows = deque()
+        # (timestamp, price) with decreasing prices; the first is the high
+        self.highs = deque()
+        self.percents = array('d')
+        self.ids = array('q')
+
+    def push(self, timestamp, price):
+        while self.lows and self.lows[-1][1] >= price:
+            self.lows.pop()
+        self.lows.append((timestamp, price))
+        while self.highs and self.highs[-1][1] <= price:
+            self.highs.pop()
+        self.highs.append((timestamp, price))
+
+        cutoff = timestamp - self.seconds
+        while self.lows[0][0] < cutoff:
+            self.lows.popleft()
+        while self.highs[0][0] < cutoff:
+            self.highs.popleft()
+
+    # Smallest move a batch of merged ticks, lowest `low` and highest `high`,
+    # is sure to have made whatever their order: a rise to high from the
+    # window's low before the batch, a fall to low from its high, or the
+    # distance between low and high one way or the other
+    def burst_move(self, timestamp, low, high):
+        cutoff = timestamp - self.seconds
+        before_low = next((price for at, price in self.lows if at >= cutoff), high)
+        before_high = next((price for at, price in self.highs if at >= cutoff), low)
+        rise = (high / before_low - 1) * 100 if before_low > 0 else 0.0
+        fall = (1 - low / before_high) * 100 if before_high > 0 else 0.0
+        within = (1 - low / high) * 100 if high > 0 else 0.0
+        return max(rise, fall, within)
+
+    # Percent the price is above the window's low or below its high,
+    # whichever is larger
+    def move(self, price):
+        low, high = self.lows[0][1], self.highs[0][1]
+        rise = (price / low - 1) * 100 if low > 0 else 0.0
+        fall = (1 - price / high) * 100 if high > 0 else 0.0
+        return max(rise, fall)
+
+
+# Percent-move alerts, grouped per symbol by window length. `backfill(symbol,
+# seconds)` returns (timestamps, prices) of at least the last `seconds` of
+# ticks and seeds a window when its first alert is added, so a new alert sees
+# the moves that already happened within its window. Older ticks it returns
+# are dropped by the next tick.
+class MoveIndex:
+    def __init__(self, backfill=None):
+        self.backfill = backfill
+        # symbol -> window seconds -> _MoveWindow
+        self.windows = {}
+
+    def __len__(self):
+        return sum(len(window.ids) for windows in self.windows.values() for window in windows.values())
+
+    def rebuild(self, alerts):
+        self.windows = {}
+        for alert in alerts:
+            self.add(alert)
+
+    def add(self, alert):
+        windows = self.windows.setdefault(alert.symbol, {})
+        window = windows.get(alert.window)
+        if window is None:
+            window = windows[alert.window] = _MoveWindow(alert.window)
+            if self.backfill is not None:
+                for timestamp, price in zip(*self.backfill(alert.symbol, alert.window)):
+                    window.push(float(timestamp), float(price))
+        i = bisect.bisect_right(window.percents, alert.percent)
+        window.percents.insert(i, alert.percent)
+        window.ids.insert(i, alert.id)
+
+    def remove(self, alert):
+        windows = self.windows.get(alert.symbol, {})
+        window = windows.get(alert.window)
+        if window is None:
+            return False
+
+        i = bisect.bisect_left(window.percents, alert.percent)
+        while i < len(window.percents) and window.percents[i] == alert.percent:
+            if window.ids[i] == alert.id:
+                del window.percents[i]
+                del window.ids[i]
+                self._drop_if_empty(alert.symbol, window)
+                return True
+            i += 1
+        return False
+
+    def _drop_if_empty(self, symbol, window):
+        if not window.ids:
+            del self.windows[symbol][window.seconds]
+            if not self.windows[symbol]:
+                del self.windows[symbol]
+
+    # Feed a tick to every window of the symbol; remove and return the ids of
+    # the alerts whose percent the move has reached. low and high are the
+    # extremes of ticks merged into this one, if any.
+    def update(self, symbol, price, timestamp, low=None, high=None):
+        burst = low is not None and high is not None and (low < price or high > price)
+        fired = []
+        for window in list(self.windows.get(symbol, {}).values()):
+            move = 0.0
+            if burst:
+                move = window.burst_move(timestamp, low, high)
+                window.push(timestamp, low)
+                window.push(timestamp, high)
+            window.push(timestamp, price)
+            hi = bisect.bisect_right(window.percents, max(move, window.move(price)))
+            if hi:
+                fired.extend(window.ids[:hi].tolist())
+                del window.percents[:hi]
+                del window.ids[:hi]
+                self._drop_if_empty(symbol, window)
+        return fired
+
+
+# Trailing-stop alerts. Each alert trails the highest price since it was
+# created, so alerts created at different times have different peaks, but a
+# new high lifts all of them to the same peak. The alerts of a symbol are
+# kept in groups sharing a peak, stacked oldest first with strictly
+# decreasing peaks: a rising price merges the groups at the top of the stack
+# into one, and a tick only compares the smallest percent of each group.
+class TrailingIndex:
+    def __init__(self, backfill=None):
+        self.backfill = backfill
+        # symbol -> list of [peak, sorted percents, ids] groups
+        self.stacks = {}
+
+    def __len__(self):
+        return sum(len(group[2]) for stack in self.stacks.values() for group in stack)
+
+    # Rebuild from stored alerts, recovering each peak from the tick history
+    # since the alert was created
+    def rebuild(self, alerts, now=None):
+        self.stacks = {}
+        for alert in sorted(alerts, key=lambda alert: alert.created_at):
+            peak = alert.target_price
+            if self.backfill is not None:
+                seconds = (time.time() if now is None else now) - alert.created_at
+                timestamps, prices = self.backfill(alert.symbol, max(seconds, 0.0))
+                prices = prices[timestamps >= alert.created_at]
+                if len(prices):
+                    peak = max(peak, float(prices.max()))
+            self.add(alert, peak)
+
+    def add(self, alert, peak=None):
+        peak = alert.target_price if peak is None else peak
+        stack = self.stacks.setdefault(alert.symbol, [])
+        self._lift(stack, peak)
+        if not stack or stack[-1][0] != peak:
+            stack.append([peak, [], []])
+        percents, ids = stack[-1][1], stack[-1][2]
+        i = bisect.bisect_right(percents, alert.percent)
+        percents.insert(i, alert.percent)
+        ids.insert(i, alert.id)
+
+    def remove(self, alert):
+        stack = self.stacks.get(alert.symbol, [])
+        for n, (_, percents, ids) in enumerate(stack):
+            if alert.id in ids:
+                i = ids.index(alert.id)
+                del percents[i]
+                del ids[i]
+                if not ids:
+                    del stack[n]
+                    if not stack:
+                        del self.stacks[alert.symbol]
+                return True
+        return False
+
+    # Merge every group whose peak is at or below `price` into one group
+    # peaking at `price`
+    @staticmethod
+    def _lift(stack, price):
+        merged = None
+        while stack and stack[-1][0] <= price:
+            _, percents, ids = stack.pop()
+            if merged is None:
+                merged = list(zip(percents, ids))
+            else:
+                merged = list(heapq.merge(merged, zip(percents, ids)))
+        if merged is not None:
+            stack.append([price, [percent for percent, _ in merged], [alert_id for _, alert_id in merged]])
+
+    # Feed a tick; remove and return the ids of the alerts whose stop it hit.
+    # low and high are the extremes of ticks merged into this one, if any: the
+    # low is compared with the peaks from before them and the high becomes a
+    # peak. A high followed by a lower low within the merged ticks cannot be
+    # told apart from the reverse and is not taken as a fall.
+    def update(self, symbol, price, low=None, high=None):
+        stack = self.stacks.get(symbol)
+        if not stack:
+            return []
+
+        fired = []
+        if low is not None and low < price:
+            fired = self._hit(stack, low)
+        if high is not None and high > price:
+            self._lift(stack, high)
+        self._lift(stack, price)
+        fired += self._hit(stack, price)
+        if not stack:
+            del self.stacks[symbol]
+        return fired
+
+    # Remove and return the ids of the alerts of a stack whose stop `price` is
+    # at or below, dropping groups left empty
+    @staticmethod
+    def _hit(stack, price):
+        fired = []
+        for group in stack:
+            peak, percents, ids = group
+            drop = (1 - price / peak) * 100 if peak > 0 else 0.0
+            hi = bisect.bisect_right(percents, drop)
+            if hi:
+                fired.extend(ids[:hi])
+                del percents[:hi]
+                del ids[:hi]
+        if fired:
+            stack[:] = [group for group in stack if group[2]]
+        return fired
+
+
+# Every alert by id and by user, plus the index used to evaluate prices
+# (an AlertIndex, or anything offering the same add/remove/rebuild methods)
+# for price-crossing alerts. Percent-move and trailing alerts always live in
+# a MoveIndex and a TrailingIndex of the book itself.
+#
+# The book has a single owner: only the thread that created it (the event
+# loop's) may change it, and each change completes without yielding, so the
+# evaluator and handlers always see it in a consistent state. Other threads
+# hand their changes to the loop (see ShardPool). A user's alerts are kept as
+# an immutable tuple that every change replaces, so a handler can hold the
+# tuple from for_user across awaits as a snapshot while alerts trigger.
+#
+# A new price-crossing alert waits outside the index until the next price of
+# its symbol (see release), so that it is never compared with a price from
+# before it existed.
+class AlertBook:
+    def __init__(self, index=None, backfill=None):
+        # alert id -> Alert
+        self.alerts = {}
+        # user id -> tuple of the user's alerts, oldest first
+        self.by_user = {}
+        self.index = AlertIndex() if index is None else index
+        # symbol -> [(alert, price it was set against or None)] for crossing
+        # alerts that have not seen a price of their symbol yet
+        self.pending = {}
+        self.moves = MoveIndex(backfill)
+        self.trailing = TrailingIndex(backfill)
+        self._owner = threading.get_ident()
+
+    def _check_owner(self):
+        if threading.get_ident() != self._owner:
+            raise RuntimeError("AlertBook changed outside its owner thread")
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def __iter__(self):
+        return iter(self.alerts.values())
+
+    def get(self, alert_id):
+        return self.alerts.get(alert_id)
+
+    # Replace the contents with `alerts` (used at startup). index_columns are
+    # saved price-crossing index columns to use when they still match; the
+    # crossing alerts missing from them had not seen a price when they were
+    # saved and are pending again.
+    def load(self, alerts, index_columns=None):
+        self._check_owner()
+        self.alerts = {}
+        self.pending = {}
+        by_user = {}
+        for alert in alerts:
+            self.alerts[alert.id] = alert
+            by_user.setdefault(alert.user_id, []).append(alert)
+        self.by_user = {user_id: tuple(user_alerts) for user_id, user_alerts in by_user.items()}
+        crossing = [alert for alert in self.alerts.values() if alert.kind == "cross"]
+        if index_columns is not None:
+            saved = set()
+            for _, saved_ids in index_columns.values():
+                saved.update(array('q', saved_ids))
+            for alert in crossing:
+                if alert.id not in saved:
+                    self.pending.setdefault(alert.symbol, []).append((alert, None))
+            crossing = [alert for alert in crossing if alert.id in saved]
+        if index_columns is None or not self.index.restore(crossing, index_columns):
+            self.index.rebuild(crossing)
+        self.moves.rebuild([alert for alert in self.alerts.values() if alert.kind == "move"])
+        self.trailing.rebuild([alert for alert in self.alerts.values() if alert.kind == "trailing"])
+
+    def _index_for(self, alert):
+        if alert.kind == "move":
+            return self.moves
+        if alert.kind == "trailing":
+            return self.trailing
+        return self.index
+
+    # reference_price is the price a crossing alert was set against, if known
+    def add(self, alert, reference_price=None):
+        self._check_owner()
+        self.alerts[alert.id] = alert
+        self.by_user[alert.user_id] = self.by_user.get(alert.user_id, ()) + (alert,)
+        if alert.kind == "cross":
+            self.pending.setdefault(alert.symbol, []).append((alert, reference_price))
+        else:
+            self._index_for(alert).add(alert)
+
+    # Remove an alert by id; returns it, or None if it no longer exists
+    def remove(self, alert_id):
+        self._check_owner()
+        alert = self.alerts.pop(alert_id, None)
+        if alert is not None:
+            self._unlink_user(alert)
+            pending = self.pending.get(alert.symbol, ())
+            for i, (waiting, _) in enumerate(pending):
+                if waiting is alert:
+                    del pending[i]
+                    break
+            else:
+                self._index_for(alert).remove(alert)
+        return alert
+
+    # Move the symbol's pending crossing alerts into the index after `price`
+    # has been evaluated. Removes and returns those whose target lies between
+    # the price they were set against and `price`.
+    def release(self, symbol, price):
+        self._check_owner()
+        pending = self.pending.pop(symbol, None)
+        if not pending:
+            return []
+
+        crossed = []
+        for alert, reference_price in pending:
+            if reference_price is not None and min(reference_price, price) <= alert.target_price <= max(reference_price, price):
+                crossed.append(alert.id)
+            else:
+                self.index.add(alert)
+        return self._pop(crossed)
+
+    # Price-crossing alerts that are in the index, i.e. not pending
+    def indexed(self):
+        pending = {alert.id for waiting in self.pending.values() for alert, _ in waiting}
+        return [alert for alert in self.alerts.values() if alert.kind == "cross" and alert.id not in pending]
+
+    # A user's alerts as a tuple, optionally only those for one symbol
+    def for_user(self, user_id, symbol=None):
+        alerts = self.by_user.get(int(user_id), ())
+        if symbol is None:
+            return alerts
+        return tuple(alert for alert in alerts if alert.symbol == symbol)
+
+    # Remove and return the alerts crossed between two prices
+    def pop_crossed(self, symbol, previous_price, current_price):
+        self._check_owner()
+        return self._pop(self.index.pop_crossed(symbol, previous_price, current_price))
+
+    # Feed a tick to the percent-move and trailing alerts; remove and return
+    # the ones it fired
+    def pop_moved(self, symbol, price, timestamp, low=None, high=None):
+        self._check_owner()
+        return self._pop(
+            self.moves.update(symbol, price, timestamp, low, high) + self.trailing.update(symbol, price, low, high)
+        )
+
+    def _pop(self, alert_ids):
+        popped = []
+        for alert_id in alert_ids:
+            alert = self.alerts.pop(alert_id)
+            self._unlink_user(alert)
+            popped.append(alert)
+        return popped
+
+    def _unlink_user(self, alert):
+        alerts = tuple(existing for existing in self.by_user[alert.user_id] if existing is not alert)
+        if alerts:
+            self.by_user[alert.user_id] = alerts
+        else:
+            del self.by_user[alert.user_id]
+
+
+# Group alerts into the user_alerts.json layout: user id -> symbol -> list
+def alerts_to_json(alerts):
+    data = {}
+    for alert in alerts:
+        data.setdefault(str(alert.user_id), {}).setdefault(alert.symbol, []).append(alert.to_dict())
+    return data
+
+
+# Read the user_alerts.json layout back into alerts
+def alerts_from_json(data):
+    return [
+        Alert.from_dict(user_id, symbol, alert)
+        for user_id, user_data in data.items()
+        for symbol, alerts in user_data.items()
+        for alert in alerts
+    ]
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import numpy as np
+from harness import quiet_bot_logs, use_scratch_dir
+
+# Offline replay and backtest of the alert engine. A long tick series is fed
+# through the bot's own evaluation path (bot.evaluate_price, the alert
+# indexes and trigger_alerts) as fast as it will go, then every sampled
+# alert is checked against a direct NumPy evaluation of the same series: it
+# must fire on exactly the tick the reference says, or not at all.
+#
+# Ticks come from the seeded PriceSimulator, or from a recorded file: .npz as
+# written by --save, or the .csv/.jsonl formats ReplaySource reads (in time
+# order). Notifications are recorded instead of sent.
+#
+# With --shards N the price-crossing alerts are evaluated by N shard
+# processes, as with SHARDS=N in the bot, and checked against the same
+# reference. Each tick then waits for every shard to answer, so this mode
+# tests correctness rather than speed.
+#
+#   python backtest.py --ticks 1000000 --users 2000 --seed 7
+#   python backtest.py --ticks 20000 --users 200 --shards 4
+#   python backtest.py --ticks 200000 --save ticks.npz
+#   python backtest.py --input ticks.npz --verify 0
+
+WORKDIR = use_scratch_dir("signal-backtest-", "backtest.db", SHARDS="1", CHARTS="0")
+
+KINDS = ("cross", "move", "trailing")
+MOVE_PERCENTS = (0.5, 1, 2, 3, 5)
+TRAILING_PERCENTS = (1, 2, 3, 5, 10)
+
+
+# Generated ticks as flat arrays of (timestamp, symbol column, price), every
+# symbol ticking at each step
+def generate_ticks(bot, steps, interval, seed):
+    from simulator import PriceSimulator
+
+    simulator = PriceSimulator(seed)
+    for symbol, config in bot.SYMBOLS.items():
+        simulator.add_symbol(symbol, config["providers"].get("simulator") or {"start": config["default_price"]})
+    timestamps, prices = simulator.ticks(steps, start=time.time(), interval=interval)
+    return simulator.symbols, timestamps, prices
+
+
+def flatten(timestamps, prices):
+    steps, columns = prices.shape
+    return np.repeat(timestamps, columns), np.tile(np.arange(columns), steps), prices.ravel()
+
+
+# Recorded ticks as flat arrays
+def read_ticks(path):
+    if path.endswith(".npz"):
+        from simulator import load_ticks
+
+        timestamps, symbols, prices = load_ticks(path)
+        return (symbols, *flatten(timestamps, prices))
+
+    from stream import ReplaySource
+
+    symbols, timestamps, columns, prices = [], [], [], []
+    for timestamp, symbol, price in ReplaySource(path).ticks():
+        if symbol not in symbols:
+            symbols.append(symbol)
+        timestamps.append(timestamp)
+        columns.append(symbols.index(symbol))
+        prices.append(price)
+    return symbols, np.array(timestamps), np.array(columns), np.array(prices)
+
+
+# When and which alerts to create: event index -> [(user id, symbol, kind,
+# parameters)], where index -1 is before the first tick and a `stagger`
+# fraction of the alerts is created at random points of the replay instead.
+# kinds are handed out in turn.
+def plan_alerts(bot, symbols, users, per_symbol, kinds, spread, stagger, events, rng):
+    plan = {}
+    for i in range(users):
+        user_id = str(1_000_000 + i)
+        for symbol in symbols:
+            for n in range(per_symbol):
+                kind = kinds[(i + n) % len(kinds)]
+                if kind == "move":
+                    parameters = (rng.choice(MOVE_PERCENTS), rng.choice(list(bot.MOVE_WINDOWS.values())))
+                elif kind == "trailing":
+                    parameters = rng.choice(TRAILING_PERCENTS)
+                else:
+                    parameters = rng.uniform(-spread, spread)
+                at = rng.randrange(events) if events and rng.random() < stagger else -1
+                plan.setdefault(at, []).append((user_id, symbol, kind, parameters))
+    return plan
+
+
+# Create a planned alert through bot.add_alert, relative to the symbol's
+# current price, which a crossing alert is also set against
+def create_alert(bot, user_id, symbol, kind, parameters, price):
+    if kind == "move":
+        percent, window = parameters
+        return bot.add_alert(user_id, symbol, price, "move", percent=percent, window=window)
+    if kind == "trailing":
+        return bot.add_alert(user_id, symbol, price, "trailing", percent=parameters)
+    return bot.add_alert(user_id, symbol, round(price * (1 + parameters), 2), reference_price=price)
+
+
+# op (np.minimum or np.maximum) over prices[starts[i]:i + 1] for every i, in
+# O(n log window) time and O(n) memory: table holds op over the 2**level
+# prices ending at each index, and each window is covered by two such spans
+def rolling(prices, starts, op):
+    lengths = np.arange(len(prices)) - starts + 1
+    levels = np.log2(lengths).astype(np.int64)
+    result = np.empty_like(prices)
+    table = prices.copy()
+    for level in range(int(levels.max()) + 1 if len(prices) else 0):
+        span = 1 << level
+        if level:
+            half = span >> 1
+            table[half:] = op(table[half:], table[:-half])
+        picked = np.flatnonzero(levels == level)
+        result[picked] = op(table[picked], table[starts[picked] + span - 1])
+    return result
+
+
+def first_index(mask, offset=0):
+    return int(np.argmax(mask)) + offset if mask.any() else None
+
+
+# Reference evaluation of one symbol's series: the index of the tick an
+# alert created just before tick `start` should fire on, computed with the
+# same arithmetic as the indexes
+class Reference:
+    def __init__(self, timestamps, prices):
+        self.timestamps = timestamps
+        self.prices = prices
+        self.low = np.minimum(prices[:-1], prices[1:])
+        self.high = np.maximum(prices[:-1], prices[1:])
+        self.moves = {}
+
+    def fires_at(self, alert, start):
+        if alert.kind == "move":
+            # The window reaches back before the alert was created
+            return first_index(alert.percent <= self.move(alert.window)[start:], start)
+        if alert.kind == "trailing":
+            prices = self.prices[start:]
+            peaks = np.maximum.accumulate(np.maximum(prices, alert.target_price))
+            return first_index(alert.percent <= (1 - prices / peaks) * 100, start)
+        # Crossing alerts compare each tick with the previous one
+        first = max(start, 1)
+        target = alert.target_price
+        return first_index((self.low[first - 1:] <= target) & (target <= self.high[first - 1:]), first)
+
+    def move(self, window):
+        move = self.moves.get(window)
+        if move is None:
+            starts = np.searchsorted(self.timestamps, self.timestamps - window, side='left')
+            low = rolling(self.prices, starts, np.minimum)
+            high = rolling(self.prices, starts, np.maximum)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rise = np.where(low > 0, (self.prices / low - 1) * 100, 0.0)
+                fall = np.where(high > 0, (1 - self.prices / high) * 100, 0.0)
+            move = self.moves[window] = np.maximum(rise, fall)
+        return move
+
+
+def run(args):
+    # The tick history keeps every tick, so the windows of move alerts created
+    # during the replay are backfilled completely
+    if args.input:
+        symbols, timestamps, columns, prices = read_ticks(args.input)
+        os.environ["HISTORY_CAPACITY"] = str(len(timestamps) + 1)
+    else:
+        os.environ["HISTORY_CAPACITY"] = str(args.ticks + 1)
+    os.environ["SHARDS"] = str(args.shards)
+    import bot
+
+    rng = random.Random(args.seed)
+    if not args.input:
+        symbols, steps_timestamps, steps_prices = generate_ticks(bot, args.ticks, args.interval, args.seed)
+        if args.save:
+            from simulator import save_ticks
+
+            save_ticks(args.save, steps_timestamps, symbols, steps_prices)
+        timestamps, columns, prices = flatten(steps_timestamps, steps_prices)
+
+    series = {
+        symbol: (timestamps[columns == column], prices[columns == column])
+        for column, symbol in enumerate(symbols)
+    }
+    first_prices = {symbol: float(symbol_prices[0]) for symbol, (_, symbol_prices) in series.items() if len(symbol_prices)}
+    kinds = [kind for kind in args.kinds.split(",") if kind in KINDS]
+    plan = plan_alerts(bot, list(first_prices), args.users, args.alerts, kinds, args.spread, args.stagger, len(timestamps), rng)
+
+    # Position of the latest tick within its symbol's series, its price, the
+    # position of the first tick each alert saw, and the one it fired at
+    positions = [-1] * len(symbols)
+    last_prices = [first_prices.get(symbol) for symbol in symbols]
+    column_of = {symbol: column for column, symbol in enumerate(symbols)}
+    alerts, created, fired = [], {}, {}
+
+    def create(specs):
+        for user_id, symbol, kind, parameters in specs:
+            column = column_of[symbol]
+            alert = create_alert(bot, user_id, symbol, kind, parameters, last_prices[column])
+            alerts.append(alert)
+            created[alert.id] = positions[column] + 1
+
+    def record(alert, current_price):
+        fired[alert.id] = positions[column_of[alert.symbol]]
+
+    bot.send_alert_notification = record
+    create(plan.pop(-1, []))
+
+    # Shards answer asynchronously: wait for their triggers after every tick
+    # so that each is recorded at the tick that caused it
+    async def replay():
+        sharded = args.shards > 1
+        if sharded:
+            await asyncio.to_thread(bot.alert_index.start, asyncio.get_running_loop())
+        evaluate = bot.evaluate_price
+        started = time.perf_counter()
+        try:
+            for n, (timestamp, column, price) in enumerate(zip(timestamps.tolist(), columns.tolist(), prices.tolist())):
+                if n in plan:
+                    create(plan.pop(n))
+                positions[column] += 1
+                last_prices[column] = price
+                evaluate(symbols[column], price, timestamp=timestamp)
+                if sharded:
+                    await bot.alert_index.flush()
+            return time.perf_counter() - started
+        finally:
+            if sharded:
+                await asyncio.to_thread(bot.alert_index.stop)
+
+    elapsed = asyncio.run(replay())
+
+    simulated = float(timestamps[-1] - timestamps[0]) if len(timestamps) else 0.0
+    report = {
+        "benchmark": "signal-backtest",
+        "params": vars(args),
+        "symbols": symbols,
+        "ticks": len(timestamps),
+        "alerts": {kind: sum(alert.kind == kind for alert in alerts) for kind in KINDS},
+        "triggered": {kind: sum(alert.kind == kind and alert.id in fired for alert in alerts) for kind in KINDS},
+        "seconds": elapsed,
+        "ticks_per_sec": len(timestamps) / elapsed if elapsed else None,
+        "simulated_seconds": simulated,
+        "speedup": simulated / elapsed if elapsed else None
+    }
+
+    sample = alerts if not args.verify else rng.sample(alerts, min(args.verify, len(alerts)))
+    references = {symbol: Reference(*series[symbol]) for symbol in first_prices}
+    mismatches = []
+    t = time.perf_counter()
+    for alert in sample:
+        expected = references[alert.symbol].fires_at(alert, created[alert.id])
+        if fired.get(alert.id) != expected:
+            mismatches.append({
+                "id": alert.id, "kind": alert.kind, "symbol": alert.symbol,
+                "expected_tick": expected, "fired_tick": fired.get(alert.id)
+            })
+    report["verification"] = {
+        "checked": len(sample),
+        "mismatches": len(mismatches),
+        "examples": mismatches[:10],
+        "seconds": time.perf_counter() - t
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay ticks through the alert engine and verify every trigger")
+    parser.add_argument("--input", help="recorded ticks (.npz, .csv or .jsonl) instead of generated ones")
+    parser.add_argument("--ticks", type=int, default=100_000, help="generated steps, each a tick for every symbol")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between generated steps")
+    parser.add_argument("--save", help="also write the generated ticks to this .npz file")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--alerts", type=int, default=3, help="alerts per symbol per user")
+    parser.add_argument("--kinds", default="cross,move,trailing", help="alert types to create, in turn")
+    parser.add_argument("--spread", type=float, default=0.05, help="crossing targets within +-spread of the current price")
+    parser.add_argument("--stagger", type=float, default=0.5, help="fraction of alerts created during the replay")
+    parser.add_argument("--verify", type=int, default=500, help="alerts to check against the reference (0 for all)")
+    parser.add_argument("--shards", type=int, default=1, help="evaluate price-crossing alerts in this many shard processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    quiet_bot_logs()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(1 if report["verification"]["mismatches"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+from harness import quiet_bot_logs, use_scratch_dir
+
+# Synthetic-load benchmarks for the alert engine and persistence paths.
+# Everything runs offline: prices come from a synthetic provider and
+# Telegram calls go to a fake bot that only counts them. Results are printed
+# (or written with --output) as JSON. Latencies are taken with tracemalloc
+# running, so compare them between runs of this script rather than with
+# production timings.
+#
+#   python benchmark.py --users 10000 --alerts 3 --ticks 50 --output bench.json
+
+WORKDIR = use_scratch_dir("signal-bench-", "bench.db")
+
+
+# Telegram stand-in that accepts every call and counts it
+class FakeBot:
+    def __init__(self):
+        self.calls = 0
+
+    async def _call(self, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="bench")])
+
+    send_message = _call
+    send_photo = _call
+
+
+class FakeMessage:
+    def __init__(self, bot, text=""):
+        self.bot = bot
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(text=text, **kwargs)
+
+    async def reply_photo(self, **kwargs):
+        return await self.bot.send_photo(**kwargs)
+
+
+def fake_update(bot, user_id, text=""):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=int(user_id), first_name="Bench"),
+        message=FakeMessage(bot, text)
+    )
+
+
+# Offline random walk standing in for every real provider
+class SyntheticProvider:
+    name = "synthetic"
+
+    def __init__(self, start_prices, volatility, seed):
+        self.prices = dict(start_prices)
+        self.volatility = volatility
+        self.random = random.Random(seed)
+
+    def step(self):
+        for symbol, price in self.prices.items():
+            self.prices[symbol] = price * (1 + self.random.gauss(0, self.volatility))
+
+    async def fetch_many(self, symbols):
+        return {symbol: self.prices[symbol] for symbol in symbols if symbol in self.prices}
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": pick(0.50) * 1000,
+        "p90_ms": pick(0.90) * 1000,
+        "p99_ms": pick(0.99) * 1000,
+        "max_ms": ordered[-1] * 1000
+    }
+
+
+# Run `fn` (sync or async) `repeat` times, recording latency and peak traced memory
+async def measure(fn, repeat):
+    samples = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "latency": percentiles(samples),
+        "ops_per_sec": repeat / elapsed if elapsed else None,
+        "peak_memory_bytes": peak
+    }
+
+
+# Memory held by the same alerts in the nested-dict layout (user_alerts plus
+# an index of (user_id, alert) tuples) and in the AlertBook
+def memory_layouts(bot, users, alerts_per_symbol, spread, seed):
+    from alerts import Alert, AlertBook
+
+    def build_dicts():
+        rng = random.Random(seed)
+        user_alerts, targets, entries = {}, {}, {}
+        alert_id = 0
+        for i in range(users):
+            user_id = str(1_000_000 + i)
+            for symbol, config in bot.SYMBOLS.items():
+                for _ in range(alerts_per_symbol):
+                    alert_id += 1
+                    alert = {
+                        "id": alert_id,
+                        "target_price": round(config["default_price"] * (1 + rng.uniform(-spread, spread)), 2),
+                        "created_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+                        "last_price": None
+                    }
+                    user_alerts.setdefault(user_id, {}).setdefault(symbol, []).append(alert)
+                    targets.setdefault(symbol, []).append(alert["target_price"])
+                    entries.setdefault(symbol, []).append((user_id, alert))
+        return user_alerts, targets, entries
+
+    def build_book():
+        rng = random.Random(seed)
+        alerts = []
+        for i in range(users):
+            for symbol, config in bot.SYMBOLS.items():
+                for _ in range(alerts_per_symbol):
+                    alerts.append(Alert(
+                        len(alerts) + 1, 1_000_000 + i, symbol,
+                        round(config["default_price"] * (1 + rng.uniform(-spread, spread)), 2), time.time()
+                    ))
+        book = AlertBook()
+        book.load(alerts)
+        return book
+
+    results = {}
+    for name, build in (("dicts", build_dicts), ("alert_book", build_book)):
+        tracemalloc.start()
+        layout = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del layout
+        count = users * alerts_per_symbol * len(bot.SYMBOLS)
+        results[name] = {"alerts": count, "bytes": size, "bytes_per_alert": size / count if count else None}
+    return results
+
+
+def populate(bot, users, alerts_per_symbol, spread, rng):
+    for i in range(users):
+        user_id = str(1_000_000 + i)
+        for symbol, config in bot.SYMBOLS.items():
+            start = config["default_price"]
+            for _ in range(alerts_per_symbol):
+                bot.add_alert(user_id, symbol, round(start * (1 + rng.uniform(-spread, spread)), 2))
+            bot.initial_prices.setdefault(user_id, {})[symbol] = start
+            bot.persistence.initial_price_set(user_id, symbol, start)
+
+
+async def run(args):
+    import bot
+
+    rng = random.Random(args.seed)
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, user_data={})
+
+    provider = SyntheticProvider(
+        {symbol: config["default_price"] for symbol, config in bot.SYMBOLS.items()},
+        args.volatility, args.seed
+    )
+    for symbol in bot.SYMBOLS:
+        bot.price_providers.routes[symbol] = [provider]
+
+    results = {
+        "benchmark": "signal-bot",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "results": {}
+    }
+
+    results["results"]["memory"] = memory_layouts(bot, args.users, args.alerts, args.spread, args.seed)
+
+    t = time.perf_counter()
+    populate(bot, args.users, args.alerts, args.spread, rng)
+    total_alerts = len(bot.alert_index)
+    results["results"]["populate"] = {
+        "alerts": total_alerts,
+        "seconds": time.perf_counter() - t
+    }
+
+    # Persistence: the first SQLite flush writes every alert created above; a
+    # JSON flush always rewrites the whole snapshot
+    json_store = bot.JsonStore(os.path.join(WORKDIR, "bench_alerts.json"), os.path.join(WORKDIR, "bench_prices.json"))
+    json_store.alerts, json_store.initial_prices = dict(bot.alert_book.alerts), bot.initial_prices
+    writers = {"sqlite": bot.persistence, "json": bot.WriteBehind(json_store)}
+    writers["json"].initial_price_set("0", "BTCUSD", 0.0)
+
+    for backend, writer in writers.items():
+        results["results"][f"persist_full_{backend}"] = await measure(writer.flush, 1)
+
+        # Small incremental flushes, as in normal operation
+        def touch():
+            user_id = str(1_000_000 + rng.randrange(args.users))
+            writer.initial_price_set(user_id, "BTCUSD", rng.random())
+            return writer.flush()
+
+        results["results"][f"persist_incremental_{backend}"] = await measure(touch, args.repeat)
+
+    # Read paths for a random sample of users
+    sample = [str(1_000_000 + rng.randrange(args.users)) for _ in range(args.repeat)]
+    iterator = iter(sample)
+    results["results"]["get_delete_keyboard"] = await measure(
+        lambda: bot.get_delete_keyboard(next(iterator)), args.repeat
+    )
+    iterator = iter(sample)
+    results["results"]["show_user_alerts"] = await measure(
+        lambda: bot.show_user_alerts(fake_update(fake_bot, next(iterator)), context), args.repeat
+    )
+
+    # Alert evaluation: one check_alerts cycle per synthetic tick
+    bot.notifier.global_bucket.rate = bot.notifier.global_bucket.capacity = 1e9
+    bot.notifier.chat_rate = bot.notifier.chat_burst = 1e9
+    bot.notifier.start(fake_bot)
+    await bot.check_alerts(context)  # establishes the previous prices
+
+    def tick():
+        provider.step()
+        return bot.check_alerts(context)
+
+    remaining = len(bot.alert_index)
+    calls = fake_bot.calls
+    cycle = await measure(tick, args.ticks)
+    triggered = remaining - len(bot.alert_index)
+    cycle["alerts_triggered"] = triggered
+    cycle["alerts_per_sec"] = total_alerts * cycle["ops_per_sec"]
+    results["results"]["check_alerts"] = cycle
+
+    t = time.perf_counter()
+    await bot.notifier.stop(timeout=600)
+    results["results"]["notifications"] = {
+        "queued_notifications": triggered,
+        "telegram_calls": fake_bot.calls - calls,
+        "drain_seconds": time.perf_counter() - t
+    }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic-load benchmark for the alert engine")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--alerts", type=int, default=3, help="alerts per symbol per user")
+    parser.add_argument("--ticks", type=int, default=50, help="check_alerts cycles to run")
+    parser.add_argument("--repeat", type=int, default=200, help="samples for the per-call benchmarks")
+    parser.add_argument("--spread", type=float, default=0.05, help="targets within +-spread of the start price")
+    parser.add_argument("--volatility", type=float, default=0.002, help="stddev of each synthetic price step")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    quiet_bot_logs()
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
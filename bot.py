@@ -1,12 +1,31 @@
-import json
+import asyncio
 import os
 import logging
-import random
+import time
+from collections import OrderedDict
 from datetime import datetime
-import requests
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters,
+    ContextTypes, ConversationHandler
+)
 from dotenv import load_dotenv
+from admission import ADMIT, COALESCE, SHED, AdmissionControl
+from alerts import AlertBook, AlertIndex, make_alert
+from charts import ChartRenderer
+from history import TickHistory
+from media import MediaCache, missing_images
+from metrics import Counter, Gauge, Histogram, serve_metrics
+from notifier import InstrumentedRequest, NotificationDispatcher
+from sharding import ShardPool
+from snapshot import Snapshot, load_snapshot, save_snapshot
+from stream import BinanceTradeSource, PollingSource, ReplaySource, TickPipeline
+from storage import JsonStore, SQLiteStore, WriteBehind
+from updates import PerUserUpdateProcessor
+from prices import (
+    CoinGeckoProvider, ExchangeRateProvider, MetalsApiProvider, PriceCache, PriceFetcher,
+    PriceProviderRegistry, SimulatedProvider
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,102 +33,407 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO level
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# An API key from the environment; the placeholders of the sample .env
+# ("your_..._api_key") count as no key
+def api_key_from_env(name):
+    value = os.getenv(name, "")
+    return "" if value.startswith("your_") else value
 
 # Get environment variables
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-COINGECKO_API_KEY = os.getenv("COINGECKO_API_KEY", "")
-METALS_API_KEY = os.getenv("METALS_API_KEY", "")
-EXCHANGE_RATE_API_KEY = os.getenv("EXCHANGE_RATE_API_KEY", "")
+# Bot API server; set to a local one (e.g. fake_telegram.py) for load tests
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+COINGECKO_API_KEY = api_key_from_env("COINGECKO_API_KEY")
+METALS_API_KEY = api_key_from_env("METALS_API_KEY")
+EXCHANGE_RATE_API_KEY = api_key_from_env("EXCHANGE_RATE_API_KEY")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+METALS_API_URL = os.getenv("METALS_API_URL", "https://metals-api.com/api")
+EXCHANGE_RATE_API_URL = os.getenv("EXCHANGE_RATE_API_URL", "https://v6.exchangerate-api.com/v6")
+
+# Price API settings
+PRICE_TIMEOUT = float(os.getenv("PRICE_TIMEOUT", "5"))
+PRICE_RETRIES = int(os.getenv("PRICE_RETRIES", "3"))
+# Longest Retry-After (seconds) a price request waits out before giving up
+PRICE_MAX_RETRY_AFTER = float(os.getenv("PRICE_MAX_RETRY_AFTER", "30"))
+
+# Price cache settings: how long a price stays fresh (per symbol via
+# PRICE_CACHE_TTL_<SYMBOL>) and how long a stale one may still be served
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "30"))
+PRICE_CACHE_STALE = float(os.getenv("PRICE_CACHE_STALE", "300"))
+
+# Supported symbols. "providers" lists price sources in order of preference;
+# the first one that is configured (has its API key) is used.
+SYMBOLS = {
+    "BTCUSD": {
+        "emoji": "💰",
+        "currency": "$",
+        "buy_image": "img/BTCbuy.jpg",
+        "default_price": 65000.00,
+        "providers": {"coingecko": "bitcoin/usd"},
+        # Live feeds used in streaming mode
+        "streams": {"binance": "btcusdt"}
+    },
+    "XAUUSD": {
+        "emoji": "🥇",
+        "currency": "$",
+        "buy_image": "img/XUAbuy.jpg",
+        "default_price": 3017.64,  # Starting price from screenshot
+        "providers": {
+            "metals": "XAU",
+            # Gold typically has smaller percentage moves
+            "simulator": {"start": 3017.64, "volatility": 0.1, "low": 2990, "high": 3050}
+        }
+    },
+    "GBPJPY": {
+        "emoji": "💱",
+        "currency": "¥",
+        "buy_image": "img/GBPbuy.jpg",
+        "default_price": 195.50,
+        "providers": {
+            "exchangerate": "GBP/JPY",
+            "simulator": {"start": 195.50, "volatility": 0.2, "low": 190, "high": 200}
+        }
+    }
+}
+
+# How prices reach the alert evaluator: "poll" runs check_alerts every
+# CHECK_INTERVAL seconds; "stream" evaluates every tick pushed by the live
+# feeds (polling STREAM_POLL_INTERVAL for symbols without one), or replays
+# PRICE_REPLAY_FILE at PRICE_REPLAY_SPEED times real time when it is set
+PRICE_MODE = os.getenv("PRICE_MODE", "poll")
+CHECK_INTERVAL = float(os.getenv("CHECK_INTERVAL", "60"))
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "5"))
+PRICE_REPLAY_FILE = os.getenv("PRICE_REPLAY_FILE", "")
+PRICE_REPLAY_SPEED = float(os.getenv("PRICE_REPLAY_SPEED", "1"))
+# Seed of the simulated prices; unset gives different prices every run
+PRICE_SEED = int(os.getenv("PRICE_SEED")) if os.getenv("PRICE_SEED") else None
+
+# Per-symbol tick history, kept in memory-mapped files in HISTORY_DIR, the
+# newest HISTORY_CAPACITY ticks per symbol
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_CAPACITY = int(os.getenv("HISTORY_CAPACITY", "100000"))
+
+# Price charts sent by show_price, drawn from the tick history of the last
+# CHART_WINDOW seconds and redrawn at most every CHART_BUCKET seconds by
+# CHART_WORKERS threads; CHARTS=0 sends the static images instead
+CHARTS = os.getenv("CHARTS", "1") == "1"
+CHART_WINDOW = float(os.getenv("CHART_WINDOW", "3600"))
+CHART_BUCKET = float(os.getenv("CHART_BUCKET", "60"))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "256"))
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+
+# Admission control in front of the handlers: each user gets
+# ADMISSION_USER_RATE updates per second (bursts of ADMISSION_USER_BURST),
+# everyone together ADMISSION_GLOBAL_RATE (bursts of ADMISSION_GLOBAL_BURST);
+# repeated price views within ADMISSION_COALESCE_SECONDS get one reply.
+# ADMISSION_CONTROL=0 turns it off.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "1"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "8"))
+ADMISSION_GLOBAL_RATE = float(os.getenv("ADMISSION_GLOBAL_RATE", "30"))
+ADMISSION_GLOBAL_BURST = int(os.getenv("ADMISSION_GLOBAL_BURST", "100"))
+ADMISSION_COALESCE_SECONDS = float(os.getenv("ADMISSION_COALESCE_SECONDS", "3"))
+
+# Local Prometheus endpoint; METRICS_PORT=0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Images show_price and alert notifications can choose from
+IMAGES = ["img/start.jpg", "img/selbuy.jpg"] + [config["buy_image"] for config in SYMBOLS.values()]
+# Telegram file_ids of uploaded images
+MEDIA_CACHE_FILE = os.getenv("MEDIA_CACHE_FILE", "media_cache.json")
+
+# Evaluator state (last prices, price cache, price-crossing index) saved to
+# SNAPSHOT_FILE every SNAPSHOT_INTERVAL seconds and at shutdown, so that a
+# restart resumes where the last run stopped; empty to disable
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "evaluator_state.npz")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))
+
+# Storage backend: "sqlite" (default) or "json" flat files
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+# SQLite database holding alerts and initial prices
+DB_FILE = os.getenv("DB_FILE", "signal.db")
+# JSON files; imported into the database on first start when using SQLite
+ALERTS_FILE = os.getenv("ALERTS_FILE", "user_alerts.json")
+INITIAL_PRICES_FILE = os.getenv("INITIAL_PRICES_FILE", "initial_prices.json")
+
+# Write-behind settings: flush at most every PERSIST_INTERVAL seconds, or
+# sooner after PERSIST_MAX_CHANGES changes
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "2"))
+PERSIST_MAX_CHANGES = int(os.getenv("PERSIST_MAX_CHANGES", "500"))
 
-# File to store user alerts
-ALERTS_FILE = "user_alerts.json"
-# File to store initial prices
-INITIAL_PRICES_FILE = "initial_prices.json"
+# Outbound notification settings: concurrent senders and Telegram rate
+# limits (messages per second overall and per chat)
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "8"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "30"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+
+# How updates arrive: "polling" (default) or "webhook", where a local HTTP
+# listener on WEBHOOK_LISTEN:WEBHOOK_PORT receives them at WEBHOOK_PATH and
+# Telegram is told to deliver them to WEBHOOK_URL (the public address of
+# that listener, without the path)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Updates handled at once; above 1, different users are served concurrently
+# while each user's updates still run one at a time, in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+
+# Alert evaluation processes; above 1, users are split between SHARDS worker
+# processes by user id and this process only fetches prices and sends
+SHARDS = int(os.getenv("SHARDS", "1"))
 
 # Conversation states
 SELECTING_CURRENCY = 1
 ENTERING_PRICE = 2
 DELETING_ALERT = 3
 
-# Initialize alerts storage
-if os.path.exists(ALERTS_FILE):
-    with open(ALERTS_FILE, 'r') as f:
-        user_alerts = json.load(f)
+# Alert types offered after a symbol is chosen; a number typed instead of
+# pressing a button sets a price-level alert
+ALERT_TYPE_BUTTONS = {
+    "🎯 Narx darajasi": "cross",
+    "📊 Foiz harakati": "move",
+    "📉 Trailing stop": "trailing"
+}
+
+# Windows a percent-move alert can watch, in seconds
+MOVE_WINDOWS = {"15m": 900, "1h": 3600, "4h": 14400, "24h": 86400}
+DEFAULT_MOVE_WINDOW = "1h"
+
+# Alerts per page of the inline delete keyboard
+DELETE_PAGE_SIZE = 8
+
+# Telegram's limit on the length of a message, in UTF-16 code units
+MESSAGE_LIMIT = 4096
+# Users whose rendered alert lists are kept
+ALERT_VIEW_CACHE_SIZE = int(os.getenv("ALERT_VIEW_CACHE_SIZE", "10000"))
+
+# Initialize alerts and initial prices storage
+if STORAGE_BACKEND == "json":
+    store = JsonStore(ALERTS_FILE, INITIAL_PRICES_FILE)
 else:
-    user_alerts = {}
+    store = SQLiteStore(DB_FILE)
+store.open()
+store.migrate_from_json(ALERTS_FILE, INITIAL_PRICES_FILE)
+stored_alerts, initial_prices = store.load()
+
+# Changes are recorded here and written to the store in the background
+persistence = WriteBehind(store, interval=PERSIST_INTERVAL, max_changes=PERSIST_MAX_CHANGES)
 
-# Initialize initial prices storage
-if os.path.exists(INITIAL_PRICES_FILE):
-    with open(INITIAL_PRICES_FILE, 'r') as f:
-        initial_prices = json.load(f)
+# Index of alert target prices per symbol, used by check_alerts; in sharded
+# mode the shard processes hold the index and report crossed alerts back to
+# handle_shard_triggers (the alerts are sent to them in post_init, and again
+# from the book to a shard that had to be restarted)
+if SHARDS > 1:
+    alert_index = ShardPool(SHARDS, lambda *args: handle_shard_triggers(*args), lambda: alert_book.indexed())
 else:
-    initial_prices = {}
-
-# Save alerts to file
-def save_alerts():
-    with open(ALERTS_FILE, 'w') as f:
-        json.dump(user_alerts, f)
-
-# Save initial prices to file
-def save_initial_prices():
-    with open(INITIAL_PRICES_FILE, 'w') as f:
-        json.dump(initial_prices, f)
-
-# Last prices for simulation
-last_prices = {
-    "BTCUSD": None,
-    "XAUUSD": 3017.64,  # Starting price from screenshot
-    "GBPJPY": 195.50    # Starting price
-}
+    alert_index = AlertIndex()
+
+# Every price the evaluator sees, for queries over past prices
+tick_history = TickHistory(HISTORY_DIR, HISTORY_CAPACITY)
+
+# Evaluator state saved by the previous run, if any
+snapshot = load_snapshot(SNAPSHOT_FILE)
+
+# All alerts, by id and by user. Percent-move and trailing alerts recover
+# their rolling windows and peaks from the tick history; the price-crossing
+# index is taken from the snapshot when it still matches the stored alerts.
+alert_book = AlertBook(alert_index, backfill=tick_history.recent)
+alert_book.load(stored_alerts, snapshot.index if snapshot is not None else None)
+
+# Resume from the prices the evaluator saw last, so that the first fresh
+# price of each symbol is compared with them and crossings missed while the
+# bot was down fire. Crossing alerts missing from the snapshot's index (added
+# after it, when the previous run crashed) must not be compared with a price
+# from before they existed; the book keeps them pending until that first
+# comparison is done.
+if snapshot is not None:
+    for symbol, price in snapshot.last_prices.items():
+        if symbol in SYMBOLS:
+            alert_index.last_prices[symbol] = price
+    held_back = sum(map(len, alert_book.pending.values()))
+    if held_back:
+        logger.info(f"Holding back {held_back} alerts newer than the evaluator snapshot")
 
-# Get price data from APIs with simulation for more dynamic prices
-async def get_price(symbol):
+# Rendered alert lists for show_user_alerts: user id -> list of
+# (symbol, [(target, line when the price must fall, line when it must rise)])
+alert_views = OrderedDict()
+
+# Create an alert for a user, register it and store it. For percent-move and
+# trailing alerts target_price is the current price and `fields` holds the
+# percent (and window). reference_price is the price a crossing alert was set
+# against (the one shown to the user): the alert fires on the next tick only
+# if the price moved past its target since then.
+def add_alert(user_id, symbol, target_price, kind="cross", reference_price=None, **fields):
+    alert = make_alert(kind, store.next_alert_id(), int(user_id), symbol, target_price, time.time(), **fields)
+    alert_book.add(alert, reference_price)
+    alert_views.pop(alert.user_id, None)
+    persistence.alert_added(alert)
+    return alert
+
+# Remove an alert and delete it from the store
+def remove_alert(alert_id):
+    alert = alert_book.remove(alert_id)
+    if alert is not None:
+        alert_views.pop(alert.user_id, None)
+        persistence.alerts_deleted([alert_id])
+    return alert
+
+# Uploaded images, sent by file_id after the first upload
+media_cache = MediaCache(MEDIA_CACHE_FILE)
+
+# Rendered price charts, shared by every user asking in the same bucket
+if CHARTS and not ChartRenderer.available():
+    logger.warning("Pillow is not installed, sending static images instead of price charts")
+if CHARTS and ChartRenderer.available():
+    chart_renderer = ChartRenderer(
+        tick_history, window_seconds=CHART_WINDOW, bucket_seconds=CHART_BUCKET,
+        cache_size=CHART_CACHE_SIZE, workers=CHART_WORKERS
+    )
+else:
+    chart_renderer = None
+
+# Decides which updates reach the handlers under load
+admission = AdmissionControl(
+    user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST,
+    global_rate=ADMISSION_GLOBAL_RATE, global_burst=ADMISSION_GLOBAL_BURST,
+    coalesce_seconds=ADMISSION_COALESCE_SECONDS
+)
+
+# Queue for outgoing alert notifications
+notifier = NotificationDispatcher(
+    workers=NOTIFY_WORKERS,
+    global_rate=NOTIFY_GLOBAL_RATE,
+    chat_rate=NOTIFY_CHAT_RATE
+)
+
+# Shared pooled HTTP client for price APIs
+price_fetcher = PriceFetcher(timeout=PRICE_TIMEOUT, retries=PRICE_RETRIES, max_retry_after=PRICE_MAX_RETRY_AFTER)
+
+# Price providers; the simulator is always available as a fallback
+price_providers = PriceProviderRegistry()
+price_providers.register(CoinGeckoProvider(price_fetcher, COINGECKO_API_URL, COINGECKO_API_KEY))
+if METALS_API_KEY:
+    price_providers.register(MetalsApiProvider(price_fetcher, METALS_API_KEY, METALS_API_URL))
+if EXCHANGE_RATE_API_KEY:
+    price_providers.register(ExchangeRateProvider(price_fetcher, EXCHANGE_RATE_API_KEY, EXCHANGE_RATE_API_URL))
+price_providers.register(SimulatedProvider(seed=PRICE_SEED))
+
+for symbol, config in SYMBOLS.items():
+    price_providers.route(symbol, config["providers"])
+
+# Shared price snapshots served to every handler
+price_cache = PriceCache(
+    ttl=PRICE_CACHE_TTL,
+    stale_ttl=PRICE_CACHE_STALE,
+    ttls={
+        symbol: float(os.environ[f"PRICE_CACHE_TTL_{symbol}"])
+        for symbol in SYMBOLS
+        if f"PRICE_CACHE_TTL_{symbol}" in os.environ
+    }
+)
+if snapshot is not None:
+    price_cache.restore({symbol: entry for symbol, entry in snapshot.cached_prices.items() if symbol in SYMBOLS})
+
+# Metrics
+GET_PRICE_SECONDS = Histogram("get_price_seconds", "get_price latency, cache included", ["symbol"])
+CHECK_SECONDS = Histogram("check_alerts_seconds", "Duration of a check_alerts cycle")
+CHECK_OVERRUNS = Counter("check_alerts_overruns_total", "check_alerts cycles longer than CHECK_INTERVAL")
+ALERTS_EVALUATED = Counter("alerts_evaluated_total", "Active alerts covered by price evaluations", ["symbol"])
+ALERTS_TRIGGERED = Counter("alerts_triggered_total", "Alerts triggered", ["symbol"])
+SNAPSHOT_SECONDS = Histogram("snapshot_write_seconds", "Time to write the evaluator snapshot")
+Gauge("alerts_active", "Alerts waiting to trigger", function=lambda: len(alert_book))
+Gauge("notifications_pending", "Notifications queued for sending", function=lambda: notifier.pending())
+Gauge("persistence_pending_changes", "Changes waiting to be flushed", function=lambda: persistence.pending())
+
+# Get the current price, served from the shared cache when it is fresh enough
+async def get_price(symbol, refresh=False):
     symbol = symbol.upper()
     
-    try:
-        if symbol == "BTCUSD":
-            # CoinGecko API for Bitcoin
-            response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=usd")
-            data = response.json()
-            price = data.get("bitcoin", {}).get("usd")
-            if price:
-                last_prices["BTCUSD"] = price
-                return price
-        
-        # For XAUUSD and GBPJPY, simulate price changes to make them dynamic
-        elif symbol == "XAUUSD" or symbol == "GBPJPY":
-            current_price = last_prices[symbol]
-            
-            # Simulate market volatility (small random changes)
-            if symbol == "XAUUSD":
-                # Gold typically has smaller percentage moves
-                change_percent = random.uniform(-0.1, 0.1)  # -0.1% to +0.1%
-                new_price = current_price * (1 + change_percent/100)
-                # Keep price within realistic range
-                new_price = max(min(new_price, 3050), 2990)
-            else:  # GBPJPY
-                change_percent = random.uniform(-0.2, 0.2)  # -0.2% to +0.2%
-                new_price = current_price * (1 + change_percent/100)
-                # Keep price within realistic range
-                new_price = max(min(new_price, 200), 190)
-            
-            last_prices[symbol] = new_price
-            return new_price
+    with GET_PRICE_SECONDS.labels(symbol).time():
+        if refresh:
+            price = await price_cache.refresh(symbol, fetch_price)
+        else:
+            price = await price_cache.get(symbol, fetch_price)
     
-    except Exception as e:
-        logger.error(f"Error fetching {symbol}: {e}")
+    if price is not None:
+        return price
     
     # Fallback to last known price or default
-    return last_prices.get(symbol) or {
-        "BTCUSD": 65000.00,
-        "XAUUSD": 3017.64,
-        "GBPJPY": 195.50
-    }.get(symbol)
+    if symbol in SYMBOLS:
+        return price_cache.peek(symbol) or SYMBOLS[symbol]["default_price"]
+    return None
+
+# Fetch a single symbol from its provider
+async def fetch_price(symbol):
+    prices = await price_providers.fetch_many([symbol])
+    return prices.get(symbol)
+
+# Format a price with the symbol's currency sign
+def format_price(symbol, price):
+    return f"{SYMBOLS[symbol]['currency']}{price:,.2f}"
+
+# Split text into messages of at most `limit` UTF-16 code units, at line breaks
+def split_message(text, limit=MESSAGE_LIMIT):
+    chunks = []
+    current, size = [], 0
+    for line in text.splitlines(keepends=True):
+        length = len(line.encode("utf-16-le")) // 2
+        if current and size + length > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        # A single line over the limit is cut; half the limit in characters
+        # always fits, whatever the characters are
+        while length > limit:
+            chunks.append(line[:limit // 2])
+            line = line[limit // 2:]
+            length = len(line.encode("utf-16-le")) // 2
+        current.append(line)
+        size += length
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+# Label of a percent-move window, e.g. "1h"
+def window_label(seconds):
+    for label, value in MOVE_WINDOWS.items():
+        if value == seconds:
+            return label
+    return f"{seconds / 3600:g}h"
+
+# What an alert waits for, as shown in lists and buttons
+def describe_alert(alert):
+    if alert.kind == "move":
+        return f"±{alert.percent:g}% harakat ({window_label(alert.window)})"
+    if alert.kind == "trailing":
+        return f"trailing stop -{alert.percent:g}%"
+    return format_price(alert.symbol, alert.target_price)
+
+# Find which configured symbol a button text refers to
+def find_symbol(text):
+    for symbol in SYMBOLS:
+        if symbol in text:
+            return symbol
+    return None
+
+# Symbol whose price a message asks to see, or None if it asks for something else
+def price_view_symbol(text):
+    symbol = find_symbol(text)
+    if symbol and "signal" not in text and not text.startswith("🗑️"):
+        return symbol
+    return None
 
 # Main keyboard
 def get_main_keyboard():
     keyboard = [
-        ["💰 BTCUSD", "🥇 XAUUSD", "💱 GBPJPY"],
+        [f"{config['emoji']} {symbol}" for symbol, config in SYMBOLS.items()],
         ["⏰ Mening signallarim", "➕ Signal qo'shish"]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -117,36 +441,118 @@ def get_main_keyboard():
 # Currency selection keyboard for alerts
 def get_currency_keyboard():
     keyboard = [
-        ["💰 BTCUSD signal", "🥇 XAUUSD signal", "💱 GBPJPY signal"],
+        [f"{config['emoji']} {symbol} signal" for symbol, config in SYMBOLS.items()],
+        ["🔙 Orqaga"]
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+# Alert type keyboard, shown while entering an alert's price
+def get_alert_type_keyboard():
+    keyboard = [
+        list(ALERT_TYPE_BUTTONS),
         ["🔙 Orqaga"]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-# Delete alert keyboard
-def get_delete_keyboard(user_id):
-    keyboard = []
+# Inline delete keyboard: one page of the user's alerts, each button carrying
+# the alert id, plus page navigation. Returns None when there are no alerts.
+def get_delete_keyboard(user_id, page=0):
+    alerts = alert_book.for_user(user_id)
+    if not alerts:
+        return None
     
-    if user_id in user_alerts:
-        for symbol, alerts in user_alerts[user_id].items():
-            for i, alert in enumerate(alerts):
-                keyboard.append([f"🗑️ {symbol}: {alert['target_price']:.2f}"])
+    pages = (len(alerts) + DELETE_PAGE_SIZE - 1) // DELETE_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    start = page * DELETE_PAGE_SIZE
     
-    keyboard.append(["🔙 Orqaga"])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    keyboard = [
+        [InlineKeyboardButton(
+            f"🗑️ {alert.symbol}: {describe_alert(alert)}",
+            callback_data=f"delete:{alert.id}:{page}"
+        )]
+        for alert in alerts[start:start + DELETE_PAGE_SIZE]
+    ]
+    
+    if pages > 1:
+        keyboard.append([
+            InlineKeyboardButton("⬅️", callback_data=f"delete_page:{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"delete_page:{page}"),
+            InlineKeyboardButton("➡️", callback_data=f"delete_page:{(page + 1) % pages}")
+        ])
+    return InlineKeyboardMarkup(keyboard)
+
+# Send the inline delete keyboard
+async def send_delete_keyboard(update, user_id):
+    keyboard = get_delete_keyboard(user_id)
+    if keyboard is None:
+        await update.message.reply_text(
+            "🔔 Sizda hech qanday signal yo'q.",
+            reply_markup=get_main_keyboard()
+        )
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "🗑️ O'chirmoqchi bo'lgan signalni tanlang:",
+        reply_markup=keyboard
+    )
+    return DELETING_ALERT
+
+# Wrap a handler of the conversation so that context.user_data["conversation"]
+# follows the user's state in it, for admit_update. As in ConversationHandler,
+# returning None keeps the current state.
+def tracks_conversation(handler):
+    async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        state = await handler(update, context)
+        if state == ConversationHandler.END:
+            context.user_data.pop("conversation", None)
+        elif state is not None:
+            context.user_data["conversation"] = state
+        return state
+    return tracked
+
+# Runs before every other handler (group -1) and stops updates admission
+# control turns away. Steps of a conversation the user is in are always let
+# through, so nobody is left halfway with no reply. Coalesced price views and inline button taps need no
+# reply of their own; shed ones get a cheap one, from the price cache for
+# price views, without fetching or uploading anything.
+async def admit_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user is None:
+        return
+    
+    query = update.callback_query
+    text = update.message.text if update.message is not None else None
+    symbol = price_view_symbol(text) if text else None
+    if symbol:
+        request = ("price", symbol)
+    elif query is not None:
+        request = ("callback", query.data)
+    else:
+        request = None
+    
+    in_conversation = context.user_data is not None and "conversation" in context.user_data
+    decision = admission.check(update.effective_user.id, request, essential=in_conversation)
+    if decision == ADMIT:
+        return
+    
+    if query is not None:
+        await query.answer("⏳ Juda ko'p so'rov, biroz kuting." if decision == SHED else None)
+    elif decision == SHED and update.message is not None:
+        price = price_cache.peek(symbol) if symbol else None
+        if price is not None:
+            await update.message.reply_text(f"💰 {symbol} joriy narxi: {format_price(symbol, price)}")
+        else:
+            await update.message.reply_text("⏳ Juda ko'p so'rov. Iltimos, biroz kuting va qayta urinib ko'ring.")
+    elif decision == COALESCE:
+        logger.debug(f"Coalesced a repeated request from user {update.effective_user.id}")
+    raise ApplicationHandlerStop
 
 # Start command handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
-    # Initialize user in alerts dictionary if not exists
-    if user_id not in user_alerts:
-        user_alerts[user_id] = {}
-        save_alerts()
-    
     # Initialize user in initial prices dictionary if not exists
     if user_id not in initial_prices:
         initial_prices[user_id] = {}
-        save_initial_prices()
     
     await update.message.reply_text(
         f"👋 Salom, {update.effective_user.first_name}!\n\n"
@@ -160,13 +566,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = str(update.effective_user.id)
     
+    symbol = find_symbol(text)
+    
     # Check if message is about viewing prices
-    if "BTCUSD" in text and "signal" not in text:
-        await show_price(update, "BTCUSD")
-    elif "XAUUSD" in text and "signal" not in text:
-        await show_price(update, "XAUUSD")
-    elif "GBPJPY" in text and "signal" not in text:
-        await show_price(update, "GBPJPY")
+    if price_view_symbol(text):
+        await show_price(update, symbol)
     
     # Handle alert management
     elif "Mening signallarim" in text:
@@ -180,21 +584,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SELECTING_CURRENCY
     
     # Handle currency selection for alert
-    elif "signal" in text and any(currency in text for currency in ["BTCUSD", "XAUUSD", "GBPJPY"]):
-        if "BTCUSD" in text:
-            symbol = "BTCUSD"
-        elif "XAUUSD" in text:
-            symbol = "XAUUSD"
-        else:
-            symbol = "GBPJPY"
-        
+    elif "signal" in text and symbol:
         context.user_data["selected_symbol"] = symbol
+        context.user_data.pop("alert_type", None)
         current_price = await get_price(symbol)
         
         await update.message.reply_text(
             f"📊 {symbol} uchun signal qo'shish\n\n"
-            f"📈 Joriy narx: ${current_price:,.2f}\n\n"
-            f"⚠️ Iltimos, signal narxini kiriting (masalan: 3100):"
+            f"📈 Joriy narx: {format_price(symbol, current_price)}\n\n"
+            f"⚠️ Iltimos, signal narxini kiriting (masalan: 3100) yoki signal turini tanlang:",
+            reply_markup=get_alert_type_keyboard()
         )
         return ENTERING_PRICE
     
@@ -206,42 +605,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Handle delete alert selection
+    # Delete buttons of the old reply keyboard, still shown by some clients:
+    # offer the inline delete keyboard instead
     elif text.startswith("🗑️"):
-        parts = text.split(":")
-        if len(parts) >= 2:
-            symbol_part = parts[0].replace("🗑️", "").strip()
-            price_part = parts[1].strip()
-            
-            try:
-                target_price = float(price_part)
-                
-                # Find and delete the alert
-                if user_id in user_alerts and symbol_part in user_alerts[user_id]:
-                    for i, alert in enumerate(user_alerts[user_id][symbol_part]):
-                        if abs(alert["target_price"] - target_price) < 0.01:  # Allow small difference due to formatting
-                            user_alerts[user_id][symbol_part].pop(i)
-                            
-                            # Remove empty lists
-                            if not user_alerts[user_id][symbol_part]:
-                                del user_alerts[user_id][symbol_part]
-                            
-                            save_alerts()
-                            
-                            await update.message.reply_text(
-                                f"✅ Signal muvaffaqiyatli o'chirildi:\n"
-                                f"{symbol_part}: {target_price:,.2f}",
-                                reply_markup=get_main_keyboard()
-                            )
-                            return ConversationHandler.END
-            except ValueError:
-                pass
-            
-            await update.message.reply_text(
-                "⚠️ Signal topilmadi yoki allaqachon o'chirilgan.",
-                reply_markup=get_main_keyboard()
-            )
-            return ConversationHandler.END
+        return await send_delete_keyboard(update, user_id)
     
     return ConversationHandler.END
 
@@ -251,13 +618,7 @@ async def show_price(update: Update, symbol):
     price = await get_price(symbol)
     
     if price:
-        # Format price based on symbol
-        if symbol == "BTCUSD":
-            formatted_price = f"${price:,.2f}"
-        elif symbol == "XAUUSD":
-            formatted_price = f"${price:,.2f}"
-        else:  # GBPJPY
-            formatted_price = f"¥{price:,.2f}"
+        formatted_price = format_price(symbol, price)
         
         # Check if this is the first time checking this symbol
         is_first_check = False
@@ -265,11 +626,13 @@ async def show_price(update: Update, symbol):
             if user_id not in initial_prices:
                 initial_prices[user_id] = {}
             initial_prices[user_id][symbol] = price
-            save_initial_prices()
+            persistence.initial_price_set(user_id, symbol, price)
             is_first_check = True
         
-        # Determine which image to send
+        # Determine which image to send, and the colours of the chart sent
+        # instead when there is one
         image_path = "img/start.jpg"  # Default image
+        chart_style = "neutral"
         message_text = f"💰 {symbol} joriy narxi: {formatted_price}\n📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         
         if not is_first_check:
@@ -279,26 +642,34 @@ async def show_price(update: Update, symbol):
             if price_diff < 0:
                 # Price is lower than initial
                 image_path = "img/start.jpg"
+                chart_style = "down"
                 message_text += f"\n\n📉 Dastlabki narxdan {abs(price_diff):.2f} past"
             elif price_diff >= 2:
                 # Price is higher by 2 or more
-                if symbol == "BTCUSD":
-                    image_path = "img/BTCbuy.jpg"
-                elif symbol == "XAUUSD":
-                    image_path = "img/XUAbuy.jpg"
-                elif symbol == "GBPJPY":
-                    image_path = "img/GBPbuy.jpg"
+                image_path = SYMBOLS[symbol]["buy_image"]
+                chart_style = "up"
                 message_text += f"\n\n📈 Dastlabki narxdan {price_diff:.2f} yuqori"
             else:
                 # Price is higher but less than 2
                 image_path = "img/selbuy.jpg"
                 message_text += f"\n\n📊 Dastlabki narxdan {price_diff:.2f} yuqori"
         
-        # Send image with caption
+        # Send the price chart, or the image without enough history for one,
+        # with caption
         try:
-            with open(image_path, 'rb') as photo:
-                await update.message.reply_photo(
-                    photo=photo,
+            message = None
+            if chart_renderer is not None:
+                message = await chart_renderer.send_chart(
+                    update.message.reply_photo,
+                    symbol,
+                    chart_style,
+                    caption=message_text + "\n\nSignal qo'yish uchun '➕ Signal qo'shish' tugmasini bosing",
+                    reply_markup=get_main_keyboard()
+                )
+            if message is None:
+                await media_cache.send_photo(
+                    update.message.reply_photo,
+                    image_path,
                     caption=message_text + "\n\nSignal qo'yish uchun '➕ Signal qo'shish' tugmasini bosing",
                     reply_markup=get_main_keyboard()
                 )
@@ -315,7 +686,8 @@ async def show_price(update: Update, symbol):
             reply_markup=get_main_keyboard()
         )
 
-# Handle price input for alert
+# Handle price input for alert: the alert type buttons, then the price or
+# the type's parameters
 async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     text = update.message.text
@@ -329,53 +701,119 @@ async def handle_price_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     symbol = context.user_data["selected_symbol"]
     
+    if "Orqaga" in text:
+        context.user_data.pop("selected_symbol", None)
+        context.user_data.pop("alert_type", None)
+        await update.message.reply_text(
+            "Asosiy menyuga qaytdingiz:",
+            reply_markup=get_main_keyboard()
+        )
+        return ConversationHandler.END
+    
+    # Alert type chosen: ask for its parameters
+    if text in ALERT_TYPE_BUTTONS:
+        kind = context.user_data["alert_type"] = ALERT_TYPE_BUTTONS[text]
+        if kind == "move":
+            prompt = (
+                f"⚠️ Iltimos, foiz va vaqt oralig'ini kiriting (masalan: 3 1h).\n"
+                f"Vaqt oraliqlari: {', '.join(MOVE_WINDOWS)}"
+            )
+        elif kind == "trailing":
+            prompt = "⚠️ Iltimos, eng yuqori narxdan tushish foizini kiriting (masalan: 5):"
+        else:
+            prompt = "⚠️ Iltimos, signal narxini kiriting (masalan: 3100):"
+        await update.message.reply_text(prompt)
+        return ENTERING_PRICE
+    
+    kind = context.user_data.pop("alert_type", "cross")
+    
     try:
-        # Clean the input text from any non-numeric characters except decimal point
-        clean_text = ''.join(c for c in text if c.isdigit() or c == '.')
-        target_price = float(clean_text)
-        
-        # Add the alert
-        if user_id not in user_alerts:
-            user_alerts[user_id] = {}
-        
-        if symbol not in user_alerts[user_id]:
-            user_alerts[user_id][symbol] = []
-        
-        # Add alert to user's alerts
-        user_alerts[user_id][symbol].append({
-            "target_price": target_price,
-            "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            "last_price": None
-        })
-        
-        save_alerts()
+        if kind == "move":
+            reply = await add_move_alert(user_id, symbol, text)
+        elif kind == "trailing":
+            reply = await add_trailing_alert(user_id, symbol, text)
+        else:
+            reply = await add_price_alert(user_id, symbol, text)
         
         # Clear the user data
         del context.user_data["selected_symbol"]
         
-        current_price = await get_price(symbol)
-        direction = "ko'tarilganda" if target_price > current_price else "tushganda"
+        await update.message.reply_text(reply, reply_markup=get_main_keyboard())
         
+    except (ValueError, KeyError, IndexError):
+        if kind == "move":
+            example = "foiz va vaqt oralig'ini kiriting (masalan: 3 1h)"
+        elif kind == "trailing":
+            example = "foizni kiriting (masalan: 5)"
+        else:
+            example = "raqam kiriting (masalan: 3100)"
         await update.message.reply_text(
-            f"✅ Signal muvaffaqiyatli qo'shildi!\n\n"
-            f"🔔 {symbol} narxi {target_price:,.2f} ga {direction} xabar olasiz.\n"
-            f"📈 Joriy narx: {current_price:,.2f}",
-            reply_markup=get_main_keyboard()
-        )
-        
-    except ValueError:
-        await update.message.reply_text(
-            "⚠️ Noto'g'ri format. Iltimos, raqam kiriting (masalan: 3100)",
+            f"⚠️ Noto'g'ri format. Iltimos, {example}",
             reply_markup=get_main_keyboard()
         )
     
     return ConversationHandler.END
 
+# Price-level alert from a typed price; returns the confirmation text
+async def add_price_alert(user_id, symbol, text):
+    # Clean the input text from any non-numeric characters except decimal point
+    clean_text = ''.join(c for c in text if c.isdigit() or c == '.')
+    target_price = float(clean_text)
+    current_price = await get_price(symbol)
+    
+    # Add alert to user's alerts
+    add_alert(user_id, symbol, target_price, reference_price=current_price)
+    
+    direction = "ko'tarilganda" if target_price > current_price else "tushganda"
+    
+    return (
+        f"✅ Signal muvaffaqiyatli qo'shildi!\n\n"
+        f"🔔 {symbol} narxi {target_price:,.2f} ga {direction} xabar olasiz.\n"
+        f"📈 Joriy narx: {current_price:,.2f}"
+    )
+
+# Percent-move alert from "<percent> [<window>]", e.g. "3 1h" or "±3% 4h"
+async def add_move_alert(user_id, symbol, text):
+    parts = text.replace("%", " ").replace(",", ".").split()
+    percent = abs(float(parts[0].lstrip("±")))
+    window = MOVE_WINDOWS[parts[1].lower() if len(parts) > 1 else DEFAULT_MOVE_WINDOW]
+    if not percent > 0:
+        raise ValueError(percent)
+    
+    current_price = await get_price(symbol)
+    if current_price is None:
+        return f"⚠️ {symbol} uchun ma'lumot olishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring."
+    
+    alert = add_alert(user_id, symbol, current_price, "move", percent=percent, window=window)
+    return (
+        f"✅ Signal muvaffaqiyatli qo'shildi!\n\n"
+        f"🔔 {symbol} narxi {window_label(alert.window)} ichida {percent:g}% o'zgarganda xabar olasiz.\n"
+        f"📈 Joriy narx: {current_price:,.2f}"
+    )
+
+# Trailing-stop alert from a percent, e.g. "5"
+async def add_trailing_alert(user_id, symbol, text):
+    percent = abs(float(text.replace("%", "").replace(",", ".").strip()))
+    if not 0 < percent < 100:
+        raise ValueError(percent)
+    
+    current_price = await get_price(symbol)
+    if current_price is None:
+        return f"⚠️ {symbol} uchun ma'lumot olishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring."
+    
+    add_alert(user_id, symbol, current_price, "trailing", percent=percent)
+    return (
+        f"✅ Signal muvaffaqiyatli qo'shildi!\n\n"
+        f"🔔 {symbol} narxi eng yuqori narxdan {percent:g}% tushganda xabar olasiz.\n"
+        f"📈 Joriy narx: {current_price:,.2f}"
+    )
+
 # Show user's alerts
 async def show_user_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
-    if user_id not in user_alerts or not user_alerts[user_id]:
+    alerts = alert_book.for_user(user_id)
+    if not alerts:
         await update.message.reply_text(
             "🔔 Sizda hech qanday signal yo'q.\n\n"
             "Signal qo'shish uchun '➕ Signal qo'shish' tugmasini bosing.",
@@ -383,19 +821,22 @@ async def show_user_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    message = "🔔 Sizning signallaringiz:\n\n"
+    # Only the current prices change between views of an unchanged list
+    view = alert_views.get(alerts[0].user_id)
+    if view is None:
+        view = render_alert_list(alerts)
+        alert_views[alerts[0].user_id] = view
+        if len(alert_views) > ALERT_VIEW_CACHE_SIZE:
+            alert_views.popitem(last=False)
+    else:
+        alert_views.move_to_end(alerts[0].user_id)
     
-    for symbol, alerts in user_alerts[user_id].items():
-        if alerts:
-            current_price = await get_price(symbol)
-            message += f"📊 {symbol} - Joriy narx: {current_price:,.2f}\n"
-            
-            for i, alert in enumerate(alerts, 1):
-                target = alert["target_price"]
-                direction = "ko'tarilganda" if target > current_price else "tushganda"
-                message += f"  {i}. {target:,.2f} ga {direction} ⏰\n"
-            
-            message += "\n"
+    parts = ["🔔 Sizning signallaringiz:\n\n"]
+    for symbol, lines in view:
+        current_price = price_cache.peek(symbol) or await get_price(symbol)
+        parts.append(f"📊 {symbol} - Joriy narx: {current_price:,.2f}\n")
+        parts.extend(rises if target > current_price else falls for target, falls, rises in lines)
+        parts.append("\n")
     
     # Ask if user wants to delete alerts
     keyboard = [
@@ -403,30 +844,47 @@ async def show_user_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ["🔙 Orqaga"]
     ]
     
+    chunks = split_message("".join(parts))
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
     await update.message.reply_text(
-        message,
+        chunks[-1],
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
     return DELETING_ALERT
 
+# Pre-render a user's alert list, grouped by symbol in the order the user
+# first set an alert for it, with both wordings of each line (percent-move
+# and trailing alerts read the same either way)
+def render_alert_list(alerts):
+    by_symbol = {}
+    for alert in alerts:
+        by_symbol.setdefault(alert.symbol, []).append(alert)
+    
+    view = []
+    for symbol, symbol_alerts in by_symbol.items():
+        lines = []
+        for i, alert in enumerate(symbol_alerts, 1):
+            target = alert.target_price
+            if alert.kind != "cross":
+                line = f"  {i}. {describe_alert(alert)} ⏰\n"
+                lines.append((target, line, line))
+                continue
+            lines.append((
+                target,
+                f"  {i}. {target:,.2f} ga tushganda ⏰\n",
+                f"  {i}. {target:,.2f} ga ko'tarilganda ⏰\n"
+            ))
+        view.append((symbol, lines))
+    return view
+
 # Handle delete alert request
 async def handle_delete_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     user_id = str(update.effective_user.id)
     
-    if "Signalni o'chirish" in text:
-        if user_id in user_alerts and user_alerts[user_id]:
-            await update.message.reply_text(
-                "🗑️ O'chirmoqchi bo'lgan signalni tanlang:",
-                reply_markup=get_delete_keyboard(user_id)
-            )
-            return DELETING_ALERT
-        else:
-            await update.message.reply_text(
-                "🔔 Sizda hech qanday signal yo'q.",
-                reply_markup=get_main_keyboard()
-            )
-            return ConversationHandler.END
+    if text.startswith("🗑️"):
+        return await send_delete_keyboard(update, user_id)
     elif "Orqaga" in text:
         await update.message.reply_text(
             "Asosiy menyuga qaytdingiz:",
@@ -436,14 +894,48 @@ async def handle_delete_request(update: Update, context: ContextTypes.DEFAULT_TY
     
     return DELETING_ALERT
 
-# Send enhanced alert notification with image
-async def send_alert_notification(bot, user_id, symbol, target_price, current_price):
-    # First message - Attention grabber
-    await bot.send_message(
-        chat_id=user_id,
-        text="🚨 DIQQAT! 🚨 DIQQAT! 🚨 DIQQAT! 🚨",
-        disable_notification=False  # Ensure notification sound plays
-    )
+# Handle the inline delete keyboard: "delete:<alert id>:<page>" removes an
+# alert, "delete_page:<page>" turns the page
+async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = str(query.from_user.id)
+    action, *args = query.data.split(":")
+    
+    try:
+        page = int(args[-1])
+        alert_id = int(args[0]) if action == "delete" else None
+    except (IndexError, ValueError):
+        await query.answer()
+        return
+    
+    if action == "delete":
+        alert = alert_book.get(alert_id)
+        if alert is None or alert.user_id != query.from_user.id:
+            await query.answer("⚠️ Signal topilmadi yoki allaqachon o'chirilgan.")
+        else:
+            remove_alert(alert_id)
+            await query.answer(
+                f"✅ Signal muvaffaqiyatli o'chirildi:\n"
+                f"{alert.symbol}: {describe_alert(alert)}"
+            )
+    else:
+        await query.answer()
+    
+    # The message is gone or too old for the bot to see; there is nothing to edit
+    if not isinstance(query.message, Message):
+        return
+    
+    keyboard = get_delete_keyboard(user_id, page)
+    if keyboard is None:
+        await query.edit_message_text("🔔 Sizda hech qanday signal yo'q.")
+    # Editing to an identical keyboard is an error
+    elif keyboard != query.message.reply_markup:
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+
+# Queue enhanced alert notification with image; the dispatcher sends it in the background
+def send_alert_notification(alert, current_price):
+    user_id = str(alert.user_id)
+    symbol = alert.symbol
     
     # Determine which image to send based on symbol and price movement
     image_path = "img/start.jpg"  # Default image
@@ -457,107 +949,252 @@ async def send_alert_notification(bot, user_id, symbol, target_price, current_pr
             image_path = "img/start.jpg"
         elif price_diff >= 2:
             # Price is higher by 2 or more
-            if symbol == "BTCUSD":
-                image_path = "img/BTCbuy.jpg"
-            elif symbol == "XAUUSD":
-                image_path = "img/XUAbuy.jpg"
-            elif symbol == "GBPJPY":
-                image_path = "img/GBPbuy.jpg"
+            image_path = SYMBOLS[symbol]["buy_image"]
         else:
             # Price is higher but less than 2
             image_path = "img/selbuy.jpg"
     
     # Alert details with eye-catching formatting
+    if alert.kind == "cross":
+        condition = f"🎯 Belgilangan narx: {alert.target_price:,.2f}\n"
+    else:
+        condition = f"🎯 Signal: {describe_alert(alert)}\n"
+    
     alert_message = (
         f"🔔🔔🔔 SIGNAL ISHLADI! 🔔🔔🔔\n\n"
         f"💢💢💢 {symbol} 💢💢💢\n\n"
-        f"🎯 Belgilangan narx: {target_price:,.2f}\n"
+        f"{condition}"
         f"📈 Joriy narx: {current_price:,.2f}\n"
         f"⏰ Vaqt: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
         f"❗️❗️❗️ SIGNAL ISHLADI ❗️❗️❗️"
     )
     
+    # First message - Attention grabber
+    async def send_attention(bot):
+        await bot.send_message(
+            chat_id=user_id,
+            text="🚨 DIQQAT! 🚨 DIQQAT! 🚨 DIQQAT! 🚨",
+            disable_notification=False  # Ensure notification sound plays
+        )
+    
     # Send image with caption
-    try:
-        with open(image_path, 'rb') as photo:
-            await bot.send_photo(
+    async def send_details(bot):
+        try:
+            await media_cache.send_photo(
+                bot.send_photo,
+                image_path,
                 chat_id=user_id,
-                photo=photo,
                 caption=alert_message,
                 disable_notification=False  # Ensure notification sound plays
             )
-    except FileNotFoundError:
-        # If image not found, send text message
-        logger.error(f"Image not found: {image_path}")
+        except FileNotFoundError:
+            # If image not found, send text message
+            logger.error(f"Image not found: {image_path}")
+            await bot.send_message(
+                chat_id=user_id,
+                text=alert_message,
+                disable_notification=False  # Ensure notification sound plays
+            )
+    
+    # Third message - Final attention grabber
+    async def send_final(bot):
         await bot.send_message(
             chat_id=user_id,
-            text=alert_message,
+            text="🔊 SIGNAL! 🔊 SIGNAL! 🔊 SIGNAL! 🔊",
             disable_notification=False  # Ensure notification sound plays
         )
     
-    # Third message - Final attention grabber
-    await bot.send_message(
-        chat_id=user_id,
-        text="🔊 SIGNAL! 🔊 SIGNAL! 🔊 SIGNAL! 🔊",
-        disable_notification=False  # Ensure notification sound plays
-    )
+    notifier.submit(user_id, [send_attention, send_details, send_final])
 
-# Check alerts periodically
+# Check alerts periodically, fetching each symbol's price once per cycle
 async def check_alerts(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Checking alerts...")
-    for user_id, user_data in list(user_alerts.items()):
-        for symbol, alerts in list(user_data.items()):
-            current_price = await get_price(symbol)
-            
-            if current_price is None:
-                logger.warning(f"Could not get price for {symbol}")
-                continue
-            
-            logger.info(f"Checking {len(alerts)} alerts for {symbol}. Current price: {current_price}")
-            
-            for alert_index, alert in enumerate(alerts[:]):
-                target_price = alert["target_price"]
-                last_price = alert.get("last_price")
-                
-                # First time checking this alert
-                if last_price is None:
-                    alert["last_price"] = current_price
-                    continue
-                
-                logger.info(f"Alert {alert_index}: target={target_price}, last={last_price}, current={current_price}")
-                
-                # Check if price has crossed the target
-                if ((target_price >= last_price and target_price <= current_price) or
-                    (target_price <= last_price and target_price >= current_price)):
-                    
-                    logger.info(f"Alert triggered for user {user_id}: {symbol} at {target_price}")
-                    
-                    # Send enhanced notification
-                    try:
-                        await send_alert_notification(
-                            context.bot, 
-                            user_id, 
-                            symbol, 
-                            target_price, 
-                            current_price
-                        )
-                        
-                        # Remove the alert after triggering
-                        if alert_index < len(user_alerts[user_id][symbol]):
-                            user_alerts[user_id][symbol].pop(alert_index)
-                            
-                            # Remove empty lists
-                            if not user_alerts[user_id][symbol]:
-                                del user_alerts[user_id][symbol]
-                            
-                            save_alerts()
-                        
-                    except Exception as e:
-                        logger.error(f"Error sending alert to {user_id}: {e}")
-                
-                # Update last price
-                if alert_index < len(alerts):
-                    alerts[alert_index]["last_price"] = current_price
+    logger.debug(f"Checking {len(alert_index)} alerts... price cache: {price_cache.stats()}")
+    started = time.perf_counter()
+    # Every symbol, not only those with alerts, so that the tick history has
+    # no gaps and new crossing alerts of every symbol join the index
+    symbols = list(SYMBOLS)
+    
+    # Take a new snapshot each cycle with one batched request per provider;
+    # handlers keep reading it until the next one
+    prices = await price_cache.refresh_many(symbols, price_providers.fetch_many)
+    
+    for symbol in symbols:
+        current_price = prices.get(symbol)
+        
+        if current_price is None:
+            logger.warning(f"Could not get price for {symbol}")
+            continue
+        
+        evaluate_price(symbol, current_price)
+    
+    elapsed = time.perf_counter() - started
+    CHECK_SECONDS.observe(elapsed)
+    if elapsed > CHECK_INTERVAL:
+        CHECK_OVERRUNS.inc()
+        logger.warning(f"check_alerts took {elapsed:.1f}s, longer than its {CHECK_INTERVAL:.0f}s interval")
+
+# Trigger every alert whose target was crossed since the previous price. low
+# and high widen the range when several ticks were merged into this one, for
+# percent-move and trailing alerts too. Those are fed every tick, in this
+# process also in sharded mode. timestamp defaults to now (replays pass their own).
+def evaluate_price(symbol, current_price, low=None, high=None, timestamp=None):
+    timestamp = time.time() if timestamp is None else timestamp
+    tick_history.record(symbol, current_price, timestamp)
+    trigger_alerts(symbol, current_price, alert_book.pop_moved(symbol, current_price, timestamp, low, high))
+    previous_price = alert_index.last_prices.get(symbol)
+    alert_index.last_prices[symbol] = current_price
+    
+    # The first price seen for a symbol has nothing to be compared against
+    if previous_price is not None:
+        ALERTS_EVALUATED.labels(symbol).inc(alert_index.count(symbol))
+        low = min(previous_price, current_price if low is None else low)
+        high = max(previous_price, current_price if high is None else high)
+        
+        # Shards answer through handle_shard_triggers
+        if SHARDS > 1:
+            alert_index.evaluate(symbol, current_price, low, high)
+        else:
+            trigger_alerts(symbol, current_price, alert_book.pop_crossed(symbol, low, high))
+    
+    # Crossing alerts added since the previous price join the index now, after
+    # it, and fire if the price passed them since they were set
+    trigger_alerts(symbol, current_price, alert_book.release(symbol, current_price))
+
+# Notify the owners of fired alerts, already removed from the book, and
+# delete the alerts from the store
+def trigger_alerts(symbol, current_price, triggered):
+    if not triggered:
+        return
+    
+    ALERTS_TRIGGERED.labels(symbol).inc(len(triggered))
+    logger.info(f"{len(triggered)} alerts crossed for {symbol} at {current_price}")
+    
+    for alert in triggered:
+        alert_views.pop(alert.user_id, None)
+        logger.debug(f"Alert triggered for user {alert.user_id}: {symbol} at {alert.target_price}")
+        
+        # Queue enhanced notification
+        send_alert_notification(alert, current_price)
+    
+    persistence.alerts_deleted([alert.id for alert in triggered])
+
+# Alert ids reported crossed by a shard. Skip those the user deleted while
+# the tick was being evaluated.
+def handle_shard_triggers(symbol, current_price, alert_ids):
+    triggered = [alert for alert in map(alert_book.remove, alert_ids) if alert is not None]
+    trigger_alerts(symbol, current_price, triggered)
+
+# Evaluate a streamed tick and make it the current price for handlers
+def handle_tick(symbol, price, low, high, timestamp):
+    price_cache.set(symbol, price)
+    evaluate_price(symbol, price, low, high, timestamp)
+
+# Background tasks of the streaming mode
+stream_tasks = []
+
+# Start the tick pipeline and its sources
+def start_streaming():
+    pipeline = TickPipeline(handle_tick)
+    stream_tasks.append(asyncio.create_task(pipeline.run()))
+    
+    if PRICE_REPLAY_FILE:
+        sources = [ReplaySource(PRICE_REPLAY_FILE, PRICE_REPLAY_SPEED)]
+    else:
+        binance = BinanceTradeSource({
+            symbol: config["streams"]["binance"]
+            for symbol, config in SYMBOLS.items()
+            if "binance" in config.get("streams", {})
+        })
+        # Poll everything the websocket does not cover while it is connected
+        polling = PollingSource(
+            price_providers.fetch_many,
+            lambda: [symbol for symbol in SYMBOLS if not (binance.connected and symbol in binance.streams)],
+            STREAM_POLL_INTERVAL
+        )
+        sources = [polling] + ([binance] if binance.streams else [])
+    
+    for source in sources:
+        stream_tasks.append(asyncio.create_task(source.run(pipeline)))
+    logger.info(f"Streaming prices from {', '.join(type(source).__name__ for source in sources)}")
+
+# Write the evaluator state to SNAPSHOT_FILE. It is copied on the event loop,
+# which owns it, and written from a thread.
+async def save_evaluator_snapshot():
+    saved_at, last_prices = time.time(), dict(alert_index.last_prices)
+    if SHARDS == 1:
+        index = alert_index
+    else:
+        # The shards hold the index; save the one they have built, so that a
+        # restart knows which alerts were still pending
+        index = AlertIndex()
+        await asyncio.to_thread(index.rebuild, alert_book.indexed())
+    columns = {symbol: (index.targets[symbol].tobytes(), index.ids[symbol].tobytes()) for symbol in index.symbols()}
+    state = Snapshot(saved_at, last_prices, price_cache.dump(), columns)
+    started = time.perf_counter()
+    await asyncio.to_thread(save_snapshot, SNAPSHOT_FILE, state)
+    SNAPSHOT_SECONDS.observe(time.perf_counter() - started)
+
+async def save_snapshots_periodically():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_evaluator_snapshot()
+        except Exception as e:
+            logger.error(f"Saving the evaluator snapshot failed: {e}")
+
+# Compare fresh prices with the restored ones right away instead of at the
+# first scheduled check, so alerts crossed during the downtime fire at once
+async def catch_up():
+    logger.info(f"Checking prices for crossings missed since {datetime.fromtimestamp(snapshot.saved_at)}")
+    before = len(alert_book)
+    await check_alerts(None)
+    if SHARDS == 1:
+        logger.info(f"{before - len(alert_book)} alerts fired for the downtime")
+
+# Background task saving snapshots
+snapshot_task = None
+
+# Metrics HTTP server, when enabled
+metrics_server = None
+
+# Start background tasks once the application is running
+async def post_init(application):
+    global metrics_server, snapshot_task
+    if METRICS_PORT:
+        metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
+    persistence.start()
+    notifier.start(application.bot)
+    if SHARDS > 1:
+        await asyncio.to_thread(alert_index.start, asyncio.get_running_loop())
+    if PRICE_MODE == "stream":
+        start_streaming()
+    elif alert_index.last_prices:
+        asyncio.create_task(catch_up())
+    if SNAPSHOT_FILE:
+        snapshot_task = asyncio.create_task(save_snapshots_periodically())
+
+# Write pending changes and release resources when the application stops
+async def shutdown(application):
+    for task in stream_tasks:
+        task.cancel()
+    await asyncio.gather(*stream_tasks, return_exceptions=True)
+    if SHARDS > 1:
+        await asyncio.to_thread(alert_index.stop)
+    await notifier.stop()
+    await persistence.stop()
+    if snapshot_task is not None:
+        snapshot_task.cancel()
+        try:
+            await save_evaluator_snapshot()
+        except Exception as e:
+            logger.error(f"Saving the evaluator snapshot failed: {e}")
+    await price_fetcher.aclose()
+    await store.close()
+    tick_history.flush()
+    if chart_renderer is not None:
+        chart_renderer.close()
+    if metrics_server is not None:
+        metrics_server.close()
 
 # Main function
 def main():
@@ -566,39 +1203,69 @@ def main():
         logger.error("No bot token found in environment variables. Please set TELEGRAM_BOT_TOKEN in .env file.")
         return
     
+    if UPDATE_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("UPDATE_MODE=webhook needs WEBHOOK_URL, the public address Telegram should post updates to.")
+        return
+    
+    # Check that every image the bot may send exists
+    for image_path in missing_images(IMAGES):
+        logger.error(f"Image not found: {image_path} (text will be sent instead)")
+    
     # Create application
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder().token(TOKEN).request(InstrumentedRequest())
+        .post_init(post_init).post_shutdown(shutdown)
+    )
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
     
     # Add conversation handler
     conv_handler = ConversationHandler(
         entry_points=[
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+            MessageHandler(filters.TEXT & ~filters.COMMAND, tracks_conversation(handle_message))
         ],
         states={
             SELECTING_CURRENCY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, tracks_conversation(handle_message))
             ],
             ENTERING_PRICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_price_input)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, tracks_conversation(handle_price_input))
             ],
             DELETING_ALERT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delete_request)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, tracks_conversation(handle_delete_request))
             ]
         },
-        fallbacks=[CommandHandler("start", start)]
+        fallbacks=[CommandHandler("start", tracks_conversation(start))]
     )
     
     # Add handlers
+    if ADMISSION_CONTROL:
+        application.add_handler(TypeHandler(Update, admit_update), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(handle_delete_callback, pattern=r"^delete"))
     
-    # Add job to check alerts every minute
-    job_queue = application.job_queue
-    job_queue.run_repeating(check_alerts, interval=60, first=10)
+    # Add job to check alerts every minute, unless prices are streamed
+    if PRICE_MODE != "stream":
+        job_queue = application.job_queue
+        job_queue.run_repeating(check_alerts, interval=CHECK_INTERVAL, first=10)
     
     # Start the bot
     print("✅ Bot ishga tushdi!")
-    application.run_polling()
+    if UPDATE_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,174 @@
+import asyncio
+import io
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from importlib.util import find_spec
+from media import send_uploaded_once
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+CHART_RENDERS = Counter("chart_renders_total", "Chart images rendered")
+CHART_HITS = Counter("chart_cache_hits_total", "Chart requests served by an already rendered or rendering image")
+CHART_UPLOADS = Counter("chart_uploads_total", "Chart images uploaded instead of sent by file_id")
+CHART_RENDER_SECONDS = Histogram("chart_render_seconds", "Time to render one chart image in the worker pool")
+
+# Colours of each chart style: line, area under the line (with alpha),
+# background, grid and text
+STYLES = {
+    "up": ((22, 163, 74), (22, 163, 74, 48), (255, 255, 255), (229, 231, 235), (55, 65, 81)),
+    "down": ((220, 38, 38), (220, 38, 38, 48), (255, 255, 255), (229, 231, 235), (55, 65, 81)),
+    "neutral": ((37, 99, 235), (37, 99, 235, 48), (255, 255, 255), (229, 231, 235), (55, 65, 81))
+}
+
+
+# Render a line chart of (timestamps, prices) as PNG bytes. Pure function of
+# its arguments, run in the worker pool.
+def render_chart(symbol, timestamps, prices, style, size=(640, 360)):
+    from PIL import Image, ImageDraw, ImageFont
+
+    line, area, background, grid, text = STYLES[style]
+    width, height = size
+    left, right, top, bottom = 12, 84, 40, 28
+    plot_width, plot_height = width - left - right, height - top - bottom
+
+    image = Image.new("RGB", size, background)
+    draw = ImageDraw.Draw(image, "RGBA")
+    font = ImageFont.load_default()
+
+    low, high = float(prices.min()), float(prices.max())
+    padding = (high - low) * 0.08 or abs(high) * 0.001 or 1.0
+    low, high = low - padding, high + padding
+    start, end = float(timestamps[0]), float(timestamps[-1])
+    span = (end - start) or 1.0
+
+    def point(timestamp, price):
+        x = left + (float(timestamp) - start) / span * plot_width
+        y = top + (high - float(price)) / (high - low) * plot_height
+        return x, y
+
+    # Price grid with labels on the right
+    for i in range(5):
+        y = top + plot_height * i / 4
+        draw.line([(left, y), (left + plot_width, y)], fill=grid)
+        draw.text((left + plot_width + 6, y - 6), f"{high - (high - low) * i / 4:,.2f}", fill=text, font=font)
+
+    points = [point(timestamp, price) for timestamp, price in zip(timestamps, prices)]
+    draw.polygon(points + [(points[-1][0], top + plot_height), (points[0][0], top + plot_height)], fill=area)
+    draw.line(points, fill=line, width=2, joint="curve")
+
+    first, last = float(prices[0]), float(prices[-1])
+    change = (last - first) / first * 100 if first else 0.0
+    draw.text((left, 12), f"{symbol}  {last:,.2f}  ({change:+.2f}%)", fill=text, font=font)
+    draw.text((left, height - 20), datetime.fromtimestamp(start).strftime('%H:%M'), fill=text, font=font)
+    draw.text((left + plot_width - 30, height - 20), datetime.fromtimestamp(end).strftime('%H:%M'), fill=text, font=font)
+
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+# One rendered chart; file_id is set once Telegram has it
+class Chart:
+    __slots__ = ("png", "file_id", "lock")
+
+    def __init__(self, png):
+        self.png = png
+        self.file_id = None
+        self.lock = asyncio.Lock()
+
+
+# Price charts drawn from the tick history over the last `window_seconds`.
+# A chart is rendered once per (symbol, time bucket, style), in a worker
+# pool, and kept in a bounded LRU cache, so every request in the same bucket
+# gets the same image and, after its first upload, the same Telegram file_id.
+# Concurrent requests for a chart that is still rendering wait for it.
+class ChartRenderer:
+    def __init__(self, history, window_seconds=3600, bucket_seconds=60, cache_size=256, workers=2, size=(640, 360)):
+        self.history = history
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.cache_size = cache_size
+        self.size = size
+        # (symbol, bucket, style) -> Chart, least recently used first
+        self.entries = OrderedDict()
+        # (symbol, bucket, style) -> task rendering that chart
+        self._rendering = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chart")
+
+    # Whether Pillow, needed to render, is installed
+    @staticmethod
+    def available():
+        return find_spec("PIL") is not None
+
+    def key(self, symbol, style, now=None):
+        return symbol, int((time.time() if now is None else now) // self.bucket_seconds), style
+
+    # The chart of the current bucket, or None without enough history to draw
+    async def chart(self, symbol, style):
+        key = self.key(symbol, style)
+        chart = self.entries.get(key)
+        if chart is not None:
+            self.entries.move_to_end(key)
+            CHART_HITS.inc()
+            return chart
+
+        task = self._rendering.get(key)
+        if task is None:
+            task = self._rendering[key] = asyncio.ensure_future(self._render(key))
+            task.add_done_callback(lambda _: self._rendering.pop(key, None))
+        else:
+            CHART_HITS.inc()
+        return await asyncio.shield(task)
+
+    async def _render(self, key):
+        symbol, _, style = key
+        # The history is only written on the event loop, so it is read here and
+        # the worker gets copies
+        timestamps, prices = self.history.downsample(symbol, self.size[0], self.window_seconds)
+        if len(prices) < 2:
+            return None
+
+        started = time.perf_counter()
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(
+                self._executor, render_chart, symbol, timestamps, prices, style, self.size
+            )
+        except Exception as e:
+            logger.error(f"Rendering the {symbol} chart failed: {e}")
+            return None
+        CHART_RENDER_SECONDS.observe(time.perf_counter() - started)
+        CHART_RENDERS.inc()
+
+        chart = self.entries[key] = Chart(png)
+        while len(self.entries) > self.cache_size:
+            self.entries.popitem(last=False)
+        return chart
+
+    # Send the current chart with `send` (bot.send_photo, message.reply_photo,
+    # ...), by file_id once one is known. Returns None, sending nothing, when
+    # there is no chart to send.
+    async def send_chart(self, send, symbol, style, **kwargs):
+        chart = await self.chart(symbol, style)
+        if chart is None:
+            return None
+
+        message, uploaded = await send_uploaded_once(
+            send,
+            chart.lock,
+            lambda: chart.file_id,
+            lambda file_id: setattr(chart, "file_id", file_id),
+            lambda: nullcontext(chart.png),
+            f"the {symbol} chart",
+            **kwargs
+        )
+        if uploaded:
+            CHART_UPLOADS.inc()
+        return message
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,267 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from email import policy
+from email.parser import BytesParser
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Methods answered with a plain True
+TRUE_METHODS = {
+    "deleteWebhook", "setWebhook", "close", "logOut", "answerCallbackQuery", "sendChatAction",
+    "deleteMessage", "setMyCommands", "deleteMyCommands"
+}
+# Methods that post or change a message and return it
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+
+# One Bot API call made by the bot; result is the message it sent or changed
+class ApiCall:
+    __slots__ = ("method", "chat_id", "params", "at", "result")
+
+    def __init__(self, method, chat_id, params, at, result=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.params = params
+        self.at = at
+        self.result = result
+
+
+# Local stand-in for the Telegram Bot API, enough of it for the bot to run
+# against: getMe, getUpdates (long polling) and the message methods it uses,
+# with multipart photo uploads. Updates are injected with push_update and
+# every call the bot makes is recorded per chat, so a driver can wait for the
+# replies to an update. It also answers CoinGecko's /simple/price under
+# /coingecko with random-walk prices, so the bot needs no network at all.
+#
+# Point the bot at it with TELEGRAM_API_URL=http://<host>:<port> (any token).
+class FakeBotApi:
+    def __init__(self, host="127.0.0.1", port=8081, coin_prices=None):
+        self.host = host
+        self.port = port
+        # coin -> vs currency -> price
+        self.coin_prices = coin_prices or {"bitcoin": {"usd": 65000.0}}
+        self.bot_user = {"id": 1, "is_bot": True, "first_name": "Signal", "username": "signal_loadtest_bot"}
+        self.updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        # (chat id, message id) -> message as returned to the bot
+        self.messages = {}
+        # callback query id -> chat id, for answerCallbackQuery
+        self._callback_chats = {}
+        # chat id -> calls, oldest first; and futures waiting for the next call
+        self.calls = {}
+        self._waiters = {}
+        self.method_counts = {}
+        self.errors = {}
+        self._server = None
+        self._handlers = set()
+        self._closed = False
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Fake Bot API listening on {self.url}")
+
+    # Stop listening and end open connections, answering pending long polls
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._closed = True
+            self._new_updates.set()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    # Queue an update for getUpdates; returns it with its update_id set
+    def push_update(self, update):
+        update = dict(update, update_id=next(self._update_ids))
+        if "callback_query" in update:
+            query = update["callback_query"]
+            self._callback_chats[query["id"]] = query["from"]["id"]
+        self.updates.append(update)
+        self._new_updates.set()
+        return update
+
+    # Wait for the next call the bot makes in `chat_id` after calls[chat_id][index:]
+    async def next_call(self, chat_id, index, timeout):
+        calls = self.calls.setdefault(chat_id, [])
+        if len(calls) > index:
+            return calls[index]
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            waiters = self._waiters.get(chat_id)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+
+    def _record(self, method, chat_id, params, result=None):
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        if chat_id is None:
+            return
+        call = ApiCall(method, chat_id, params, time.perf_counter(), result)
+        self.calls.setdefault(chat_id, []).append(call)
+        for waiter in self._waiters.pop(chat_id, []):
+            if not waiter.done():
+                waiter.set_result(call)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            # Keep-alive: serve requests until the client closes the connection
+            while not self._closed:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                method, target = request_line.decode("latin-1").split()[:2]
+                status, payload = await self._dispatch(method, target, headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Fake Bot API request failed: {e}")
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    async def _dispatch(self, http_method, target, headers, body):
+        url = urlsplit(target)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "coingecko":
+            return "200 OK", self._coingecko(dict(parse_qsl(url.query)))
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return "404 Not Found", {"ok": False, "error_code": 404, "description": "Not Found"}
+
+        method = parts[1]
+        params = dict(parse_qsl(url.query))
+        params.update(parse_body(headers.get("content-type", ""), body))
+        try:
+            result = await self._call(method, params)
+        except ApiError as e:
+            self.errors[method] = self.errors.get(method, 0) + 1
+            return f"{e.code} Error", {"ok": False, "error_code": e.code, "description": e.description}
+        return "200 OK", {"ok": True, "result": result}
+
+    async def _call(self, method, params):
+        if method == "getMe":
+            self._record(method, None, params)
+            return self.bot_user
+        if method == "getUpdates":
+            self._record(method, None, params)
+            return await self._get_updates(params)
+        if method in TRUE_METHODS:
+            chat_id = params.get("chat_id")
+            if method == "answerCallbackQuery":
+                chat_id = self._callback_chats.pop(params.get("callback_query_id"), None)
+            self._record(method, int(chat_id) if chat_id is not None else None, params)
+            return True
+        if method in MESSAGE_METHODS:
+            if "chat_id" not in params:
+                raise ApiError(400, "Bad Request: chat_id is empty")
+            chat_id = int(params["chat_id"])
+            message = self._message(method, chat_id, params)
+            self._record(method, chat_id, params, message)
+            return message
+        raise ApiError(404, "Not Found")
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        if offset:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and not self._closed:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout", 0)))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit", 100))]
+
+    # The message a send or edit call results in
+    def _message(self, method, chat_id, params):
+        if method.startswith("edit"):
+            key = (chat_id, int(params.get("message_id", 0)))
+            message = self.messages.get(key)
+            if message is None:
+                raise ApiError(400, "Bad Request: message to edit not found")
+            message = dict(message)
+        else:
+            message = {"message_id": next(self._message_ids), "chat": {"id": chat_id, "type": "private"}}
+            key = (chat_id, message["message_id"])
+        message.update({"date": int(time.time()), "from": self.bot_user})
+
+        if "text" in params:
+            message["text"] = params["text"]
+        if "photo" in params:
+            file_id = params["photo"] if isinstance(params["photo"], str) else f"photo-{next(self._file_ids)}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 360}]
+            if "caption" in params:
+                message["caption"] = params["caption"]
+        markup = json.loads(params["reply_markup"]) if "reply_markup" in params else None
+        # Only inline keyboards are part of a message
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        elif method.startswith("edit"):
+            message.pop("reply_markup", None)
+        self.messages[key] = message
+        return message
+
+    def _coingecko(self, params):
+        self._record("coingecko", None, params)
+        result = {}
+        for coin in params.get("ids", "").split(","):
+            for vs in params.get("vs_currencies", "").split(","):
+                prices = self.coin_prices.get(coin)
+                if prices and vs in prices:
+                    prices[vs] *= 1 + random.uniform(-0.001, 0.001)
+                    result.setdefault(coin, {})[vs] = prices[vs]
+        return result
+
+
+class ApiError(Exception):
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+
+# Parameters of a Bot API request body: JSON, form-encoded, or multipart with
+# uploaded files as bytes
+def parse_body(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=policy.HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            params[name] = payload if part.get_filename() else payload.decode()
+        return params
+    return dict(parse_qsl(body.decode()))
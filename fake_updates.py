@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import json
+import time
+import httpx
+
+# Posts synthetic Telegram updates to the bot's webhook listener, the way
+# Telegram would, and reports how the listener answered. Each simulated user
+# walks through the add-alert conversation, so with CONCURRENT_UPDATES the
+# per-user ordering is exercised as well. Start the bot with UPDATE_MODE=webhook
+# (replies go to whatever Bot API server the bot is configured with):
+#
+#   python fake_updates.py --url http://127.0.0.1:8443/telegram --users 200
+
+# One user's messages: open the add-alert menu, pick a symbol, enter a price,
+# then look at the price and the alert list
+CONVERSATION = ["➕ Signal qo'shish", "💰 BTCUSD signal", "70000", "💰 BTCUSD", "⏰ Mening signallarim", "🔙 Orqaga"]
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Fake"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Fake"},
+            "text": text
+        }
+    }
+
+
+async def run(args):
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    statuses = {}
+    samples = []
+    update_ids = iter(range(1, 1 << 62))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(client, user_id, text):
+        body = json.dumps(make_update(next(update_ids), user_id, text))
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(args.url, content=body, headers=headers)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            samples.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    # A user's updates are posted one after another, like Telegram does;
+    # different users are posted concurrently
+    async def user(client, user_id):
+        for _ in range(args.rounds):
+            for text in CONVERSATION:
+                await post(client, user_id, text)
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=30) as client:
+        await asyncio.gather(*(user(client, 1_000_000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    samples.sort()
+    return {
+        "updates": len(samples),
+        "seconds": elapsed,
+        "updates_per_sec": len(samples) / elapsed if elapsed else None,
+        "statuses": statuses,
+        "latency_ms": {
+            "p50": samples[len(samples) // 2] * 1000,
+            "p99": samples[int(len(samples) * 0.99)] * 1000,
+            "max": samples[-1] * 1000
+        } if samples else {}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post fake Telegram updates to the webhook listener")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET of the bot, if set")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=1, help="times each user repeats the conversation")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight at once")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import logging
+import os
+import tempfile
+
+# Shared setup of the offline tools (backtest.py, benchmark.py, loadtest.py),
+# which run the bot against files in a scratch directory.
+
+
+# Bot settings that put every file the bot writes into `workdir`
+def scratch_settings(workdir, db_name="signal.db"):
+    return {
+        "DB_FILE": os.path.join(workdir, db_name),
+        "ALERTS_FILE": os.path.join(workdir, "user_alerts.json"),
+        "INITIAL_PRICES_FILE": os.path.join(workdir, "initial_prices.json"),
+        "MEDIA_CACHE_FILE": os.path.join(workdir, "media_cache.json"),
+        "HISTORY_DIR": os.path.join(workdir, "history"),
+        "SNAPSHOT_FILE": os.path.join(workdir, "evaluator_state.npz")
+    }
+
+
+# Create a scratch directory and point the bot's configuration at it, with
+# no Telegram token and any further `settings`. bot.py reads its
+# configuration at import time, so call this before importing it. Returns
+# the directory.
+def use_scratch_dir(prefix, db_name="signal.db", **settings):
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.environ.update(scratch_settings(workdir, db_name), TELEGRAM_BOT_TOKEN="", **settings)
+    return workdir
+
+
+# Keep the bot's log lines (one per alert, missing-image errors for every
+# notification) out of the measurements
+def quiet_bot_logs():
+    logging.disable(logging.ERROR)
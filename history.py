@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# File layout: a header of four int64 (magic, capacity, next write position,
+# number of stored ticks) followed by capacity rows of (timestamp, price) float64
+MAGIC = 0x5449434B31  # "TICK1"
+HEADER = 4
+
+OHLC_DTYPE = np.dtype([("time", "f8"), ("open", "f8"), ("high", "f8"), ("low", "f8"), ("close", "f8")])
+
+
+# Fixed-size ring buffer of (timestamp, price) ticks for one symbol, kept in a
+# memory-mapped file so it survives restarts. Timestamps never go backwards.
+class TickRing:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+
+        previous = self._read_existing(path)
+        size = (HEADER + capacity * 2) * 8
+        if previous is None or previous[0] != capacity:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+        self._header = np.memmap(path, dtype=np.int64, mode='r+', shape=(HEADER,))
+        self._data = np.memmap(path, dtype=np.float64, mode='r+', offset=HEADER * 8, shape=(capacity, 2))
+
+        if previous is not None and previous[0] != capacity:
+            # Capacity changed: keep the newest ticks that fit
+            ticks = previous[1][-capacity:]
+            self._data[:len(ticks)] = ticks
+            self._header[:] = (MAGIC, capacity, len(ticks) % capacity, len(ticks))
+            logger.info(f"Resized tick history {path} to {capacity} ticks")
+        elif previous is None:
+            self._header[:] = (MAGIC, capacity, 0, 0)
+
+    # (capacity, ordered ticks) of an existing file, or None
+    @staticmethod
+    def _read_existing(path):
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER * 8:
+            return None
+        header = np.fromfile(path, dtype=np.int64, count=HEADER)
+        magic, capacity, head, count = (int(value) for value in header)
+        if magic != MAGIC or capacity <= 0 or os.path.getsize(path) != (HEADER + capacity * 2) * 8:
+            logger.warning(f"Ignoring unreadable tick history {path}")
+            return None
+        data = np.fromfile(path, dtype=np.float64, offset=HEADER * 8).reshape(capacity, 2)
+        if count < capacity:
+            return capacity, data[:count]
+        return capacity, np.concatenate((data[head:], data[:head]))
+
+    def __len__(self):
+        return int(self._header[3])
+
+    def append(self, timestamp, price):
+        head, count = int(self._header[2]), int(self._header[3])
+        if count:
+            timestamp = max(timestamp, self._data[head - 1, 0])
+        self._data[head] = (timestamp, price)
+        self._header[2] = (head + 1) % self.capacity
+        self._header[3] = min(count + 1, self.capacity)
+
+    # Timestamp of the newest tick, or None
+    def latest(self):
+        head, count = int(self._header[2]), int(self._header[3])
+        return float(self._data[head - 1, 0]) if count else None
+
+    # Ticks in time order as (timestamps, prices), optionally only since a time
+    def ticks(self, since=None):
+        head, count = int(self._header[2]), int(self._header[3])
+        if count < self.capacity:
+            data = self._data[:count]
+        else:
+            data = np.concatenate((self._data[head:], self._data[:head]))
+        timestamps, prices = data[:, 0], data[:, 1]
+        if since is not None:
+            start = np.searchsorted(timestamps, since, side='left')
+            timestamps, prices = timestamps[start:], prices[start:]
+        return np.array(timestamps), np.array(prices)
+
+    def flush(self):
+        self._header.flush()
+        self._data.flush()
+
+
+# Tick history of every symbol, one TickRing file per symbol in `directory`.
+# Queries take a window in seconds back from now (None for everything kept).
+class TickHistory:
+    def __init__(self, directory, capacity=100_000):
+        self.directory = directory
+        self.capacity = capacity
+        self.rings = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def ring(self, symbol):
+        ring = self.rings.get(symbol)
+        if ring is None:
+            ring = self.rings[symbol] = TickRing(os.path.join(self.directory, f"{symbol}.ticks"), self.capacity)
+        return ring
+
+    def record(self, symbol, price, timestamp=None):
+        self.ring(symbol).append(time.time() if timestamp is None else timestamp, price)
+
+    def window(self, symbol, seconds=None):
+        return self.ring(symbol).ticks(None if seconds is None else time.time() - seconds)
+
+    # The last `seconds` of ticks counted back from the symbol's newest tick
+    # rather than from now, so it also works on replayed time
+    def recent(self, symbol, seconds):
+        ring = self.ring(symbol)
+        latest = ring.latest()
+        return ring.ticks(None if latest is None else latest - seconds)
+
+    def low(self, symbol, seconds=None):
+        _, prices = self.window(symbol, seconds)
+        return float(prices.min()) if len(prices) else None
+
+    def high(self, symbol, seconds=None):
+        _, prices = self.window(symbol, seconds)
+        return float(prices.max()) if len(prices) else None
+
+    # Percent change from the first to the last price in the window
+    def change(self, symbol, seconds=None):
+        _, prices = self.window(symbol, seconds)
+        if len(prices) < 2 or not prices[0]:
+            return None
+        return float((prices[-1] - prices[0]) / prices[0] * 100)
+
+    # OHLC bars of `bar_seconds` each, aligned to multiples of bar_seconds;
+    # bars without ticks are left out
+    def ohlc(self, symbol, bar_seconds, seconds=None):
+        timestamps, prices = self.window(symbol, seconds)
+        if not len(prices):
+            return np.empty(0, dtype=OHLC_DTYPE)
+
+        buckets = np.floor_divide(timestamps, bar_seconds)
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(prices)] - 1
+
+        bars = np.empty(len(starts), dtype=OHLC_DTYPE)
+        bars["time"] = buckets[starts] * bar_seconds
+        bars["open"] = prices[starts]
+        bars["high"] = np.maximum.reduceat(prices, starts)
+        bars["low"] = np.minimum.reduceat(prices, starts)
+        bars["close"] = prices[ends]
+        return bars
+
+    # At most `points` (timestamp, price) pairs: the window split into equal
+    # time buckets, each reduced to its mean time and price
+    def downsample(self, symbol, points, seconds=None):
+        timestamps, prices = self.window(symbol, seconds)
+        if len(prices) <= points:
+            return timestamps, prices
+
+        span = timestamps[-1] - timestamps[0]
+        if span <= 0:
+            return timestamps[-1:], prices[-1:]
+        buckets = np.minimum(((timestamps - timestamps[0]) / span * points).astype(np.int64), points - 1)
+        counts = np.bincount(buckets, minlength=points)
+        filled = counts > 0
+        mean_times = np.bincount(buckets, weights=timestamps, minlength=points)[filled] / counts[filled]
+        mean_prices = np.bincount(buckets, weights=prices, minlength=points)[filled] / counts[filled]
+        return mean_times, mean_prices
+
+    def flush(self):
+        for ring in self.rings.values():
+            ring.flush()
@@ -0,0 +1,247 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from fake_telegram import FakeBotApi
+from harness import scratch_settings
+
+# End-to-end load test of the whole bot. The bot runs as a separate process,
+# unchanged, pointed at a local fake Bot API server (fake_telegram.py) that
+# also serves its CoinGecko prices. Thousands of simulated users then walk
+# through a scripted conversation, each waiting for the bot's reply before
+# the next step. Reports, per step, the latency from posting an update to
+# the bot's first API call in that chat, the API calls each update caused,
+# and how many steps timed out or got an API error back.
+#
+#   python loadtest.py --users 2000 --ramp 20
+#   ADMISSION_CONTROL=0 CONCURRENT_UPDATES=64 python loadtest.py --users 2000
+#
+# Any other bot settings are taken from the environment, as for bot.py.
+
+WORKDIR = tempfile.mkdtemp(prefix="signal-loadtest-")
+TOKEN = "123456:loadtest"
+
+# One conversation: (step name, text sent). "/start" is sent as a command;
+# None presses the first alert button of the inline delete keyboard.
+SCRIPT = [
+    ("start", "/start"),
+    ("show_price", "💰 BTCUSD"),
+    ("add_menu", "➕ Signal qo'shish"),
+    ("select_symbol", "💰 BTCUSD signal"),
+    ("enter_price", "1000000"),
+    ("show_alerts", "⏰ Mening signallarim"),
+    ("delete_menu", "🗑️ Signalni o'chirish"),
+    ("delete_alert", None),
+    ("back", "🔙 Orqaga")
+]
+
+
+def make_message(user_id, text):
+    message = {
+        "message_id": random.randrange(1 << 30),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "Load"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+        "text": text
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"message": message}
+
+
+# A tap on the first alert button of the newest inline keyboard in the chat,
+# or None if the bot has not sent one
+def make_callback(api, user_id):
+    for call in reversed(api.calls.get(user_id, ())):
+        markup = (call.result or {}).get("reply_markup")
+        if not markup:
+            continue
+        for row in markup["inline_keyboard"]:
+            for button in row:
+                if button.get("callback_data", "").startswith("delete:"):
+                    return {"callback_query": {
+                        "id": str(random.randrange(1 << 62)),
+                        "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+                        "chat_instance": str(user_id),
+                        "message": call.result,
+                        "data": button["callback_data"]
+                    }}
+    return None
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {
+        "p50": samples[len(samples) // 2] * 1000,
+        "p90": samples[int(len(samples) * 0.9)] * 1000,
+        "p99": samples[int(len(samples) * 0.99)] * 1000,
+        "max": samples[-1] * 1000
+    }
+
+
+class Results:
+    def __init__(self):
+        # step -> reply latencies, API calls per update
+        self.latency = {name: [] for name, _ in SCRIPT}
+        self.calls = {name: [] for name, _ in SCRIPT}
+        self.timeouts = {}
+        self.skipped = {}
+        # Replies that were admission control turning the update away
+        self.shed = 0
+        self.updates = 0
+
+
+# One user running the script, pausing `think` seconds on average between steps
+async def converse(api, user_id, args, results):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for _ in range(args.rounds):
+        for name, text in SCRIPT:
+            update = make_message(user_id, text) if text is not None else make_callback(api, user_id)
+            if update is None:
+                results.skipped[name] = results.skipped.get(name, 0) + 1
+                continue
+
+            index = len(api.calls.get(user_id, ()))
+            sent = time.perf_counter()
+            api.push_update(update)
+            results.updates += 1
+            try:
+                call = await api.next_call(user_id, index, args.timeout)
+                results.latency[name].append(call.at - sent)
+                if str(call.params.get("text", "")).startswith("⏳"):
+                    results.shed += 1
+            except asyncio.TimeoutError:
+                results.timeouts[name] = results.timeouts.get(name, 0) + 1
+
+            # Calls made until the next update are this update's
+            await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+            results.calls[name].append(len(api.calls.get(user_id, ())) - index)
+
+
+# Start bot.py against the fake server and wait until it polls for updates
+async def start_bot(api, args, log_path):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=api.url,
+        COINGECKO_API_URL=f"{api.url}/coingecko",
+        COINGECKO_API_KEY="",
+        METALS_API_KEY="",
+        EXCHANGE_RATE_API_KEY="",
+        UPDATE_MODE="polling",
+        METRICS_PORT=os.environ.get("METRICS_PORT", "0"),
+        **scratch_settings(WORKDIR, "loadtest.db")
+    )
+    log = open(log_path, "wb")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py"),
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=log
+    )
+    log.close()
+
+    deadline = time.monotonic() + args.startup_timeout
+    while not api.method_counts.get("getUpdates"):
+        if process.returncode is not None or time.monotonic() > deadline:
+            raise RuntimeError(f"The bot did not start, see {log_path}")
+        await asyncio.sleep(0.05)
+    return process
+
+
+async def stop_bot(process):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+async def run(args):
+    api = FakeBotApi(args.host, args.port)
+    await api.start()
+    log_path = os.path.join(WORKDIR, "bot.log")
+    process = await start_bot(api, args, log_path) if not args.external else None
+    # Errors the bot logs while serving the users, not at startup
+    log_start = os.path.getsize(log_path) if process is not None else 0
+    if args.external:
+        print(f"Waiting for a bot with TELEGRAM_API_URL={api.url}", file=sys.stderr)
+        while not api.method_counts.get("getUpdates"):
+            await asyncio.sleep(0.1)
+
+    results = Results()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(converse(api, 1_000_000 + i, args, results) for i in range(args.users)))
+    finally:
+        elapsed = time.perf_counter() - started
+        if process is not None:
+            await stop_bot(process)
+        await api.close()
+
+    errors = sum(results.timeouts.values()) + sum(api.errors.values())
+    bot_errors = 0
+    if process is not None:
+        with open(log_path, "rb") as f:
+            f.seek(log_start)
+            bot_errors = sum(b" - ERROR - " in line for line in f)
+    all_latencies = [sample for samples in results.latency.values() for sample in samples]
+    return {
+        "benchmark": "signal-loadtest",
+        "params": vars(args),
+        "updates": results.updates,
+        "seconds": elapsed,
+        "updates_per_sec": results.updates / elapsed if elapsed else None,
+        "latency_ms": percentiles(all_latencies),
+        "steps": {
+            name: {
+                "latency_ms": percentiles(results.latency[name]),
+                "calls_per_update": sum(results.calls[name]) / len(results.calls[name]) if results.calls[name] else None,
+                "timeouts": results.timeouts.get(name, 0),
+                "skipped": results.skipped.get(name, 0)
+            }
+            for name, _ in SCRIPT
+        },
+        "api_calls": api.method_counts,
+        "api_errors": api.errors,
+        "shed_replies": results.shed,
+        "error_rate": errors / results.updates if results.updates else None,
+        "bot_errors_logged": bot_errors,
+        "bot_log": log_path if process is not None else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the bot end to end against a fake Bot API server")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=1, help="times each user runs the conversation")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which users start")
+    parser.add_argument("--think", type=float, default=1.0, help="mean seconds between a user's steps")
+    parser.add_argument("--timeout", type=float, default=15.0, help="seconds to wait for a reply")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="port of the fake Bot API server")
+    parser.add_argument("--external", action="store_true", help="do not start bot.py, wait for one started separately")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
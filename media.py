@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import os
+from telegram.error import BadRequest
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+# Remembers the file_id Telegram assigns to each uploaded image, so an image
+# is uploaded once and afterwards sent by reference. Entries are keyed by path
+# and tied to the file's modification time, so replacing an image re-uploads
+# it. The mapping is saved to disk and survives restarts.
+class MediaCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._locks = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except ValueError as e:
+                logger.error(f"Ignoring unreadable media cache {path}: {e}")
+        self.uploads = 0
+        self.reuses = 0
+
+    def file_id(self, image_path):
+        entry = self.entries.get(image_path)
+        if entry and entry["mtime"] == os.path.getmtime(image_path):
+            return entry["file_id"]
+        return None
+
+    def _set_file_id(self, image_path, file_id):
+        if file_id is None:
+            self.entries.pop(image_path, None)
+        else:
+            self.entries[image_path] = {"file_id": file_id, "mtime": os.path.getmtime(image_path)}
+
+    # Send a photo with `send` (bot.send_photo, message.reply_photo, ...),
+    # by file_id when one is known, uploading the file otherwise
+    async def send_photo(self, send, image_path, **kwargs):
+        # Raises FileNotFoundError for missing images, like opening the file would
+        message, uploaded = await send_uploaded_once(
+            send,
+            self._locks.setdefault(image_path, asyncio.Lock()),
+            lambda: self.file_id(image_path),
+            lambda file_id: self._set_file_id(image_path, file_id),
+            lambda: open(image_path, 'rb'),
+            image_path,
+            **kwargs
+        )
+        if not uploaded:
+            self.reuses += 1
+            return message
+
+        self.uploads += 1
+        if image_path in self.entries:
+            await asyncio.to_thread(write_atomic, self.path, json.dumps(self.entries))
+        return message
+
+
+# Whether Telegram rejected a request for its file_id, as opposed to the
+# rest of it ("Wrong file identifier/http url specified", "File reference
+# expired", ...)
+def is_file_id_error(error):
+    message = str(error).lower()
+    return "file identifier" in message or "file reference" in message
+
+
+# Send a photo with `send` by the file_id get_file_id() returns, uploading
+# open_photo() (a context manager giving the file or its bytes) when there is
+# none or Telegram rejects the file_id. set_file_id(file_id) forgets a rejected file_id
+# (with None) and keeps the one an upload got. Uploads hold `lock`, so that
+# callers arriving meanwhile send the new file_id instead of uploading again.
+# Returns the message and whether the photo was uploaded.
+async def send_uploaded_once(send, lock, get_file_id, set_file_id, open_photo, name, **kwargs):
+    file_id = get_file_id()
+    if file_id:
+        try:
+            return await send(photo=file_id, **kwargs), False
+        except BadRequest as e:
+            # Anything else (a bad chat, caption, ...) would fail the upload too
+            if not is_file_id_error(e):
+                raise
+            logger.warning(f"Cached file_id of {name} was rejected ({e}), uploading again")
+            set_file_id(None)
+
+    async with lock:
+        file_id = get_file_id()
+        if file_id:
+            return await send(photo=file_id, **kwargs), False
+
+        with open_photo() as photo:
+            message = await send(photo=photo, **kwargs)
+        if message is not None and message.photo:
+            set_file_id(message.photo[-1].file_id)
+        return message, True
+
+
+# Return the image paths that do not exist
+def missing_images(paths):
+    return [path for path in paths if not os.path.exists(path)]
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import timedelta
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+SEND_SECONDS = Histogram("telegram_send_seconds", "Latency of outbound Telegram calls", ["result"])
+SEND_ERRORS = Counter("telegram_send_errors_total", "Failed outbound Telegram calls", ["error"])
+
+
+# Request object for the bot's outbound calls (every Bot API call except
+# getUpdates, which PTB makes through a request object of its own) that
+# records each one under the send metrics, whether it comes from a handler
+# reply or from the dispatcher. Pass it to ApplicationBuilder.request().
+class InstrumentedRequest(HTTPXRequest):
+    def __init__(self, connection_pool_size=256, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await super().post(*args, **kwargs)
+        except Exception as e:
+            SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+            SEND_ERRORS.labels(type(e).__name__).inc()
+            raise
+        SEND_SECONDS.labels("ok").observe(time.perf_counter() - started)
+        return result
+
+
+# Token bucket: `rate` tokens per second, holding at most `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds to wait before a token is available (0 if one was taken)
+    def take(self):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self.take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    # Refuse tokens until `delay` seconds from now, e.g. after a RetryAfter
+    def block(self, delay):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.tokens = 0
+
+
+# Outbound message queue with a fixed pool of workers. Each job is a list of
+# sends (async callables taking the bot) for one chat. Jobs for the same chat
+# run in order and never in parallel; different chats are served round-robin.
+# Every send waits for both the global and the chat's token bucket, which
+# follow Telegram's limits of about 30 messages per second overall and one per
+# second per chat.
+class NotificationDispatcher:
+    def __init__(self, workers=8, global_rate=30.0, chat_rate=1.0, chat_burst=3, max_retries=5):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bot = None
+        # chat_id -> deque of pending jobs
+        self._chats = {}
+        self._chat_buckets = {}
+        # Chats with pending jobs that no worker is serving
+        self._ready = asyncio.Queue()
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def pending(self):
+        return sum(len(jobs) for jobs in self._chats.values())
+
+    # Queue a job without waiting for it to be sent
+    def submit(self, chat_id, sends):
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        jobs.append(list(sends))
+
+    def start(self, bot):
+        self.bot = bot
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    # Give queued jobs up to `timeout` seconds to go out, then stop the workers
+    async def stop(self, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self._chats and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._chats:
+            logger.warning(f"Dropping {self.pending()} unsent notifications on shutdown")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats.get(chat_id)
+            if not jobs:
+                self._chats.pop(chat_id, None)
+                continue
+
+            delay = await self._run_job(chat_id, jobs[0])
+            if delay is None:
+                jobs.popleft()
+
+            if not jobs:
+                del self._chats[chat_id]
+                self._chat_buckets.pop(chat_id, None)
+            elif delay:
+                # Telegram asked us to wait; come back to this chat when it allows
+                asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+            else:
+                # Serve other chats before this one's next job
+                self._ready.put_nowait(chat_id)
+
+    # Send a job's messages in order. Returns None when the job is finished
+    # (sent or given up on), or the RetryAfter delay if the rest of it must wait.
+    async def _run_job(self, chat_id, job):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        while job:
+            attempt = 0
+            while True:
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                try:
+                    await job[0](self.bot)
+                    self.sent += 1
+                    break
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    bucket.block(delay)
+                    self.retried += 1
+                    logger.warning(f"Flood limit for chat {chat_id}, retrying in {delay}s")
+                    return delay
+                except (Forbidden, BadRequest) as e:
+                    # Blocked bot, deleted chat, malformed message: retrying will not help
+                    self.failed += 1
+                    logger.error(f"Dropping notification to {chat_id}: {e}")
+                    return None
+                except NetworkError as e:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        self.failed += 1
+                        logger.error(f"Dropping notification to {chat_id} after {attempt} attempts: {e}")
+                        return None
+                    self.retried += 1
+                    await asyncio.sleep(random.uniform(0, min(30, 2 ** attempt)))
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Error sending notification to {chat_id}: {e}")
+                    return None
+            job.pop(0)
+        return None
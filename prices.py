@@ -0,0 +1,444 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+import httpx
+from metrics import Counter, Histogram
+from simulator import PriceSimulator
+
+logger = logging.getLogger(__name__)
+
+PRICE_FETCH_SECONDS = Histogram(
+    "price_fetch_seconds", "Time taken by a provider to price a batch, per symbol in the batch",
+    ["provider", "symbol"]
+)
+PRICE_FETCH_ERRORS = Counter("price_fetch_errors_total", "Failed provider requests", ["provider"])
+PRICE_CACHE_REQUESTS = Counter("price_cache_requests_total", "Price cache lookups by result", ["result"])
+
+# Status codes worth retrying: rate limiting and upstream failures
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+# Async JSON fetcher for price APIs. All requests share one pooled keep-alive
+# client, are retried with jittered exponential backoff, and concurrent
+# requests for the same URL and parameters share a single in-flight call.
+# A Retry-After from the server is waited out in full; a request told to wait
+# longer than max_retry_after seconds fails instead.
+class PriceFetcher:
+    def __init__(self, timeout=5.0, retries=3, backoff=0.5, max_backoff=8.0, max_retry_after=30.0,
+                 max_connections=20, keepalive_expiry=30.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._client = None
+        self._inflight = {}
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                ),
+                headers={"Accept": "application/json"}
+            )
+        return self._client
+
+    # Fetch and decode a JSON document, joining an identical request if one is already running
+    async def get_json(self, url, params=None, headers=None):
+        key = (url, tuple(sorted((params or {}).items())))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._get_with_retries(url, params, headers))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # Shield the shared request so one cancelled caller does not cancel it for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved when every caller has gone away
+        if not task.cancelled():
+            task.exception()
+
+    async def _get_with_retries(self, url, params, headers):
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = await self.client.get(url, params=params, headers=headers)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                retry_after = response.headers.get("Retry-After")
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                error = repr(e)
+
+            if attempt >= self.retries:
+                raise PriceFetchError(f"{url} failed after {attempt + 1} attempts: {error}")
+
+            delay = self._backoff_delay(attempt, retry_after)
+            if retry_after and delay > self.max_retry_after:
+                raise PriceFetchError(f"{url} failed ({error}) and asks to retry after {delay:.0f}s")
+            logger.warning(f"Price request to {url} failed ({error}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # Full-jitter backoff, unless the server told us how long to wait, in
+    # seconds or as an HTTP date
+    def _backoff_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class PriceFetchError(Exception):
+    pass
+
+
+# Shared price snapshots per symbol. A snapshot younger than its symbol's
+# freshness window is served from memory; an older one is still served for up
+# to stale_ttl seconds while a single background refresh replaces it.
+class PriceCache:
+    def __init__(self, ttl=30.0, stale_ttl=300.0, ttls=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.ttls = dict(ttls or {})
+        # symbol -> (price, monotonic time it was fetched)
+        self._entries = {}
+        self._pending = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def ttl_for(self, symbol):
+        return self.ttls.get(symbol, self.ttl)
+
+    # Cached price regardless of its age, or None
+    def peek(self, symbol):
+        entry = self._entries.get(symbol)
+        return entry[0] if entry else None
+
+    def set(self, symbol, price):
+        self._entries[symbol] = (price, time.monotonic())
+
+    # symbol -> (price, Unix time fetched), to carry the cache over a restart
+    def dump(self):
+        offset = time.time() - time.monotonic()
+        return {symbol: (price, fetched + offset) for symbol, (price, fetched) in self._entries.items()}
+
+    # Take prices from dump() without overwriting fresher ones; they keep their age
+    def restore(self, prices):
+        offset = time.time() - time.monotonic()
+        for symbol, (price, fetched_at) in prices.items():
+            if symbol not in self._entries:
+                self._entries[symbol] = (price, fetched_at - offset)
+
+    async def get(self, symbol, loader):
+        entry = self._entries.get(symbol)
+        if entry is not None:
+            age = time.monotonic() - entry[1]
+            if age < self.ttl_for(symbol):
+                self.hits += 1
+                PRICE_CACHE_REQUESTS.labels("hit").inc()
+                return entry[0]
+            if age < self.ttl_for(symbol) + self.stale_ttl:
+                self.stale_hits += 1
+                PRICE_CACHE_REQUESTS.labels("stale").inc()
+                self._start_refresh(symbol, loader)
+                return entry[0]
+
+        self.misses += 1
+        PRICE_CACHE_REQUESTS.labels("miss").inc()
+        return await self.refresh(symbol, loader)
+
+    # Load a new snapshot now, joining a refresh that is already running
+    async def refresh(self, symbol, loader):
+        return await asyncio.shield(self._start_refresh(symbol, loader))
+
+    def _start_refresh(self, symbol, loader):
+        task = self._pending.get(symbol)
+        if task is None:
+            task = asyncio.ensure_future(self._load(symbol, loader))
+            self._pending[symbol] = task
+            task.add_done_callback(lambda done: self._pending.pop(symbol, None))
+        return task
+
+    async def _load(self, symbol, loader):
+        try:
+            price = await loader(symbol)
+        except Exception as e:
+            logger.error(f"Error refreshing {symbol}: {e}")
+            price = None
+
+        if price is None:
+            self.errors += 1
+        else:
+            self.set(symbol, price)
+        return price
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "symbols": len(self._entries)
+        }
+
+    # Load several symbols with one batched loader call and store whatever came back
+    async def refresh_many(self, symbols, loader):
+        try:
+            prices = await loader(symbols)
+        except Exception as e:
+            logger.error(f"Error refreshing {', '.join(symbols)}: {e}")
+            prices = {}
+
+        for symbol in symbols:
+            price = prices.get(symbol)
+            if price is None:
+                self.errors += 1
+            else:
+                self.set(symbol, price)
+        return prices
+
+
+# Base class for price sources. Each provider prices many symbols per call;
+# source is whatever the provider needs to know about a symbol (an API id,
+# a currency code, simulation parameters).
+class PriceProvider:
+    name = None
+
+    def __init__(self):
+        self.sources = {}
+
+    def add_symbol(self, symbol, source):
+        self.sources[symbol] = source
+
+    # Return {symbol: price} for the requested symbols it could price
+    async def fetch_many(self, symbols):
+        raise NotImplementedError
+
+
+# CoinGecko: every coin in one simple/price request. Source is "coin_id/vs_currency".
+class CoinGeckoProvider(PriceProvider):
+    name = "coingecko"
+
+    def __init__(self, fetcher, base_url="https://api.coingecko.com/api/v3", api_key=""):
+        super().__init__()
+        self.fetcher = fetcher
+        self.base_url = base_url
+        self.api_key = api_key
+
+    async def fetch_many(self, symbols):
+        pairs = {symbol: self.sources[symbol].split("/") for symbol in symbols}
+        headers = {"x-cg-demo-api-key": self.api_key} if self.api_key else None
+        data = await self.fetcher.get_json(
+            f"{self.base_url}/simple/price",
+            params={
+                "ids": ",".join(sorted({coin for coin, _ in pairs.values()})),
+                "vs_currencies": ",".join(sorted({vs for _, vs in pairs.values()}))
+            },
+            headers=headers
+        )
+
+        prices = {}
+        for symbol, (coin, vs) in pairs.items():
+            price = data.get(coin, {}).get(vs)
+            if price:
+                prices[symbol] = price
+        return prices
+
+
+# metals-api.com: every metal in one latest-rates request. Source is the metal code, e.g. "XAU".
+class MetalsApiProvider(PriceProvider):
+    name = "metals"
+
+    def __init__(self, fetcher, api_key, base_url="https://metals-api.com/api"):
+        super().__init__()
+        self.fetcher = fetcher
+        self.api_key = api_key
+        self.base_url = base_url
+
+    async def fetch_many(self, symbols):
+        codes = {symbol: self.sources[symbol] for symbol in symbols}
+        data = await self.fetcher.get_json(
+            f"{self.base_url}/latest",
+            params={
+                "access_key": self.api_key,
+                "base": "USD",
+                "symbols": ",".join(sorted(set(codes.values())))
+            }
+        )
+        if not data.get("success", True):
+            raise PriceFetchError(f"metals-api error: {data.get('error')}")
+
+        rates = data.get("rates", {})
+        prices = {}
+        for symbol, code in codes.items():
+            # Rates are metal per dollar; some plans also return the inverse directly
+            if rates.get(f"USD{code}"):
+                prices[symbol] = rates[f"USD{code}"]
+            elif rates.get(code):
+                prices[symbol] = 1 / rates[code]
+        return prices
+
+
+# exchangerate-api.com: one request per base currency covers every quote
+# currency. Source is "BASE/QUOTE", e.g. "GBP/JPY".
+class ExchangeRateProvider(PriceProvider):
+    name = "exchangerate"
+
+    def __init__(self, fetcher, api_key, base_url="https://v6.exchangerate-api.com/v6"):
+        super().__init__()
+        self.fetcher = fetcher
+        self.api_key = api_key
+        self.base_url = base_url
+
+    async def fetch_many(self, symbols):
+        by_base = {}
+        for symbol in symbols:
+            base, quote = self.sources[symbol].split("/")
+            by_base.setdefault(base, []).append((symbol, quote))
+
+        responses = await asyncio.gather(*[
+            self.fetcher.get_json(f"{self.base_url}/{self.api_key}/latest/{base}")
+            for base in by_base
+        ])
+
+        prices = {}
+        for pairs, data in zip(by_base.values(), responses):
+            rates = data.get("conversion_rates", {})
+            for symbol, quote in pairs:
+                if rates.get(quote):
+                    prices[symbol] = rates[quote]
+        return prices
+
+
+# Random-walk simulator for symbols without a real feed. Source is a dict
+# with the start price, the maximum move per step in percent, and the
+# low/high bounds the price is kept within. Steps come from a seeded
+# PriceSimulator, generated `block` at a time; each fetch takes the next step
+# of every symbol, so a seed reproduces the same prices for the same calls.
+class SimulatedProvider(PriceProvider):
+    name = "simulator"
+
+    def __init__(self, seed=None, block=256):
+        super().__init__()
+        self.simulator = PriceSimulator(seed)
+        self.block = block
+        self._steps = None
+        self._next = 0
+
+    def add_symbol(self, symbol, source):
+        super().add_symbol(symbol, source)
+        self.simulator.add_symbol(symbol, source)
+        # Steps generated so far lack the new symbol: continue from the last
+        # price handed out
+        if self._steps is not None and self._next:
+            self.simulator.prices[:-1] = self._steps[self._next - 1]
+        self._steps = None
+
+    async def fetch_many(self, symbols):
+        if self._steps is None or self._next == len(self._steps):
+            self._steps = self.simulator.generate(self.block)
+            self._next = 0
+        step = self._steps[self._next]
+        self._next += 1
+
+        columns = {symbol: i for i, symbol in enumerate(self.simulator.symbols)}
+        return {symbol: float(step[columns[symbol]]) for symbol in symbols if symbol in columns}
+
+
+# Routes each symbol to the registered providers configured for it and
+# fetches a batch of symbols with one call per provider. Symbols a provider
+# fails to price fall through to their next provider.
+class PriceProviderRegistry:
+    def __init__(self):
+        self.providers = {}
+        self.routes = {}
+
+    def register(self, provider):
+        self.providers[provider.name] = provider
+
+    # sources maps provider name -> source, in order of preference
+    def route(self, symbol, sources):
+        chain = []
+        for name, source in sources.items():
+            if name in self.providers:
+                self.providers[name].add_symbol(symbol, source)
+                chain.append(self.providers[name])
+        if not chain:
+            raise ValueError(f"No registered provider for {symbol}: {', '.join(sources)}")
+        self.routes[symbol] = chain
+
+    # Preferred provider for a symbol
+    def provider_for(self, symbol):
+        chain = self.routes.get(symbol)
+        return chain[0] if chain else None
+
+    async def fetch_many(self, symbols):
+        prices = {}
+        pending = {}
+        for symbol in symbols:
+            if symbol in self.routes:
+                pending[symbol] = 0
+            else:
+                logger.warning(f"No price provider for {symbol}")
+
+        while pending:
+            by_provider = {}
+            for symbol, position in pending.items():
+                by_provider.setdefault(self.routes[symbol][position], []).append(symbol)
+
+            results = await asyncio.gather(
+                *[self._timed_fetch(provider, batch) for provider, batch in by_provider.items()],
+                return_exceptions=True
+            )
+
+            for (provider, batch), result in zip(by_provider.items(), results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error fetching {', '.join(batch)} from {provider.name}: {result}")
+                    PRICE_FETCH_ERRORS.labels(provider.name).inc()
+                    result = {}
+                prices.update(result)
+
+            # Move symbols that are still missing on to their next provider
+            pending = {
+                symbol: position + 1
+                for symbol, position in pending.items()
+                if symbol not in prices and position + 1 < len(self.routes[symbol])
+            }
+        return prices
+
+    async def _timed_fetch(self, provider, batch):
+        started = time.perf_counter()
+        try:
+            return await provider.fetch_many(batch)
+        finally:
+            elapsed = time.perf_counter() - started
+            for symbol in batch:
+                PRICE_FETCH_SECONDS.labels(provider.name, symbol).observe(elapsed)
@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing.connection import Client, Connection, answer_challenge, deliver_challenge
+from alerts import Alert, AlertIndex
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+SHARD_RESTARTS = Counter("alert_shard_restarts_total", "Alert shard processes restarted after a failure", ["shard"])
+
+# Seconds a shard process gets to start and connect
+START_TIMEOUT = 30.0
+# Messages queued for a shard before it counts as stuck and is restarted
+MAX_BACKLOG = 100_000
+# Seconds before restarting a failed shard, doubled for every failure in a
+# row up to MAX_RESTART_DELAY; a shard that ran for RESTART_RESET seconds
+# starts over from RESTART_DELAY
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+RESTART_RESET = 300.0
+
+
+# Shard that owns a user, stable across processes and restarts
+def shard_for(user_id, shards):
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+# One run of a shard process. Messages for it wait in `outbox` and are sent by
+# a writer thread, so a shard that stops reading never blocks the event loop.
+# Until a restarted shard is ready, consecutive ticks are merged per symbol in
+# `missed` as symbol -> [price, low, high] rather than queued.
+class Shard:
+    __slots__ = ("id", "process", "conn", "outbox", "missed", "ready", "failures", "connected_at", "failed")
+
+    def __init__(self, shard_id, failures=0):
+        self.id = shard_id
+        self.process = None
+        self.conn = None
+        self.outbox = queue.Queue(MAX_BACKLOG)
+        self.missed = {}
+        self.ready = False
+        self.failures = failures
+        self.connected_at = None
+        self.failed = False
+
+
+# Price-crossing evaluation split across worker processes. Users are assigned
+# to shards by hashing their id; each shard process keeps an AlertIndex of
+# its users' price-crossing alerts. The bot process stays the single owner of
+# the price feed, of all sending and of the alerts themselves: the AlertBook
+# with every Alert, and the percent-move and trailing indexes, stay in the
+# bot process, so sharding spreads only the crossing checks, not the alert
+# state. The bot broadcasts every tick to the shards, and each shard answers
+# with the alerts it found crossed, which are passed to
+# on_triggered(symbol, price, [alert_id, ...]) on the event loop.
+#
+# A shard that dies or stops reading is restarted and gets its users' alerts
+# again from load_alerts(), which returns the crossing alerts in the index.
+# Ticks it had not evaluated when it failed are lost.
+#
+# Offers the parts of the AlertIndex interface an AlertBook uses to keep the
+# index in sync (rebuild, add, remove, symbols, count, len, last_prices).
+class ShardPool:
+    def __init__(self, shards, on_triggered, load_alerts):
+        self.shards = shards
+        self.on_triggered = on_triggered
+        self.load_alerts = load_alerts
+        self.last_prices = {}
+        self._counts = {}
+        # Alerts from rebuild(), sent to the shards once they are running
+        self._batches = [[] for _ in range(shards)]
+        # shard id -> its current Shard
+        self._shards = []
+        self._socket = None
+        self._address = None
+        self._authkey = None
+        self._tmpdir = None
+        self._loop = None
+        # Restarts accept on the listening socket one at a time
+        self._accept_lock = threading.Lock()
+        self._stopping = False
+        # shard id -> futures of flush() waiting for that shard
+        self._flushes = [[] for _ in range(shards)]
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    def count(self, symbol):
+        return self._counts.get(symbol, 0)
+
+    def symbols(self):
+        return [symbol for symbol, count in self._counts.items() if count]
+
+    def rebuild(self, alerts):
+        self._counts = {}
+        self._batches = [[] for _ in range(self.shards)]
+        for alert in alerts:
+            self._batches[shard_for(alert.user_id, self.shards)].append(
+                (alert.id, alert.user_id, alert.symbol, alert.target_price)
+            )
+            self._counts[alert.symbol] = self._counts.get(alert.symbol, 0) + 1
+
+    # Shards build their own indexes from the alerts
+    def restore(self, alerts, columns):
+        return False
+
+    # Spawn the shard processes and send them the alerts given to rebuild
+    # (blocking). Raises RuntimeError if a shard exits or does not connect
+    # within START_TIMEOUT seconds.
+    def start(self, loop):
+        self._loop = loop
+        self._tmpdir = tempfile.mkdtemp(prefix="signal-shards-")
+        self._address = os.path.join(self._tmpdir, "shards.sock")
+        self._authkey = os.urandom(32)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._address)
+        self._socket.listen()
+        # Wake up regularly to check on the processes instead of waiting forever
+        self._socket.settimeout(0.5)
+
+        self._shards = [Shard(shard_id) for shard_id in range(self.shards)]
+        try:
+            for shard in self._shards:
+                self._spawn(shard)
+            self._accept(self._shards)
+        except BaseException:
+            for shard in self._shards:
+                if shard.conn is not None:
+                    shard.conn.close()
+                if shard.process is not None:
+                    shard.process.kill()
+            self._socket.close()
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            raise
+
+        for shard, batch in zip(self._shards, self._batches):
+            shard.outbox.put_nowait(("add_many", batch))
+            shard.ready = True
+            self._run(shard)
+        self._batches = None
+        logger.info(f"Started {self.shards} alert shards with {len(self)} alerts")
+
+    def _spawn(self, shard):
+        shard.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--shard", str(shard.id), "--address", self._address],
+            env=dict(os.environ, SHARD_AUTHKEY=self._authkey.hex())
+        )
+
+    # Wait for `shards` to connect, in any order, and introduce themselves
+    def _accept(self, shards):
+        waiting = {shard.id: shard for shard in shards}
+        deadline = time.monotonic() + START_TIMEOUT
+        with self._accept_lock:
+            while waiting:
+                try:
+                    sock, _ = self._socket.accept()
+                except TimeoutError:
+                    for shard in waiting.values():
+                        if shard.process.poll() is not None:
+                            raise RuntimeError(
+                                f"Alert shard {shard.id} exited with code {shard.process.returncode} while starting"
+                            ) from None
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(
+                            f"Alert shards {sorted(waiting)} did not connect within {START_TIMEOUT:.0f}s"
+                        ) from None
+                    continue
+                sock.settimeout(None)
+                conn = Connection(sock.detach())
+                try:
+                    deliver_challenge(conn, self._authkey)
+                    answer_challenge(conn, self._authkey)
+                    shard = waiting.pop(conn.recv())
+                except Exception as e:
+                    logger.warning(f"Rejected a connection to the alert shard socket: {e!r}")
+                    conn.close()
+                    continue
+                shard.conn = conn
+                shard.connected_at = time.monotonic()
+
+    # Start the reader and writer threads of a connected shard
+    def _run(self, shard):
+        for target, role in ((self._read, "reader"), (self._write, "writer")):
+            threading.Thread(target=target, args=(shard,), name=f"shard-{shard.id}-{role}", daemon=True).start()
+
+    def _read(self, shard):
+        while True:
+            try:
+                message = shard.conn.recv()
+            except (EOFError, OSError) as e:
+                shard.conn.close()
+                self._loop.call_soon_threadsafe(self._shard_failed, shard, str(e) or type(e).__name__)
+                return
+            if message[0] == "triggered":
+                self._loop.call_soon_threadsafe(self.on_triggered, *message[1:])
+            elif message[0] == "flushed":
+                self._loop.call_soon_threadsafe(self._flushed, shard)
+
+    def _write(self, shard):
+        while True:
+            message = shard.outbox.get()
+            if message is None:
+                return
+            try:
+                shard.conn.send(message)
+            except OSError as e:
+                self._loop.call_soon_threadsafe(self._shard_failed, shard, str(e) or type(e).__name__)
+                return
+
+    # A shard can no longer be reached: stop it and start a new process for
+    # the same users, which gets their alerts before any later message
+    def _shard_failed(self, shard, error):
+        if shard.failed or self._stopping:
+            return
+        shard.failed = True
+        code = shard.process.poll() if shard.process is not None else None
+        logger.error(f"Alert shard {shard.id} failed ({error}, exit code {code}), restarting it")
+        for future in self._flushes[shard.id]:
+            if not future.done():
+                future.set_result(None)
+        self._flushes[shard.id] = []
+        self._close(shard)
+
+        failures = 0 if shard.connected_at and time.monotonic() - shard.connected_at > RESTART_RESET else shard.failures
+        replacement = self._shards[shard.id] = Shard(shard.id, failures + 1)
+        replacement.outbox.put_nowait(("add_many", [
+            (alert.id, alert.user_id, alert.symbol, alert.target_price)
+            for alert in self.load_alerts() if shard_for(alert.user_id, self.shards) == shard.id
+        ]))
+        delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** failures)
+        threading.Thread(
+            target=self._restart, args=(replacement, delay), name=f"shard-{shard.id}-restart", daemon=True
+        ).start()
+
+    def _restart(self, shard, delay):
+        time.sleep(delay)
+        if self._stopping:
+            return
+        try:
+            self._spawn(shard)
+            self._accept([shard])
+        except Exception as e:
+            self._loop.call_soon_threadsafe(self._shard_failed, shard, e)
+            return
+        self._loop.call_soon_threadsafe(self._restarted, shard)
+
+    # On the loop: pass on the ticks merged during the restart, then go live
+    def _restarted(self, shard):
+        if shard.failed:
+            return
+        self._put_missed(shard)
+        shard.ready = True
+        SHARD_RESTARTS.labels(str(shard.id)).inc()
+        logger.info(f"Alert shard {shard.id} restarted")
+        self._run(shard)
+
+    def _put_missed(self, shard):
+        for symbol, (price, low, high) in shard.missed.items():
+            shard.outbox.put_nowait(("tick", symbol, price, low, high))
+        shard.missed = {}
+
+    # Stop a failed shard's writer and process; its reader then sees the
+    # connection end and closes it
+    def _close(self, shard):
+        # The queue may be full if the shard stopped reading
+        try:
+            shard.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        if shard.process is not None and shard.process.poll() is None:
+            shard.process.kill()
+
+    # Queue a message for one shard. While it restarts, ticks are merged and
+    # other messages keep their place after the ticks before them.
+    def _send_to(self, shard_id, message):
+        shard = self._shards[shard_id]
+        if shard.failed:
+            return False
+        try:
+            if not shard.ready:
+                if message[0] == "tick":
+                    _, symbol, price, low, high = message
+                    missed = shard.missed.get(symbol)
+                    shard.missed[symbol] = [price, min(low, missed[1]), max(high, missed[2])] if missed else [price, low, high]
+                    return True
+                self._put_missed(shard)
+            shard.outbox.put_nowait(message)
+            return True
+        except queue.Full:
+            self._shard_failed(shard, f"stopped reading, {MAX_BACKLOG} messages waiting")
+            return False
+
+    def add(self, alert):
+        self._counts[alert.symbol] = self._counts.get(alert.symbol, 0) + 1
+        self._send(alert.user_id, ("add", alert.id, alert.user_id, alert.symbol, alert.target_price))
+
+    def remove(self, alert):
+        self._counts[alert.symbol] = max(0, self._counts.get(alert.symbol, 0) - 1)
+        self._send(alert.user_id, ("remove", alert.id))
+
+    # Changes made before start() are applied to the initial batches
+    def _send(self, user_id, message):
+        shard_id = shard_for(user_id, self.shards)
+        if self._batches is None:
+            self._send_to(shard_id, message)
+        elif message[0] == "add":
+            self._batches[shard_id].append(message[1:])
+        else:
+            self._batches[shard_id] = [entry for entry in self._batches[shard_id] if entry[0] != message[1]]
+
+    # Broadcast a tick; shards report crossed alerts through on_triggered
+    def evaluate(self, symbol, current_price, low, high):
+        for shard_id in range(len(self._shards)):
+            self._send_to(shard_id, ("tick", symbol, current_price, low, high))
+
+    # Wait until every shard has handled everything sent to it so far and its
+    # triggers have been passed to on_triggered (used by replays). A shard
+    # that fails meanwhile is not waited for.
+    async def flush(self):
+        futures = []
+        for shard_id in range(len(self._shards)):
+            future = self._loop.create_future()
+            self._flushes[shard_id].append(future)
+            if self._send_to(shard_id, ("flush",)):
+                futures.append(future)
+            else:
+                self._flushes[shard_id].remove(future)
+        await asyncio.gather(*futures)
+
+    def _flushed(self, shard):
+        if shard is self._shards[shard.id] and self._flushes[shard.id]:
+            future = self._flushes[shard.id].pop(0)
+            if not future.done():
+                future.set_result(None)
+
+    # Stop the shard processes (blocking)
+    def stop(self):
+        self._stopping = True
+        for shard in self._shards:
+            try:
+                shard.outbox.put_nowait(("stop",))
+                shard.outbox.put_nowait(None)
+            except queue.Full:
+                logger.warning(f"Alert shard {shard.id} was not reading when stopping")
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            try:
+                shard.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                shard.process.kill()
+            if shard.conn is not None:
+                shard.conn.close()
+        if self._socket is not None:
+            self._socket.close()
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+# Shard process main loop
+def run_shard(shard_id, address, authkey):
+    conn = Client(address, family="AF_UNIX", authkey=authkey)
+    conn.send(shard_id)
+
+    index = AlertIndex()
+    # alert id -> Alert, for removal by id
+    alerts = {}
+
+    def add(alert_id, user_id, symbol, target_price):
+        alert = alerts[alert_id] = Alert(alert_id, user_id, symbol, target_price, 0.0)
+        index.add(alert)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        kind = message[0]
+        if kind == "tick":
+            _, symbol, current_price, low, high = message
+            crossed = index.pop_crossed(symbol, low, high)
+            if crossed:
+                for alert_id in crossed:
+                    del alerts[alert_id]
+                conn.send(("triggered", symbol, current_price, crossed))
+        elif kind == "add":
+            add(*message[1:])
+        elif kind == "add_many":
+            for entry in message[1]:
+                add(*entry)
+        elif kind == "remove":
+            alert = alerts.pop(message[1], None)
+            if alert is not None:
+                index.remove(alert)
+        elif kind == "flush":
+            conn.send(("flushed",))
+        elif kind == "stop":
+            break
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Alert evaluation shard (started by bot.py)")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--address", required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format=f'%(asctime)s - shard {args.shard} - %(levelname)s - %(message)s', level=logging.INFO)
+    run_shard(args.shard, args.address, bytes.fromhex(os.environ["SHARD_AUTHKEY"]))
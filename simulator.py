@@ -0,0 +1,71 @@
+import numpy as np
+
+# Default percent volatility per step for symbols configured without one
+DEFAULT_VOLATILITY = 0.1
+
+
+# Seeded random-walk price generator for many symbols at once. Each step
+# moves every price by a uniform random percent within +-volatility; prices
+# with a low/high range are reflected back into it rather than clamped, so
+# they never stick to a bound. A batch of steps is generated with a few
+# NumPy operations over a (steps, symbols) array, and successive batches
+# continue from where the previous one stopped, so one seed gives the same
+# series (up to rounding) however it is split into batches.
+class PriceSimulator:
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.symbols = []
+        self.prices = np.empty(0)
+        self.volatility = np.empty(0)
+        self.low = np.empty(0)
+        self.high = np.empty(0)
+
+    # source: {"start", "volatility", optional "low" and "high"}
+    def add_symbol(self, symbol, source):
+        if symbol in self.symbols:
+            return
+        self.symbols.append(symbol)
+        self.prices = np.append(self.prices, float(source["start"]))
+        self.volatility = np.append(self.volatility, float(source.get("volatility", DEFAULT_VOLATILITY)))
+        self.low = np.append(self.low, float(source.get("low", 0.0)))
+        self.high = np.append(self.high, float(source.get("high", np.inf)))
+
+    # The next `steps` prices of every symbol as a (steps, symbols) array, in
+    # the order the symbols were added
+    def generate(self, steps):
+        changes = self.rng.uniform(-1.0, 1.0, size=(steps, len(self.symbols))) * (self.volatility / 100)
+        paths = self.prices * np.exp(np.cumsum(np.log1p(changes), axis=0))
+        paths = reflect(paths, self.low, self.high)
+        if steps:
+            self.prices = paths[-1].copy()
+        return paths
+
+    # Timestamps and prices of `steps` ticks `interval` seconds apart,
+    # starting one interval after `start`
+    def ticks(self, steps, start=0.0, interval=1.0):
+        timestamps = start + interval * np.arange(1, steps + 1)
+        return timestamps, self.generate(steps)
+
+
+# Fold values into [low, high] as a reflecting boundary would; an infinite
+# high reflects at low only
+def reflect(values, low, high):
+    width = high - low
+    bounded = np.isfinite(width)
+    folded = np.abs(values - low)
+    period = np.where(bounded, 2 * width, np.inf)
+    folded = np.where(bounded, np.mod(folded, period), folded)
+    folded = np.where(bounded & (folded > width), period - folded, folded)
+    return low + folded
+
+
+# Save generated or recorded ticks for later replays: timestamps (n,),
+# symbols (m,) and prices (n, m)
+def save_ticks(path, timestamps, symbols, prices):
+    np.savez_compressed(path, timestamps=timestamps, symbols=np.array(symbols), prices=prices)
+
+
+def load_ticks(path):
+    with np.load(path) as data:
+        return data["timestamps"], [str(symbol) for symbol in data["symbols"]], data["prices"]
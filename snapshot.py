@@ -0,0 +1,87 @@
+import logging
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the arrays below change meaning
+VERSION = 1
+
+
+# Evaluator state as of `saved_at` (Unix time): the last price the evaluator
+# saw per symbol, the price cache as symbol -> (price, Unix time fetched),
+# and the price-crossing index as symbol -> (targets, ids), the raw bytes of
+# its float64 and int64 columns
+class Snapshot:
+    __slots__ = ("saved_at", "last_prices", "cached_prices", "index")
+
+    def __init__(self, saved_at, last_prices, cached_prices, index):
+        self.saved_at = saved_at
+        self.last_prices = last_prices
+        self.cached_prices = cached_prices
+        self.index = index
+
+
+# Write a snapshot as one uncompressed .npz of flat arrays: a value per symbol
+# (NaN where there is none) and the index columns of every symbol back to
+# back, split by offsets. Loading is a few array reads, with no per-alert
+# parsing or sorting. The file is replaced atomically.
+def save_snapshot(path, snapshot):
+    symbols = sorted(set(snapshot.last_prices) | set(snapshot.cached_prices) | set(snapshot.index))
+    nan = float("nan")
+    columns = [snapshot.index.get(symbol, (b"", b"")) for symbol in symbols]
+    targets = [np.frombuffer(column[0], dtype=np.float64) for column in columns]
+    ids = [np.frombuffer(column[1], dtype=np.int64) for column in columns]
+    arrays = {
+        "version": np.array(VERSION),
+        "saved_at": np.array(snapshot.saved_at),
+        "symbols": np.array(symbols, dtype=str),
+        "last_prices": np.array([snapshot.last_prices.get(symbol, nan) for symbol in symbols], dtype=np.float64),
+        "cached_prices": np.array([snapshot.cached_prices.get(symbol, (nan, nan))[0] for symbol in symbols], dtype=np.float64),
+        "cached_at": np.array([snapshot.cached_prices.get(symbol, (nan, nan))[1] for symbol in symbols], dtype=np.float64),
+        "offsets": np.cumsum([0] + [len(column) for column in targets], dtype=np.int64),
+        "targets": np.concatenate(targets or [np.empty(0)]),
+        "ids": np.concatenate(ids or [np.empty(0, dtype=np.int64)])
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# The snapshot in `path`, or None if there is none or it cannot be read
+def load_snapshot(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != VERSION:
+                logger.warning(f"Ignoring evaluator snapshot {path} of another version")
+                return None
+            symbols = [str(symbol) for symbol in data["symbols"]]
+            last_prices, cached_prices, cached_at = data["last_prices"], data["cached_prices"], data["cached_at"]
+            offsets, targets, ids = data["offsets"], data["targets"], data["ids"]
+            return Snapshot(
+                float(data["saved_at"]),
+                {symbol: float(price) for symbol, price in zip(symbols, last_prices) if not np.isnan(price)},
+                {
+                    symbol: (float(price), float(at))
+                    for symbol, price, at in zip(symbols, cached_prices, cached_at) if not np.isnan(price)
+                },
+                {
+                    symbol: (targets[start:end].tobytes(), ids[start:end].tobytes())
+                    for symbol, start, end in zip(symbols, offsets[:-1].tolist(), offsets[1:].tolist()) if end > start
+                }
+            )
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable evaluator snapshot {path}: {e}")
+        return None
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from alerts import alerts_from_json, alerts_to_json, format_created_at, make_alert, parse_created_at
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = Histogram("persistence_flush_seconds", "Time to write a batch of changes to the store")
+FLUSH_ERRORS = Counter("persistence_flush_errors_total", "Failed flushes")
+FLUSH_CHANGES = Counter("persistence_changes_flushed_total", "Coalesced changes written to the store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    target_price REAL NOT NULL,
+    created_at TEXT NOT NULL,
+    last_price REAL,
+    type TEXT NOT NULL DEFAULT 'cross',
+    percent REAL,
+    window_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS alerts_user ON alerts (user_id);
+CREATE INDEX IF NOT EXISTS alerts_symbol_target ON alerts (symbol, target_price);
+
+CREATE TABLE IF NOT EXISTS initial_prices (
+    user_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    price REAL NOT NULL,
+    PRIMARY KEY (user_id, symbol)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Columns added to the alerts table after its first release, with their
+# definitions, for databases created before them
+ALERT_COLUMNS = {
+    "type": "TEXT NOT NULL DEFAULT 'cross'",
+    "percent": "REAL",
+    "window_seconds": "REAL"
+}
+
+ALERT_INSERT = (
+    "INSERT OR REPLACE INTO alerts (id, user_id, symbol, target_price, created_at, last_price, type, percent, window_seconds) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+# SQLite (WAL mode) storage for alerts and initial prices. The connection
+# lives on a single worker thread, so every query runs off the event loop and
+# in order; the async methods just hand work to that thread.
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._next_id = 1
+
+    def _call(self, fn, *args):
+        return self._executor.submit(fn, *args).result()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # Open the database and create the schema (blocking, used at startup)
+    def open(self):
+        self._call(self._open)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(alerts)")}
+        for column, definition in ALERT_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE alerts ADD COLUMN {column} {definition}")
+        (max_id,) = self._conn.execute("SELECT MAX(id) FROM alerts").fetchone()
+        self._next_id = (max_id or 0) + 1
+
+    # Alert ids are handed out in memory so callers know them before the row is written
+    def next_alert_id(self):
+        alert_id = self._next_id
+        self._next_id += 1
+        return alert_id
+
+    # Import user_alerts.json and initial_prices.json once (blocking, used at startup)
+    def migrate_from_json(self, alerts_file, prices_file):
+        return self._call(self._migrate_from_json, alerts_file, prices_file)
+
+    def _migrate_from_json(self, alerts_file, prices_file):
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return False
+
+        alert_rows = []
+        if os.path.exists(alerts_file):
+            with open(alerts_file, 'r') as f:
+                for user_id, user_data in json.load(f).items():
+                    for symbol, alerts in user_data.items():
+                        for alert in alerts:
+                            alert_rows.append((
+                                self.next_alert_id(), user_id, symbol, alert["target_price"],
+                                alert["created_at"], alert.get("last_price"),
+                                alert.get("type", "cross"), alert.get("percent"), alert.get("window")
+                            ))
+
+        price_rows = []
+        if os.path.exists(prices_file):
+            with open(prices_file, 'r') as f:
+                for user_id, prices in json.load(f).items():
+                    for symbol, price in prices.items():
+                        price_rows.append((user_id, symbol, price))
+
+        with self._conn:
+            self._conn.executemany(ALERT_INSERT, alert_rows)
+            self._conn.executemany("INSERT OR REPLACE INTO initial_prices VALUES (?, ?, ?)", price_rows)
+            self._conn.execute("INSERT INTO meta VALUES ('json_migrated', datetime('now'))")
+
+        logger.info(f"Migrated {len(alert_rows)} alerts and {len(price_rows)} initial prices from JSON")
+        return True
+
+    # Load all alerts and the initial prices (blocking, used at startup)
+    def load(self):
+        return self._call(self._load)
+
+    def _load(self):
+        rows = self._conn.execute(
+            "SELECT id, user_id, symbol, target_price, created_at, type, percent, window_seconds FROM alerts ORDER BY id"
+        )
+        alerts = [
+            make_alert(
+                kind, alert_id, int(user_id), symbol, target_price, parse_created_at(created_at),
+                percent=percent, window=window
+            )
+            for alert_id, user_id, symbol, target_price, created_at, kind, percent, window in rows
+        ]
+
+        initial_prices = {}
+        for user_id, symbol, price in self._conn.execute("SELECT user_id, symbol, price FROM initial_prices"):
+            initial_prices.setdefault(user_id, {})[symbol] = price
+
+        return alerts, initial_prices
+
+    # Apply a batch of WriteBehind operations in one transaction
+    async def apply(self, ops):
+        await self._run(self._apply, ops)
+
+    def _apply(self, ops):
+        with self._conn:
+            for op in ops:
+                if op[0] == "add_alert":
+                    alert = op[1]
+                    self._conn.execute(ALERT_INSERT, (
+                        alert.id, str(alert.user_id), alert.symbol, alert.target_price, format_created_at(alert.created_at),
+                        None, alert.kind, getattr(alert, "percent", None), getattr(alert, "window", None)
+                    ))
+                elif op[0] == "delete_alert":
+                    self._conn.execute("DELETE FROM alerts WHERE id = ?", (op[1],))
+                elif op[0] == "initial_price":
+                    self._conn.execute("INSERT OR REPLACE INTO initial_prices VALUES (?, ?, ?)", op[1:])
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# Flat-file storage: user_alerts.json and initial_prices.json, rewritten as
+# whole snapshots. Each snapshot goes to a temporary file that is renamed over
+# the old one, so a crash mid-write never leaves a truncated file behind.
+class JsonStore:
+    def __init__(self, alerts_file, prices_file):
+        self.alerts_file = alerts_file
+        self.prices_file = prices_file
+        # alert id -> Alert, kept up to date from the applied operations
+        self.alerts = {}
+        self.initial_prices = {}
+        self._next_id = 1
+
+    def open(self):
+        pass
+
+    # Nothing to migrate, the JSON files are the storage
+    def migrate_from_json(self, alerts_file, prices_file):
+        return False
+
+    def next_alert_id(self):
+        alert_id = self._next_id
+        self._next_id += 1
+        return alert_id
+
+    # Load the files; the store keeps the returned initial_prices dictionary and snapshots it on every flush
+    def load(self):
+        alerts = alerts_from_json(self._read(self.alerts_file))
+        self.initial_prices = self._read(self.prices_file)
+
+        self._next_id = max((alert.id or 0 for alert in alerts), default=0) + 1
+        # Files written before alerts had ids
+        for alert in alerts:
+            if alert.id is None:
+                alert.id = self.next_alert_id()
+
+        self.alerts = {alert.id: alert for alert in alerts}
+        return alerts, self.initial_prices
+
+    def _read(self, path):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    # Track the alert changes, then write full snapshots
+    async def apply(self, ops):
+        for op in ops:
+            if op[0] == "add_alert":
+                self.alerts[op[1].id] = op[1]
+            elif op[0] == "delete_alert":
+                self.alerts.pop(op[1], None)
+
+        # Serialize on the event loop so the snapshot is consistent, write off it
+        alerts_data = json.dumps(alerts_to_json(self.alerts.values()))
+        prices_data = json.dumps(self.initial_prices)
+        await asyncio.to_thread(write_atomic, self.alerts_file, alerts_data)
+        await asyncio.to_thread(write_atomic, self.prices_file, prices_data)
+
+    async def close(self):
+        pass
+
+
+# Write a file by renaming a fully written temporary file over it
+def write_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Write-behind persistence. Mutations are recorded in memory and coalesced
+# (an alert added and deleted before a flush never reaches the store, repeated
+# initial-price updates keep only the last value). A background task flushes
+# them at most once per interval, or sooner once max_changes have piled up.
+class WriteBehind:
+    def __init__(self, store, interval=2.0, max_changes=500):
+        self.store = store
+        self.interval = interval
+        self.max_changes = max_changes
+        self._pending = {}
+        self._changes = 0
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def pending(self):
+        return len(self._pending)
+
+    def alert_added(self, alert):
+        self._pending[("alert", alert.id)] = ("add_alert", alert)
+        self._changed()
+
+    def alerts_deleted(self, alert_ids):
+        for alert_id in alert_ids:
+            key = ("alert", alert_id)
+            # Never written, so there is nothing to delete
+            if self._pending.get(key, ("",))[0] == "add_alert":
+                del self._pending[key]
+            else:
+                self._pending[key] = ("delete_alert", alert_id)
+        self._changed()
+
+    def initial_price_set(self, user_id, symbol, price):
+        self._pending[("initial_price", user_id, symbol)] = ("initial_price", user_id, symbol, price)
+        self._changed()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.max_changes:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._changes:
+                return
+
+            pending, self._pending = self._pending, {}
+            self._changes = 0
+            started = time.perf_counter()
+            try:
+                await self.store.apply(list(pending.values()))
+                FLUSH_SECONDS.observe(time.perf_counter() - started)
+                FLUSH_CHANGES.inc(len(pending))
+            except Exception as e:
+                FLUSH_ERRORS.inc()
+                logger.error(f"Error flushing {len(pending)} changes: {e}")
+                # Put the batch back under anything recorded since
+                self._pending = {**pending, **self._pending}
+                self._changes += len(pending)
+
+    # Stop the background task and write everything still pending
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
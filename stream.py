@@ -0,0 +1,187 @@
+import asyncio
+import csv
+import json
+import logging
+import random
+import time
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+TICKS_RECEIVED = Counter("stream_ticks_received_total", "Ticks pushed by price sources", ["symbol"])
+TICKS_COALESCED = Counter("stream_ticks_coalesced_total", "Ticks merged into a tick still waiting", ["symbol"])
+
+
+# Pipeline between price sources and alert evaluation. Sources push ticks;
+# a single consumer hands them to `handler(symbol, price, low, high, timestamp)`,
+# timestamp being when the source saw the (latest) price.
+# Ticks for a symbol that arrive while it is still waiting to be evaluated are
+# merged into one: the latest price plus the lowest and highest price seen,
+# so a target crossed and recrossed inside a burst is not missed. The number
+# of received ticks not yet evaluated, merged ones included, is bounded by
+# max_pending; when it is reached push() waits until the consumer catches up,
+# which slows the sources down.
+class TickPipeline:
+    def __init__(self, handler, max_pending=1000):
+        self.handler = handler
+        self.max_pending = max_pending
+        # symbol -> [price, low, high, timestamp, ticks merged] not yet evaluated
+        self._pending = {}
+        self._queue = asyncio.Queue()
+        # Ticks received and not yet evaluated, and an event set while there
+        # is room for more
+        self._backlog = 0
+        self._room = asyncio.Event()
+        self._room.set()
+        self.received = 0
+        self.coalesced = 0
+        self.processed = 0
+
+    async def push(self, symbol, price, timestamp=None):
+        while self._backlog >= self.max_pending:
+            await self._room.wait()
+        self._backlog += 1
+        if self._backlog >= self.max_pending:
+            self._room.clear()
+
+        self.received += 1
+        TICKS_RECEIVED.labels(symbol).inc()
+        pending = self._pending.get(symbol)
+        if pending is not None:
+            pending[0] = price
+            pending[1] = min(pending[1], price)
+            pending[2] = max(pending[2], price)
+            pending[3] = time.time() if timestamp is None else timestamp
+            pending[4] += 1
+            self.coalesced += 1
+            TICKS_COALESCED.labels(symbol).inc()
+            return
+
+        self._pending[symbol] = [price, price, price, time.time() if timestamp is None else timestamp, 1]
+        self._queue.put_nowait(symbol)
+
+    async def run(self):
+        while True:
+            symbol = await self._queue.get()
+            price, low, high, timestamp, merged = self._pending.pop(symbol)
+            try:
+                result = self.handler(symbol, price, low, high, timestamp)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error evaluating tick for {symbol}: {e}")
+            self.processed += 1
+            self._backlog -= merged
+            if self._backlog < self.max_pending:
+                self._room.set()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "processed": self.processed,
+            "pending": len(self._pending),
+            "backlog": self._backlog
+        }
+
+
+# Binance trade stream over a websocket. `streams` maps our symbol to the
+# Binance market, e.g. {"BTCUSD": "btcusdt"}. Reconnects with jittered backoff.
+class BinanceTradeSource:
+    def __init__(self, streams, url="wss://stream.binance.com:9443"):
+        self.streams = streams
+        self.url = url
+        self.connected = False
+        self._symbols = {market.upper(): symbol for symbol, market in streams.items()}
+
+    def symbols(self):
+        return list(self.streams)
+
+    async def run(self, pipeline):
+        # Optional dependency, only needed in streaming mode
+        import websockets
+
+        url = f"{self.url}/stream?streams=" + "/".join(f"{market}@trade" for market in self.streams.values())
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(url, ping_interval=20) as ws:
+                    self.connected = True
+                    attempt = 0
+                    logger.info(f"Connected to Binance trade stream for {', '.join(self.streams)}")
+                    async for message in ws:
+                        data = json.loads(message).get("data", {})
+                        symbol = self._symbols.get(data.get("s"))
+                        if symbol:
+                            await pipeline.push(symbol, float(data["p"]), data["T"] / 1000)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Binance trade stream disconnected: {e}")
+            finally:
+                self.connected = False
+
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, min(60, 2 ** attempt)))
+
+
+# Polls prices on an interval and feeds them into the pipeline. Used for
+# symbols that have no live stream, including streamed symbols whose
+# connection is down. `symbols` is called before every poll.
+class PollingSource:
+    def __init__(self, fetch_many, symbols, interval=5.0):
+        self.fetch_many = fetch_many
+        self.symbols = symbols
+        self.interval = interval
+
+    async def run(self, pipeline):
+        while True:
+            symbols = self.symbols()
+            if symbols:
+                try:
+                    prices = await self.fetch_many(symbols)
+                except Exception as e:
+                    logger.error(f"Error polling {', '.join(symbols)}: {e}")
+                    prices = {}
+                for symbol, price in prices.items():
+                    await pipeline.push(symbol, price)
+            await asyncio.sleep(self.interval)
+
+
+# Replays recorded ticks from a CSV (timestamp,symbol,price) or JSON-lines
+# ({"timestamp", "symbol", "price"}) file, `speed` times faster than they
+# were recorded; speed 0 replays as fast as the pipeline accepts them.
+class ReplaySource:
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+
+    def ticks(self):
+        with open(self.path, 'r') as f:
+            if self.path.endswith(".csv"):
+                for row in csv.reader(f):
+                    if row and row[0] != "timestamp":
+                        yield float(row[0]), row[1], float(row[2])
+            else:
+                for line in f:
+                    if line.strip():
+                        tick = json.loads(line)
+                        yield float(tick["timestamp"]), tick["symbol"], float(tick["price"])
+
+    async def run(self, pipeline):
+        started = time.monotonic()
+        first = None
+        count = 0
+        for timestamp, symbol, price in self.ticks():
+            if first is None:
+                first = timestamp
+            if self.speed:
+                delay = (timestamp - first) / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await pipeline.push(symbol, price, timestamp)
+            if not self.speed:
+                # Let the consumer keep up instead of merging the whole file into one tick
+                await asyncio.sleep(0)
+            count += 1
+        logger.info(f"Replay of {self.path} finished after {count} ticks")
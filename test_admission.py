@@ -0,0 +1,19 @@
+from admission import ADMIT, DROP, SHED, AdmissionControl
+
+
+def test_conversation_steps_are_admitted_over_budget():
+    admission = AdmissionControl(user_rate=0.001, user_burst=1, global_rate=0.001, global_burst=1)
+    assert admission.check(1) == ADMIT
+    assert admission.check(1) == SHED
+    assert admission.check(1, essential=True) == ADMIT
+    assert admission.check(2, essential=True) == ADMIT
+
+
+# A user over their own budget is answered once, while every update shed for
+# the global budget gets a reply
+def test_only_user_budget_sheds_are_dropped():
+    admission = AdmissionControl(user_rate=0.001, user_burst=1, global_rate=1000, global_burst=1000)
+    assert [admission.check(1) for _ in range(3)] == [ADMIT, SHED, DROP]
+
+    admission = AdmissionControl(user_rate=1000, user_burst=1000, global_rate=0.001, global_burst=1)
+    assert [admission.check(1) for _ in range(3)] == [ADMIT, SHED, SHED]
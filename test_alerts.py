@@ -0,0 +1,82 @@
+from alerts import Alert, AlertBook, AlertIndex, PercentMoveAlert, TrailingAlert
+
+
+# One tick the way bot.evaluate_price feeds it to the book: crossings since
+# the previous price, then the alerts added since then
+def tick(book, symbol, previous_price, price):
+    fired = book.pop_crossed(symbol, previous_price, price) if previous_price is not None else []
+    return [alert.id for alert in fired + book.release(symbol, price)]
+
+
+# Price evaluated at 100, the cache moves to 106 and the user sets 103 while
+# shown 106: the next tick at 106 must not fire it, a later fall through 103 must
+def test_new_alert_is_not_compared_with_an_older_price():
+    book = AlertBook()
+    assert tick(book, "BTCUSD", None, 100.0) == []
+    book.add(Alert(1, 7, "BTCUSD", 103.0, 0.0), reference_price=106.0)
+    assert tick(book, "BTCUSD", 100.0, 106.0) == []
+    assert tick(book, "BTCUSD", 106.0, 104.0) == []
+    assert tick(book, "BTCUSD", 104.0, 102.0) == [1]
+    assert len(book) == 0
+
+
+def test_new_alert_fires_when_crossed_before_its_first_tick():
+    book = AlertBook()
+    tick(book, "BTCUSD", None, 100.0)
+    book.add(Alert(1, 7, "BTCUSD", 103.0, 0.0), reference_price=106.0)
+    assert tick(book, "BTCUSD", 100.0, 102.0) == [1]
+
+
+def test_alert_deleted_before_its_first_tick():
+    book = AlertBook()
+    book.add(Alert(1, 7, "BTCUSD", 103.0, 0.0), reference_price=100.0)
+    assert book.remove(1).id == 1
+    assert tick(book, "BTCUSD", None, 104.0) == []
+    assert len(book.index) == 0
+
+
+# Alerts missing from saved index columns had not seen a price yet
+def test_load_keeps_alerts_missing_from_the_snapshot_pending():
+    saved = AlertBook()
+    saved.load([Alert(1, 7, "BTCUSD", 103.0, 0.0)])
+    columns = {"BTCUSD": (saved.index.targets["BTCUSD"].tobytes(), saved.index.ids["BTCUSD"].tobytes())}
+
+    book = AlertBook()
+    book.load([Alert(1, 7, "BTCUSD", 103.0, 0.0), Alert(2, 7, "BTCUSD", 101.0, 0.0)], columns)
+    assert list(book.index.ids["BTCUSD"]) == [1]
+    assert tick(book, "BTCUSD", 100.0, 104.0) == [1]
+    assert tick(book, "BTCUSD", 104.0, 100.5) == [2]
+
+
+# A spike inside ticks merged into one reaches percent-move and trailing
+# alerts through low and high
+def test_merged_spike_fires_move_and_trailing_alerts():
+    book = AlertBook()
+    book.add(PercentMoveAlert(1, 7, "BTCUSD", 100.0, 0.0, 5.0, 3600.0))
+    book.add(TrailingAlert(2, 7, "BTCUSD", 100.0, 0.0, 5.0))
+    assert book.pop_moved("BTCUSD", 100.0, 1.0) == []
+    # 100 -> 94 -> 100 merged into one tick at 100
+    assert sorted(alert.id for alert in book.pop_moved("BTCUSD", 100.0, 2.0, 94.0, 100.0)) == [1, 2]
+
+
+def test_merged_rise_then_fall_is_not_taken_as_a_trailing_stop():
+    book = AlertBook()
+    book.add(TrailingAlert(1, 7, "BTCUSD", 100.0, 0.0, 5.0))
+    # Whether 106 came before 100.5 is unknown, so 106 only becomes the peak
+    assert book.pop_moved("BTCUSD", 101.0, 1.0, 100.5, 106.0) == []
+    assert [alert.id for alert in book.pop_moved("BTCUSD", 100.0, 2.0)] == [1]
+
+
+def test_restore_takes_only_columns_matching_the_alerts():
+    alerts = [Alert(1, 7, "BTCUSD", 103.0, 0.0), Alert(2, 7, "BTCUSD", 101.0, 0.0), Alert(3, 7, "ETHUSD", 3000.0, 0.0)]
+    saved = AlertIndex()
+    saved.rebuild(alerts)
+    columns = {symbol: (saved.targets[symbol].tobytes(), saved.ids[symbol].tobytes()) for symbol in saved.targets}
+
+    index = AlertIndex()
+    assert index.restore(alerts, columns)
+    assert index.targets == saved.targets and index.ids == saved.ids
+    assert not AlertIndex().restore(alerts[:2], columns)
+    assert not AlertIndex().restore(alerts[:2] + [Alert(3, 7, "ETHUSD", 3001.0, 0.0)], columns)
+    unsorted = dict(columns, BTCUSD=(saved.targets["BTCUSD"][::-1].tobytes(), saved.ids["BTCUSD"][::-1].tobytes()))
+    assert not AlertIndex().restore(alerts, unsorted)
@@ -0,0 +1,43 @@
+import asyncio
+import io
+from types import SimpleNamespace
+import pytest
+from telegram.error import BadRequest
+from media import send_uploaded_once
+
+
+# Stand-in for bot.send_photo that rejects the cached file_id with `error`
+# and records every photo it was sent
+class FakeSend:
+    def __init__(self, error):
+        self.error = error
+        self.photos = []
+
+    async def __call__(self, photo, **kwargs):
+        self.photos.append(photo)
+        if photo == "cached":
+            raise BadRequest(self.error)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="fresh")])
+
+
+def send(fake, file_ids):
+    return asyncio.run(send_uploaded_once(
+        fake, asyncio.Lock(), lambda: file_ids[-1], file_ids.append,
+        lambda: io.BytesIO(b"image"), "logo.png", chat_id=1
+    ))
+
+
+def test_rejected_file_id_is_uploaded_again():
+    fake, file_ids = FakeSend("Wrong file identifier/http url specified"), ["cached"]
+    message, uploaded = send(fake, file_ids)
+    assert uploaded and message.photo[-1].file_id == "fresh"
+    assert len(fake.photos) == 2
+    assert file_ids == ["cached", None, "fresh"]
+
+
+def test_other_bad_requests_are_not_uploaded_again():
+    fake, file_ids = FakeSend("Chat not found"), ["cached"]
+    with pytest.raises(BadRequest, match="Chat not found"):
+        send(fake, file_ids)
+    assert fake.photos == ["cached"]
+    assert file_ids == ["cached"]
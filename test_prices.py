@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+import httpx
+import pytest
+from prices import PriceFetchError, PriceFetcher
+
+
+# Local HTTP server answering each request with the next of `responses`,
+# (status, headers, body) tuples, the last one repeated; records when every
+# request arrived
+class StubServer:
+    def __init__(self, responses, delay=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.requests = []
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/simple/price"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                self.requests.append(time.monotonic())
+                status, headers, body = self.responses[min(len(self.requests), len(self.responses)) - 1]
+                await asyncio.sleep(self.delay)
+                data = json.dumps(body).encode()
+                head = f"HTTP/1.1 {status} Stub\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+                writer.write(head.encode() + b"\r\n" + data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+OK = (200, {}, {"bitcoin": {"usd": 65000.0}})
+
+
+async def fetch(server, **options):
+    fetcher = PriceFetcher(**options)
+    try:
+        return await fetcher.get_json(server.url, params={"ids": "bitcoin"})
+    finally:
+        await fetcher.aclose()
+
+
+def test_retries_server_errors_with_backoff():
+    async def run():
+        async with StubServer([(503, {}, {}), (500, {}, {}), OK]) as server:
+            result = await fetch(server, retries=3, backoff=0.05)
+            return result, server.requests
+
+    result, requests = asyncio.run(run())
+    assert result == OK[2]
+    assert len(requests) == 3
+
+
+def test_gives_up_after_the_last_retry():
+    async def run():
+        async with StubServer([(502, {}, {})]) as server:
+            with pytest.raises(PriceFetchError, match="after 3 attempts"):
+                await fetch(server, retries=2, backoff=0.01)
+            return server.requests
+
+    assert len(asyncio.run(run())) == 3
+
+
+def test_client_errors_are_not_retried():
+    async def run():
+        async with StubServer([(404, {}, {})]) as server:
+            with pytest.raises(httpx.HTTPStatusError):
+                await fetch(server, retries=3)
+            return server.requests
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_waits_the_full_retry_after():
+    async def run():
+        async with StubServer([(429, {"Retry-After": "1"}, {}), OK]) as server:
+            # Longer than max_backoff, which must not cap it
+            result = await fetch(server, retries=1, max_backoff=0.1)
+            return result, server.requests
+
+    result, requests = asyncio.run(run())
+    assert result == OK[2]
+    assert len(requests) == 2
+    assert requests[1] - requests[0] >= 0.95
+
+
+def test_gives_up_on_a_retry_after_over_the_budget():
+    async def run():
+        async with StubServer([(429, {"Retry-After": "120"}, {}), OK]) as server:
+            started = time.monotonic()
+            with pytest.raises(PriceFetchError, match="retry after 120s"):
+                await fetch(server, retries=3, max_retry_after=30)
+            return time.monotonic() - started, server.requests
+
+    elapsed, requests = asyncio.run(run())
+    assert len(requests) == 1
+    assert elapsed < 1
+
+
+def test_concurrent_callers_share_one_request():
+    async def run():
+        async with StubServer([OK], delay=0.1) as server:
+            fetcher = PriceFetcher()
+            try:
+                results = await asyncio.gather(*(
+                    fetcher.get_json(server.url, params={"ids": "bitcoin"}) for _ in range(20)
+                ))
+                # Once it has finished, the next call makes a new request
+                await fetcher.get_json(server.url, params={"ids": "bitcoin"})
+            finally:
+                await fetcher.aclose()
+            return results, server.requests
+
+    results, requests = asyncio.run(run())
+    assert results == [OK[2]] * 20
+    assert len(requests) == 2
+
+
+def test_backoff_is_jittered_and_capped():
+    fetcher = PriceFetcher(backoff=0.5, max_backoff=8.0)
+    for attempt in range(8):
+        delays = [fetcher._backoff_delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= min(8.0, 0.5 * 2 ** attempt) for delay in delays)
+        assert len(set(delays)) > 1
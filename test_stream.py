@@ -0,0 +1,39 @@
+import asyncio
+from stream import TickPipeline
+
+
+# Merged ticks count against max_pending, so a slow consumer slows the
+# sources down even when only one symbol is ticking
+def test_push_waits_for_a_slow_consumer():
+    async def run():
+        evaluated = []
+
+        async def handle(symbol, price, low, high, timestamp):
+            evaluated.append((price, low, high))
+            await asyncio.sleep(0.05)
+
+        pipeline = TickPipeline(handle, max_pending=3)
+        consumer = asyncio.create_task(pipeline.run())
+        pushed = 0
+
+        async def produce():
+            nonlocal pushed
+            for price in range(10):
+                await pipeline.push("BTCUSD", float(price), timestamp=float(price))
+                pushed += 1
+
+        producer = asyncio.create_task(produce())
+        await asyncio.sleep(0.02)
+        blocked_at = pushed
+        await producer
+        await asyncio.sleep(0.2)
+        consumer.cancel()
+        return blocked_at, evaluated, pipeline.stats()
+
+    blocked_at, evaluated, stats = asyncio.run(run())
+    assert blocked_at <= 4
+    assert stats["received"] == 10 and stats["backlog"] == 0
+    # Every price reached the handler, merged or not
+    assert min(low for _, low, _ in evaluated) == 0.0
+    assert max(high for _, _, high in evaluated) == 9.0
+    assert evaluated[-1][0] == 9.0
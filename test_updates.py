@@ -0,0 +1,56 @@
+import asyncio
+import time
+from telegram import Chat, Message, Update, User
+from updates import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, "Test", False)
+    message = Message(update_id, None, Chat(user_id, "private"), from_user=user, text="x")
+    return Update(update_id, message=message)
+
+
+async def handle(duration, finished, name):
+    await asyncio.sleep(duration)
+    finished[name] = time.perf_counter()
+
+
+# Updates queued behind a user's slow update must not take the slots other
+# users need
+def test_waiting_updates_do_not_hold_slots():
+    async def run():
+        processor = PerUserUpdateProcessor(4)
+        finished = {}
+        started = time.perf_counter()
+        tasks = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), handle(0.3, finished, f"a{i}")))
+            for i in range(4)
+        ]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(10, 2), handle(0.01, finished, "b"))))
+        await asyncio.gather(*tasks)
+        return {name: at - started for name, at in finished.items()}
+
+    finished = asyncio.run(run())
+    assert finished["b"] < 0.1
+    # One user's updates still run one at a time, in order
+    assert finished["a0"] < finished["a1"] < finished["a2"] < finished["a3"]
+    assert finished["a3"] >= 1.2
+
+
+def test_limit_applies_across_users():
+    async def run():
+        processor = PerUserUpdateProcessor(2)
+        running = peak = 0
+
+        async def count():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(i, i), count()) for i in range(6)))
+        return peak
+
+    assert asyncio.run(run()) == 2
@@ -0,0 +1,59 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Limit handed to the base class, which must not limit anything itself
+UNLIMITED = 1 << 30
+
+
+# Processes updates concurrently, but one at a time and in arrival order for
+# each user, so steps of one user's conversation never race each other while
+# different users are served in parallel. Updates without a user or chat run
+# without ordering. At most `max_concurrent_updates` updates run at once; an
+# update waiting for its user's earlier updates does not hold one of those
+# slots, so a user with a queue of slow updates cannot hold up other users.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        # The base class takes its semaphore before do_process_update, i.e.
+        # before the user's lock; the real limit is applied after the lock
+        super().__init__(UNLIMITED)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # user or chat id -> [lock, updates holding or waiting for it]
+        self._locks = {}
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in the order they arrived
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass